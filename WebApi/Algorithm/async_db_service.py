@@ -0,0 +1,387 @@
+import asyncio
+from collections.abc import AsyncIterator
+import numpy
+import asyncpg
+from Algorithm.content_cache import ContentCache
+from Algorithm.db_service import hash_column, packed_video_fingerprints_from_rows, frequencies_of, \
+    PACKED_WORD_DTYPE, LOOKUP_BATCH_ROWS
+from Algorithm.default_logger import logger
+
+
+def asyncpg_connect_params(config: dict) -> dict:
+    """
+    Converts psycopg2 connection parameters ('database.ini') to asyncpg parameters.
+    """
+    params = dict(config)
+
+    if 'dbname' in params:
+        params['database'] = params.pop('dbname')
+    if 'port' in params:
+        params['port'] = int(params['port'])
+
+    return params
+
+
+class AsyncDBService:
+    """
+    Asyncio counterpart of 'DBService' on asyncpg: queries do not block the event loop,
+    so I/O of concurrent requests overlaps. Values are sent as binary parameters (hash arrays included)
+    and bulk inserts use binary COPY.
+    """
+
+    def __init__(self, pool: asyncpg.Pool, hash_index=None):
+        self.pool = pool
+        self.content_cache = ContentCache()
+        self.hash_index = hash_index
+
+    @classmethod
+    async def create(cls, min_conn: int, max_conn: int, config: dict, hash_index=None):
+        """
+        Creates a service to work with the database. Uses the asyncpg connection pool.
+
+        :param min_conn: minimum number of connections.
+        :param max_conn: the maximum number of connections.
+        :param config: connection parameters (as for 'DBService').
+        :param hash_index: 'AudioHashIndex' updated with the packed audio snapshots written to 'snapshot_audio'.
+        """
+        pool = await asyncpg.create_pool(min_size=min_conn, max_size=max_conn, **asyncpg_connect_params(config))
+
+        return cls(pool, hash_index)
+
+    async def update_hash_index(self, update, *args, **kwargs):
+        """
+        Applies a change to the hash index in a thread (see 'DBService.update_hash_index').
+        """
+        try:
+            await asyncio.to_thread(update, *args, **kwargs)
+
+        except Exception as error:
+            logger.error(f'Exception: hash index update failed: {error}')
+
+    async def close(self):
+        await self.pool.close()
+
+    async def add_content(self, title, duration) -> int:
+        """
+        Adds a new content with 'title' and 'duration' fields.
+
+        :param title: title content.
+        :param duration: duration content.
+        :return: content id from the database.
+        """
+
+        query = """ INSERT INTO content(title, duration)
+                    VALUES ($1, $2)
+                    RETURNING id;
+                """
+
+        id = None
+
+        try:
+            id = await self.pool.fetchval(query, title, None if duration is None else int(duration))
+            self.content_cache.invalidate(id)
+
+        except (Exception, asyncpg.PostgresError) as error:
+            logger.error(f'Exception: {error}')
+
+        finally:
+            return id
+
+    async def get_content_by_id(self, id: int) -> tuple[str, int]:
+        """
+        Getting content data by id content.
+
+        :param: id: id content.
+        :return: content data (title and duration in seconds).
+        """
+
+        return (await self.get_contents_by_ids([id])).get(id)
+
+    async def get_contents_by_ids(self, ids: list[int]) -> dict[int, tuple[str, int]]:
+        """
+        Getting content data of several contents in one query. Cached rows are not requested from the database.
+
+        :param ids: list of id content.
+        :return: dictionary id content -> content data (title and duration in seconds); unknown ids are omitted.
+        """
+
+        data, missing = self.content_cache.get_many(ids)
+        if not missing:
+            return data
+
+        query = """ SELECT id, title, duration
+                    FROM content
+                    WHERE id = ANY($1::integer[]);
+                """
+
+        try:
+            rows = await self.pool.fetch(query, [int(id) for id in missing])
+
+            rows = {row[0]: (row[1], row[2]) for row in rows}
+            self.content_cache.put_many(rows)
+            data.update(rows)
+
+        except (Exception, asyncpg.PostgresError) as error:
+            logger.error(f'Exception: {error}')
+
+        finally:
+            return data
+
+    async def delete_content_by_id(self, id: int) -> bool:
+        """
+        Deletes content with the specified id (see 'DBService.delete_content_by_id').
+
+        :param: id: id content.
+        :return: boolean value that tells whether the content was deleted.
+        """
+
+        result = False
+
+        try:
+            status = await self.pool.execute(""" DELETE FROM content WHERE id = $1; """, id)
+            result = status != 'DELETE 0'
+
+        except (Exception, asyncpg.PostgresError) as error:
+            logger.error(f'Exception: {error}')
+
+        finally:
+            self.content_cache.invalidate(id)
+            return result
+
+    async def cascade_delete_content_by_id(self, id: int) -> bool:
+        """
+        Performs cascading deletion of content in one transaction.
+
+        :param: id: id content.
+        :return: boolean value that tells whether the content was deleted.
+        """
+
+        result = False
+
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(""" DELETE FROM snapshot_audio WHERE id_content = $1; """, id)
+                    await conn.execute(""" DELETE FROM fingerprint_video WHERE id_content = $1; """, id)
+                    await conn.execute(""" DELETE FROM fingerprint_video_packed WHERE id_content = $1; """, id)
+                    status = await conn.execute(""" DELETE FROM content WHERE id = $1; """, id)
+                    result = status != 'DELETE 0'
+
+        except (Exception, asyncpg.PostgresError) as error:
+            logger.error(f'Exception: {error}')
+
+        finally:
+            self.content_cache.invalidate(id)
+            if result and self.hash_index is not None:
+                await self.update_hash_index(self.hash_index.remove_content, id)
+            return result
+
+    async def add_audio_snapshots(self, data: list[tuple[int, int, str]]) -> int:
+        """
+        Adds a list of audio snapshot data with binary COPY.
+
+        :param data: list with tuple ('id_content', 'timestamp' and 'hash').
+        :return: number of inserted rows.
+        :raises asyncpg.PostgresError: if the rows were not inserted (nothing is inserted in this case).
+        """
+
+        count = await self.copy_records('snapshot_audio', ['id_content', 'timestamp', 'hash'], data)
+
+        if self.hash_index is not None and data and not isinstance(data[0][2], str):
+            id_contents, timestamps, hashes = (numpy.array(column) for column in zip(*data))
+            await self.update_hash_index(self.hash_index.add, id_contents, hashes, timestamps)
+
+        return count
+
+    async def add_packed_audio_snapshots(self, id_content: int, hashes: numpy.ndarray, timestamps: numpy.ndarray,
+                                         table='snapshot_audio') -> int:
+        """
+        Adds audio snapshots of one content in the packed format ('hash' is bigint).
+
+        :param id_content: id content.
+        :param hashes: array of packed hashes (int64).
+        :param timestamps: array of snapshot times, same length as 'hashes'.
+        :param table: target table.
+        :return: number of inserted rows.
+        :raises asyncpg.PostgresError: if the rows were not inserted.
+        """
+
+        records = zip([int(id_content)] * len(hashes), numpy.asarray(timestamps).tolist(),
+                      numpy.asarray(hashes).tolist())
+
+        count = await self.copy_records(table, ['id_content', 'timestamp', 'hash'], records)
+
+        if self.hash_index is not None and table == 'snapshot_audio':
+            await self.update_hash_index(self.hash_index.add, id_content, hashes, timestamps)
+
+        return count
+
+    async def copy_records(self, table: str, column_names: list[str], records) -> int:
+        """
+        Loads rows into the table with binary COPY.
+
+        :param table: table name.
+        :param column_names: names of the table columns.
+        :param records: iterable of tuples, one value per column.
+        :return: number of inserted rows.
+        :raises asyncpg.PostgresError: if the rows were not inserted (nothing is inserted in this case).
+        """
+
+        try:
+            async with self.pool.acquire() as conn:
+                status = await conn.copy_records_to_table(table, records=records, columns=column_names)
+
+            return int(status.split()[-1])
+
+        except (Exception, asyncpg.PostgresError) as error:
+            logger.error(f'Exception: {error}')
+            raise
+
+    async def get_audio_snapshots_by_hashes(self, hashes) -> list[tuple[int, int, str]]:
+        """
+        Performs a hash search and returns matches from the database.
+
+        :param hashes: snapshot hashes (packed int64 hashes or SHA-256 hex digests).
+        :return: list of hashes from elements (‘id_content’, ‘timestamp’, ‘hash’).
+        :raises asyncpg.PostgresError: if the search failed (a failed search is not "no matches").
+        """
+
+        data = []
+
+        async for rows in self.iter_audio_snapshots_by_hashes(hashes):
+            data.extend(rows)
+
+        return data
+
+    async def iter_audio_snapshots_by_hashes(self, hashes, batch_size=LOOKUP_BATCH_ROWS)\
+            -> AsyncIterator[list[tuple[int, int, str]]]:
+        """
+        Performs a hash search and yields matches from the database in batches.
+        The distinct hashes are sent as one binary array parameter; rows are read through a cursor.
+
+        :param hashes: snapshot hashes (packed int64 hashes or SHA-256 hex digests).
+        :param batch_size: maximum number of rows in a batch.
+        :return: asynchronous iterator over lists of elements (‘id_content’, ‘timestamp’, ‘hash’).
+        :raises asyncpg.PostgresError: if the search failed.
+        """
+
+        hashes = numpy.unique(hash_column(hashes))
+        if len(hashes) == 0:
+            return
+
+        if hashes.dtype.kind == 'S':
+            query = """ SELECT id_content, timestamp, hash FROM snapshot_audio WHERE hash = ANY($1::text[]) """
+            values = hashes.astype(str).tolist()
+        else:
+            query = """ SELECT id_content, timestamp, hash FROM snapshot_audio WHERE hash = ANY($1::bigint[]) """
+            values = hashes.tolist()
+
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    cursor = await conn.cursor(query, values)
+
+                    while rows := await cursor.fetch(batch_size):
+                        yield [tuple(row) for row in rows]
+
+        except (Exception, asyncpg.PostgresError) as error:
+            logger.error(f'Exception: {error}')
+            raise
+
+    async def get_hash_frequencies(self, hashes) -> numpy.ndarray:
+        """
+        Returns the numbers of snapshots of the hashes (see 'DBService.get_hash_frequencies').
+        """
+
+        hashes = hash_column(hashes)
+        frequencies = numpy.zeros(len(hashes), dtype=numpy.int64)
+        if len(hashes) == 0 or hashes.dtype.kind == 'S':
+            return frequencies
+
+        query = """ SELECT hash, snapshots FROM audio_hash_stats WHERE hash = ANY($1::bigint[]) """
+
+        try:
+            rows = await self.pool.fetch(query, numpy.unique(hashes).tolist())
+            frequencies = frequencies_of(hashes, [tuple(row) for row in rows])
+
+        except (Exception, asyncpg.PostgresError) as error:
+            logger.error(f'Exception: {error}')
+
+        finally:
+            return frequencies
+
+    async def add_packed_video_fingerprints(self, id_content: int, timestamps: numpy.ndarray,
+                                            fingerprints: numpy.ndarray, sizes: numpy.ndarray) -> int:
+        """
+        Adds video fingerprints in the packed format (see 'DBService.add_packed_video_fingerprints').
+
+        :param id_content: id content.
+        :param timestamps: fingerprint timestamps (milliseconds).
+        :param fingerprints: packed fingerprints (uint64 words, one row per fingerprint).
+        :param sizes: numbers of values in fingerprints.
+        :return: number of inserted rows.
+        :raises asyncpg.PostgresError: if the rows were not inserted (nothing is inserted in this case).
+        """
+
+        fingerprints = numpy.ascontiguousarray(fingerprints, dtype=PACKED_WORD_DTYPE)
+        records = zip([int(id_content)] * len(fingerprints), numpy.asarray(timestamps).tolist(),
+                      numpy.asarray(sizes).tolist(), map(bytes, fingerprints))
+
+        return await self.copy_records('fingerprint_video_packed', ['id_content', 'timestamp', 'size', 'fingerprint'],
+                                       records)
+
+    async def get_packed_video_fingerprints(self, id_content, timestamp_start, timestamp_end)\
+            -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """
+        Reads packed video fingerprints of the content in the time range.
+
+        :param id_content: id content.
+        :param timestamp_start: start time.
+        :param timestamp_end: end time.
+        :return: timestamps (int32), packed fingerprints (uint64 words, one row per fingerprint, ordered by time)
+            and numbers of values in fingerprints (int32).
+        """
+
+        query = """ SELECT timestamp, size, fingerprint
+                    FROM fingerprint_video_packed
+                    WHERE id_content = $1 AND timestamp BETWEEN $2 AND $3
+                    ORDER BY timestamp
+                """
+
+        rows = []
+
+        try:
+            rows = await self.pool.fetch(query, id_content, int(timestamp_start), int(timestamp_end))
+
+        except (Exception, asyncpg.PostgresError) as error:
+            logger.error(f'Exception: {error}')
+
+        return packed_video_fingerprints_from_rows(rows)
+
+    async def get_video_fingerprints_by_hash(self, id_content, timestamp_start, timestamp_end)\
+            -> list[tuple[int, int, int]]:
+        """
+        Performs a fingerprint search in 'fingerprint_video' (see 'DBService.get_video_fingerprints_by_hash').
+
+        :param id_content: id content.
+        :param timestamp_start: start time.
+        :param timestamp_end: end time.
+        :return: list of tuple (‘column’, ‘row’, ‘timestamp’).
+        """
+
+        query = """ SELECT "column", row, timestamp
+                    FROM fingerprint_video
+                    WHERE id_content = $1 and timestamp BETWEEN $2 AND $3
+                """
+
+        data = []
+
+        try:
+            rows = await self.pool.fetch(query, id_content, int(timestamp_start), int(timestamp_end))
+            data = [tuple(row) for row in rows]
+
+        except (Exception, asyncpg.PostgresError) as error:
+            logger.error(f'Exception: {error}')
+
+        finally:
+            return data
@@ -1,23 +1,57 @@
-import time
 import hashlib
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy.fft import rfft
 from scipy.ndimage import maximum_filter
-from sklearn.neighbors import KDTree
 from Algorithm.audio_utility import get_audio_duration
 from Algorithm.default_logger import logger
+from Algorithm.metrics import metrics
 
+# Минимальная мощность спектра (-200 дБ), подставляемая вместо нуля перед логарифмированием.
+MIN_POWER = 1e-20
 
-def compute_log_spectrogram(audio_samples: np.ndarray, sample_rate: int, frame_size=2048, hop_size=512) \
-        -> tuple[np.ndarray, int, int, int]:
+# Форматы хэшей: упакованное 64-битное целое (bigint в БД) и прежний SHA-256 в виде hex-строки.
+HASH_FORMAT_PACKED = 'packed'
+HASH_FORMAT_SHA256 = 'sha256'
+DEFAULT_HASH_FORMAT = HASH_FORMAT_PACKED
+
+# Количество бит на каждое поле упакованного хэша (freq_a, freq_b, delta_time).
+HASH_FIELD_BITS = 20
+
+
+def frame_signal(audio_samples: np.ndarray, frame_size: int, hop_size: int) -> np.ndarray:
+    """
+    Представляет сигнал в виде матрицы перекрывающихся фреймов без копирования данных.
+
+    :param audio_samples: Одноканальные аудиоданные.
+    :param frame_size: Размер каждого фрейма.
+    :param hop_size: Шаг между фреймами.
+
+    :return frames: Представление (view) размерности (количество фреймов, frame_size), доступное только для чтения.
+    """
+    num_frames = max((len(audio_samples) - frame_size) // hop_size + 1, 0)
+    stride = audio_samples.strides[0]
+
+    return as_strided(audio_samples, shape=(num_frames, frame_size), strides=(hop_size * stride, stride),
+                      writeable=False)
+
+
+def compute_log_spectrogram(audio_samples: np.ndarray, sample_rate: int, frame_size=2048, hop_size=512,
+                            block_frames=1024) -> tuple[np.ndarray, int, int, int]:
     """
     Загружает WAV файл и вычисляет его логарифмическую спектрограмму.
 
+    Фреймы не копируются по одному: сигнал представляется в виде матрицы фреймов (strided view),
+    а БПФ выполняется сразу для блока из block_frames фреймов в float32. Размер блока ограничивает
+    объем временной памяти для длинных записей.
+
     :param audio_samples: Аудиоданные.
     :param sample_rate: Частота дискретизации аудиоданных.
     :param frame_size: Размер каждого фрейма для FFT. По умолчанию 2048.
     :param hop_size: Шаг между фреймами. По умолчанию 512.
+    :param block_frames: Количество фреймов, обрабатываемых одним вызовом FFT. По умолчанию 1024.
 
-    :return log_spectrogram: Логарифмическая спектрограмма.
+    :return log_spectrogram: Логарифмическая спектрограмма (float32).
     :return sample_rate: Частота дискретизации аудиофайла.
     :return frames_count: Количество фреймов в логарифмической спектрограмме.
     :return freq_count: Количество частотных бинов в логарифмической спектрограмме.
@@ -26,21 +60,29 @@ def compute_log_spectrogram(audio_samples: np.ndarray, sample_rate: int, frame_s
         if len(audio_samples.shape) > 1:  # Если стерео, взять только первый канал
             audio_samples = audio_samples[:, 0]
 
-        num_frames = (len(audio_samples) - frame_size) // hop_size + 1
+        frames = frame_signal(audio_samples, frame_size, hop_size)
+        num_frames = frames.shape[0]
+
+        # Окно Хэннинга применяется сразу ко всему блоку фреймов
+        window = np.hanning(frame_size).astype(np.float32)
+
+        log_spectrogram = np.empty((num_frames, frame_size // 2 + 1), dtype=np.float32)
 
-        # Применение окна Хэннинга к каждому фрейму
-        window = np.hanning(frame_size)
+        for start in range(0, num_frames, block_frames):
+            stop = min(start + block_frames, num_frames)
 
-        log_spectrogram = []
+            block = frames[start:stop].astype(np.float32)
+            block *= window
 
-        for i in range(num_frames):
-            frame = audio_samples[i * hop_size:i * hop_size + frame_size].astype(np.float32)
-            frame *= window
-            spectrogram = np.abs(np.fft.rfft(frame, n=frame_size))
-            power_spectrum = spectrogram ** 2
-            log_spectrogram.append(10 * np.log10(power_spectrum))
+            spectrum = rfft(block, n=frame_size, axis=1)
+            power_spectrum = spectrum.real ** 2 + spectrum.imag ** 2
 
-        log_spectrogram = np.array(log_spectrogram)
+            # Тишина дает нулевую мощность: ограничиваем снизу, чтобы не получать -inf
+            np.maximum(power_spectrum, MIN_POWER, out=power_spectrum)
+
+            block_log = log_spectrogram[start:stop]
+            np.log10(power_spectrum, out=block_log)
+            block_log *= 10
 
         return log_spectrogram, sample_rate, log_spectrogram.shape[0], log_spectrogram.shape[1]
 
@@ -49,7 +91,6 @@ def compute_log_spectrogram(audio_samples: np.ndarray, sample_rate: int, frame_s
 
     except Exception as e:
         print(f"Произошла ошибка: {e}")
-    
 
 
 def apply_maximum_filter(spectrogram, size_window):
@@ -72,116 +113,560 @@ def apply_maximum_filter(spectrogram, size_window):
     return filtered_spectrogram
 
 
-def find_peaks(spectrogram, threshold_ratio=0.8, neighborhood_size=20):
+def find_peaks(spectrogram, threshold_ratio=0.8, neighborhood_size=20, threshold_db=None):
     """
     Функция для поиска пиков в двумерном массиве (спектрограмме).
     
     :param spectrogram: логарифмическая спектрограмма
     :param threshold_ratio: процент от максимальной амплитуды для порога
     :param neighborhood_size: размер окна для поиска локальных максимумов
+    :param threshold_db: абсолютный порог (дБ); если задан, threshold_ratio не используется
     
     :return detected_peaks: двумерный логический массив, где True обозначает пик
     """
 
     # Normalize spectrogram
-    max_val = np.max(spectrogram)
-    threshold = threshold_ratio * max_val
+    if threshold_db is None:
+        max_val = np.max(spectrogram)
+        threshold = threshold_ratio * max_val
+    else:
+        threshold = threshold_db
     
     # Find local maximums
     local_max = maximum_filter(spectrogram, size=neighborhood_size) == spectrogram
     detected_peaks = (spectrogram > threshold) & local_max
     return detected_peaks
 
-def make_pairs(peaks, time_window=50, freq_window=20):
+def iter_window_neighbours(times: np.ndarray, max_distance: int):
+    """
+    Перебирает пары точек, отсортированных по времени, расстояние по времени между которыми не больше max_distance.
+    Пары выдаются группами по сдвигу k: точка i сравнивается с точкой i + k сразу для всех i (скользящее окно).
+
+    :param times: отсортированный по возрастанию массив времен точек
+    :param max_distance: максимальное расстояние по времени между точками пары
+
+    :return: генератор кортежей (индексы первых точек, индексы вторых точек, расстояние по времени)
+    """
+
+    count = len(times)
+    active = np.arange(count)
+    shift = 1
+
+    while active.size:
+        active = active[active + shift < count]
+        distance = times[active + shift] - times[active]
+
+        # Если для точки i сдвиг k уже вышел за окно, то и все следующие сдвиги тоже выйдут
+        in_window = distance <= max_distance
+        active = active[in_window]
+
+        if active.size:
+            yield active, active + shift, distance[in_window]
+
+        shift += 1
+
+
+def axis_slice(axis: int, start: int, stop: int) -> tuple[slice, slice]:
+    """
+    Индекс двумерного массива, выбирающий диапазон [start, stop) вдоль оси axis.
+    """
+    index = [slice(None), slice(None)]
+    index[axis] = slice(start, stop)
+
+    return tuple(index)
+
+
+def window_max(array: np.ndarray, size: int, mode='reflect') -> np.ndarray:
+    """
+    Фильтр максимумов с квадратным окном size x size, совпадающий с scipy.ndimage.maximum_filter
+    для режимов 'reflect' и 'constant' (cval=0).
+
+    Фильтр разделяется по осям, а максимум в окне вдоль оси вычисляется удвоением длины окна
+    (log2(size) + 1 операций np.maximum над всем массивом вместо size).
+
+    :param array: двумерный массив
+    :param size: размер окна
+    :param mode: 'reflect' или 'constant'
+
+    :return: массив максимумов той же формы
+    """
+    before = size // 2
+    after = size - before - 1
+
+    result = array
+    for axis in (0, 1):
+        pad_width = [(0, 0), (0, 0)]
+        pad_width[axis] = (before, after)
+        padded = np.pad(result, pad_width, mode='symmetric' if mode == 'reflect' else 'constant')
+
+        # current[i] - максимум в окне длины width, начинающемся с i
+        current = padded
+        width = 1
+        while 2 * width <= size:
+            count = current.shape[axis] - width
+            current = np.maximum(current[axis_slice(axis, 0, count)], current[axis_slice(axis, width, width + count)])
+            width *= 2
+
+        length = array.shape[axis]
+        result = np.maximum(current[axis_slice(axis, 0, length)],
+                            current[axis_slice(axis, size - width, size - width + length)])
+
+    return result
+
+
+def pick_peaks(spectrogram, threshold_ratio=0.8, neighborhood_size=20, size_window=3, threshold_db=None,
+               tile_frames=512) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Поиск пиков за один проход, дающий тот же набор пиков, что и
+    find_peaks(apply_maximum_filter(spectrogram, size_window), threshold_ratio, neighborhood_size, threshold_db).
+
+    Спектрограмма обрабатывается частями по tile_frames фреймов (с полями для фильтров): для каждой части
+    фильтры size_window и neighborhood_size (window_max) выполняются подряд, пока данные в кэше,
+    без промежуточных копий всей спектрограммы. Результат - разреженные координаты пиков.
+
+    :param spectrogram: логарифмическая спектрограмма
+    :param threshold_ratio: процент от максимальной амплитуды для порога
+    :param neighborhood_size: размер окна для поиска локальных максимумов
+    :param size_window: размер окна первичного фильтра максимумов
+    :param threshold_db: абсолютный порог (дБ); если задан, threshold_ratio не используется
+    :param tile_frames: количество фреймов в одной части; None - вся спектрограмма сразу
+
+    :return: кортеж массивов (time, freq) координат пиков, упорядоченных по времени
+    """
+
+    if threshold_db is None:
+        # После первого фильтра отброшенные точки равны нулю, поэтому максимум не меньше нуля
+        threshold = threshold_ratio * max(float(np.max(spectrogram)), 0)
+    else:
+        threshold = threshold_db
+
+    num_frames = spectrogram.shape[0]
+    tile_frames = tile_frames or max(num_frames, 1)
+
+    # Поля части: от них зависит результат обоих фильтров для фреймов внутри части
+    margin = size_window + neighborhood_size
+
+    times_list = []
+    freqs_list = []
+    for start in range(0, num_frames, tile_frames):
+        stop = min(start + tile_frames, num_frames)
+        lo = max(start - margin, 0)
+        hi = min(stop + margin, num_frames)
+
+        part = spectrogram[lo:hi]
+        filtered = np.where(part == window_max(part, size_window, mode='constant'), part, 0)
+        filtered = filtered.astype(spectrogram.dtype, copy=False)
+
+        rows = filtered[start - lo:stop - lo]
+        local_max = window_max(filtered, neighborhood_size)[start - lo:stop - lo]
+
+        times, freqs = np.nonzero((rows > threshold) & (local_max == rows))
+        times_list.append(times + start)
+        freqs_list.append(freqs)
+
+    if not times_list:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    return np.concatenate(times_list).astype(np.int64), np.concatenate(freqs_list).astype(np.int64)
+
+
+def make_pairs(peaks, time_window=50, freq_window=20, fan_out=None):
     """
     Функция для формирования пар опорных и целевых точек из target-зоны.
 
-    :param peaks: двумерный логический массив пиков
+    :param peaks: двумерный логический массив пиков или массив координат пиков (time, freq),
+        отсортированный по времени
     :param time_window: максимальный временной интервал между anchor и target
     :param freq_window: максимальная частотная разница между anchor и target
+    :param fan_out: максимальное количество целевых точек для одной опорной (ближайшие по времени);
+        None - без ограничения
 
-    :return pairs: список пар точек ((time_a, freq_a), (time_b, freq_b))
+    :return pairs: кортеж массивов (time_a, freq_a, time_b, freq_b), упорядоченных по опорной точке
     """
 
     # Get coordinates of peaks
-    peak_coordinates = np.argwhere(peaks)
+    peak_coordinates = np.argwhere(peaks) if peaks.dtype == bool else np.asarray(peaks, dtype=np.int64)
+    times = peak_coordinates[:, 0]
+    freqs = peak_coordinates[:, 1]
+
+    targets_count = np.zeros(len(times), dtype=np.int64)
+    anchors_list = []
+    targets_list = []
+
+    for anchors, targets, distance in iter_window_neighbours(times, time_window):
+        valid = (distance > 0) & (np.abs(freqs[targets] - freqs[anchors]) <= freq_window)
+        anchors = anchors[valid]
+        targets = targets[valid]
+
+        if fan_out is not None:
+            # Каждая опорная точка встречается не более одного раза на сдвиг
+            free = targets_count[anchors] < fan_out
+            anchors = anchors[free]
+            targets = targets[free]
+            targets_count[anchors] += 1
+
+        anchors_list.append(anchors)
+        targets_list.append(targets)
+
+    if anchors_list:
+        anchors = np.concatenate(anchors_list)
+        targets = np.concatenate(targets_list)
+        order = np.lexsort((targets, anchors))
+        anchors = anchors[order]
+        targets = targets[order]
+    else:
+        anchors = targets = np.empty(0, dtype=np.int64)
+
+    return times[anchors], freqs[anchors], times[targets], freqs[targets]
+
+
+def hash_pair(freq_a, freq_b, delta_time) -> str:
+    """
+    Формирует хэш пары точек по частотам и разнице времени между ними.
+
+    :param freq_a: частота опорной точки
+    :param freq_b: частота целевой точки
+    :param delta_time: разница времени между целевой и опорной точками (в фреймах)
+
+    :return hash_hex: хэш в виде шестнадцатеричной строки
+    """
+
+    # Key generation from frequencies and time difference
+    key = f"{freq_a}-{freq_b}-{delta_time}"
+
+    # Create hash value
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def pack_hashes(freqs_a: np.ndarray, freqs_b: np.ndarray, delta_times: np.ndarray) -> np.ndarray:
+    """
+    Упаковывает частоты пары точек и разницу времени между ними в одно 64-битное целое:
+    freq_a << 40 | freq_b << 20 | delta_time (по HASH_FIELD_BITS бит на поле).
+
+    :param freqs_a: частоты опорных точек
+    :param freqs_b: частоты целевых точек
+    :param delta_times: разница времени между целевой и опорной точками (в фреймах)
+
+    :return hashes: массив хэшей (int64, всегда неотрицательные, соответствуют типу bigint в БД)
+    """
+    mask = (1 << HASH_FIELD_BITS) - 1
+
+    hashes = (np.asarray(freqs_a, dtype=np.int64) & mask) << (2 * HASH_FIELD_BITS)
+    hashes |= (np.asarray(freqs_b, dtype=np.int64) & mask) << HASH_FIELD_BITS
+    hashes |= np.asarray(delta_times, dtype=np.int64) & mask
+
+    return hashes
 
-    # Create KD-Tree from peak coordinates
-    tree = KDTree(peak_coordinates)
 
-    pairs = []
-    # For each peak, look for the nearest points in the given windows
-    for i, (t1, f1) in enumerate(peak_coordinates):
-        # Find points within time_window and freq_window
-        indices = tree.query_radius([[t1, f1]], r=np.sqrt(time_window ** 2 + freq_window ** 2))[0]
+def unpack_hashes(hashes: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Обратное преобразование к pack_hashes.
+
+    :param hashes: массив упакованных хэшей
+    :return: кортеж массивов (freq_a, freq_b, delta_time)
+    """
+    mask = (1 << HASH_FIELD_BITS) - 1
+    hashes = np.asarray(hashes, dtype=np.int64)
+
+    return (hashes >> (2 * HASH_FIELD_BITS)) & mask, (hashes >> HASH_FIELD_BITS) & mask, hashes & mask
+
+
+def anchor_times_ms(times_a: np.ndarray, duration) -> np.ndarray:
+    """
+    Переводит время опорных точек (в фреймах) в миллисекунды, масштабируя диапазон времен на длительность записи.
+
+    :param times_a: время опорных точек в фреймах, упорядоченное по возрастанию
+    :param duration: длительность записи в миллисекундах
+
+    :return times_ms: массив времени в миллисекундах
+    """
+    min_duration_ds = times_a[0]
+    max_duration_ds = times_a[-1]
+
+    # Все опорные точки в одном фрейме: диапазон нулевой, время первой опорной точки - 0
+    if max_duration_ds == min_duration_ds:
+        return np.zeros(len(times_a), dtype=np.int64)
+
+    step = ((max_duration_ds - min_duration_ds) / duration)
+
+    return ((times_a - min_duration_ds) / step).astype(np.int64)
+
+
+def generate_packed_hashes(pairs, duration) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Векторизованное формирование упакованных хэшей (pack_hashes) для пар точек.
+
+    :param pairs: кортеж массивов (time_a, freq_a, time_b, freq_b)
+    :param duration: длительность записи в миллисекундах
+
+    :return: кортеж массивов (хэши int64, время якорной точки в миллисекундах)
+    """
+    times_a, freqs_a, times_b, freqs_b = pairs
 
-        for j in indices:
-            if i != j:
-                t2, f2 = peak_coordinates[j]
-                if 0 < (t2 - t1) <= time_window and abs(f2 - f1) <= freq_window:
-                    pairs.append(((t1, f1), (t2, f2)))
+    if len(times_a) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
 
-    return pairs
+    return pack_hashes(freqs_a, freqs_b, times_b - times_a), anchor_times_ms(times_a, duration)
 
 
-def generate_hashes(pairs, duration):
+def generate_hashes(pairs, duration, hash_format=DEFAULT_HASH_FORMAT):
     """
     Функция для формирования хэш слепка для пар точек.
     
-    :param pairs: список пар точек с ((t1, f1), (t2, f2))
+    :param pairs: кортеж массивов (time_a, freq_a, time_b, freq_b)
+    :param duration: длительность записи в миллисекундах
+    :param hash_format: HASH_FORMAT_PACKED (целые bigint) или HASH_FORMAT_SHA256 (прежний формат, hex-строки)
     
     :return result_hashes: спиок хэш сплепков для каждой пары и время якороной точки A
     """
-    min_duration_ds = pairs[0][0][0]
-    max_duration_ds = pairs[-1][0][0]
-    step = ((max_duration_ds - min_duration_ds) / duration)
+    if hash_format == HASH_FORMAT_PACKED:
+        hashes, times_ms = generate_packed_hashes(pairs, duration)
+        return list(zip(hashes.tolist(), times_ms.tolist()))
+
+    times_a, freqs_a, times_b, freqs_b = pairs
+
+    if len(times_a) == 0:
+        return []
+
+    # Convert to milliseconds
+    times_ms = anchor_times_ms(times_a, duration)
 
     result_hashes = []
-    for pair in pairs:
+    for freq_a, freq_b, delta_time, time_a in zip(freqs_a.tolist(), freqs_b.tolist(), (times_b - times_a).tolist(),
+                                                  times_ms.tolist()):
+        result_hashes.append((hash_pair(freq_a, freq_b, delta_time), time_a))
+
+    return result_hashes
 
-        point_a, point_b = pair
-        time_a, freq_a = point_a
-        time_b, freq_b = point_b
 
-        # Key generation from frequencies and time difference
-        key = f"{freq_a}-{freq_b}-{time_b - time_a}"
+def create_audio_hashes(audio_samples: np.ndarray, sample_rate: int, frame_size=2048, hop_size=512, size_window=3,
+                          threshold_ratio=0.8, neighborhood_size=20, time_window=50, freq_window=20, threshold_db=None,
+                          fan_out=None, hash_format=DEFAULT_HASH_FORMAT) -> list[tuple[int | str, int]]:
+
+    duration_audio_ms = int(get_audio_duration(audio_samples, sample_rate) * 1000)
 
-        # Create hash value
-        hash_object = hashlib.sha256(key.encode())
-        hash_hex = hash_object.hexdigest()
+    with metrics.stage('stft'):
+        spectrogram, _, _, _ = compute_log_spectrogram(audio_samples, sample_rate, frame_size=frame_size,
+                                                       hop_size=hop_size)
+    logger.debug(f'created spectrogram (shape: {spectrogram.shape})')
 
-        # Convert to milliseconds
-        time_a = int((time_a - min_duration_ds) / step)
+    with metrics.stage('peak_picking'):
+        peaks = pick_peaks(spectrogram, threshold_ratio=threshold_ratio, neighborhood_size=neighborhood_size,
+                           size_window=size_window, threshold_db=threshold_db)
+    metrics.count('peaks', len(peaks[0]))
 
-        result_hashes.append((hash_hex, time_a))
+    with metrics.stage('pairing'):
+        pairs = make_pairs(np.column_stack(peaks), time_window=time_window, freq_window=freq_window, fan_out=fan_out)
+    metrics.count('pairs', len(pairs[0]))
+
+    with metrics.stage('hashing'):
+        result_hashes = generate_hashes(pairs, duration=duration_audio_ms, hash_format=hash_format)
+    metrics.count('hashes', len(result_hashes))
 
     return result_hashes
 
 
-def create_audio_hashes(audio_samples: np.ndarray, sample_rate: int, frame_size=2048, hop_size=512, size_window=3,
-                          threshold_ratio=0.8, neighborhood_size=20, time_window=50, freq_window=20)\
-        -> list[tuple[str, int]]:
+def iter_log_spectrogram_blocks(chunks, sample_rate: int, frame_size=2048, hop_size=512, block_frames=1024):
+    """
+    Потоково вычисляет логарифмическую спектрограмму: фреймы те же, что у compute_log_spectrogram
+    для всего сигнала. Между частями хранится только необработанный хвост сигнала.
 
-    duration_audio_ms = int(get_audio_duration(audio_samples, sample_rate) * 1000)
+    :param chunks: итерируемый объект с частями аудиоданных (numpy массивы, для стерео берется первый канал).
+    :param sample_rate: Частота дискретизации аудиоданных.
+    :param block_frames: Количество фреймов, обрабатываемых одним вызовом FFT.
 
-    start_time = time.time()
-    spectrogram, _, _, _ = compute_log_spectrogram(audio_samples, sample_rate, frame_size=frame_size, hop_size=hop_size)
-    logger.debug(f'created spectrogram (shape: {spectrogram.shape}); done: {time.time() - start_time} seconds')
+    :return: генератор идущих подряд частей спектрограммы (float32).
+    """
+    pending = None                      # необработанный хвост сигнала
+
+    for chunk in chunks:
+        if len(chunk.shape) > 1:
+            chunk = chunk[:, 0]
+        if len(chunk) == 0:
+            continue
 
-    start_time = time.time()
-    filtered_spectrogram = apply_maximum_filter(spectrogram, size_window=size_window)
-    logger.debug(f'applied maximum filter (shape: {filtered_spectrogram.shape}); done: {time.time() - start_time} seconds')
+        pending = chunk if pending is None else np.concatenate([pending, chunk])
 
-    start_time = time.time()
-    peaks_mask = find_peaks(filtered_spectrogram, threshold_ratio=threshold_ratio, neighborhood_size=neighborhood_size)
-    logger.debug(f'found peak mask; done: {time.time() - start_time} seconds')
+        with metrics.stage('stft'):
+            block, _, frames_count, _ = compute_log_spectrogram(pending, sample_rate, frame_size=frame_size,
+                                                                hop_size=hop_size, block_frames=block_frames)
+        if frames_count == 0:
+            continue
 
-    start_time = time.time()
-    pairs = make_pairs(peaks_mask, time_window=time_window, freq_window=freq_window)
-    logger.debug(f'found {len(pairs)} pairs; done: {time.time() - start_time} seconds')
+        pending = pending[frames_count * hop_size:]
 
-    start_time = time.time()
-    result_hashes = generate_hashes(pairs, duration=duration_audio_ms)
-    logger.debug(f'generated {len(result_hashes)} hashes; done: {time.time() - start_time} seconds')
+        yield block
 
-    return result_hashes    
\ No newline at end of file
+
+def spectrogram_max(chunks, sample_rate: int, frame_size=2048, hop_size=512, block_frames=1024) -> float | None:
+    """
+    Максимум логарифмической спектрограммы, вычисленный потоково.
+
+    :return: максимум (дБ) или None, если в сигнале нет ни одного фрейма.
+    """
+    result = None
+
+    for block in iter_log_spectrogram_blocks(chunks, sample_rate, frame_size, hop_size, block_frames):
+        block_max = float(np.max(block))
+        result = block_max if result is None else max(result, block_max)
+
+    return result
+
+
+def iter_audio_hash_blocks(chunks, sample_rate: int, threshold_db: float, frame_size=2048, hop_size=512,
+                           size_window=3, neighborhood_size=20, time_window=50, freq_window=20, fan_out=None,
+                           block_frames=1024, hash_format=DEFAULT_HASH_FORMAT):
+    """
+    Потоковое формирование хэшей: аудиоданные принимаются частями, хэши выдаются блоками по мере готовности.
+
+    В памяти хранятся только необработанный хвост сигнала, часть спектрограммы с полями для фильтров
+    максимумов и пики из временного окна target-зоны, поэтому объем памяти зависит от размера части,
+    а не от длительности записи. Пики и пары (в том числе на границах частей) совпадают с результатом
+    create_audio_hashes с тем же порогом threshold_db.
+
+    Время опорных точек выдается в фреймах: перевод в миллисекунды (anchor_times_ms) зависит от первой
+    и последней опорных точек всей записи (см. create_audio_hashes_streaming).
+
+    :param chunks: итерируемый объект с частями аудиоданных (numpy массивы, для стерео берется первый канал).
+    :param sample_rate: Частота дискретизации аудиоданных.
+    :param threshold_db: абсолютный порог для пиков (дБ).
+    :param block_frames: минимальное количество новых фреймов, после которого выполняется поиск пиков.
+    :param hash_format: формат хэшей (см. generate_hashes).
+
+    :return: генератор кортежей (хэши блока, время опорных точек в фреймах); хэши - массив int64
+        для HASH_FORMAT_PACKED или список строк для HASH_FORMAT_SHA256.
+    """
+
+    # Запас фреймов с каждой стороны, от которых зависит результат поиска пиков
+    margin = size_window + neighborhood_size
+
+    spectrogram = None                  # часть спектрограммы, начиная с фрейма spectrogram_start
+    spectrogram_start = 0
+    peaks_done = 0                      # пики найдены для фреймов < peaks_done
+    anchors_done = 0                    # пары сформированы для якорей с временем < anchors_done
+    peaks = np.empty((0, 2), dtype=np.int64)
+
+    def emit(final: bool):
+        nonlocal spectrogram, spectrogram_start, peaks_done, anchors_done, peaks
+
+        spectrogram_end = spectrogram_start + spectrogram.shape[0]
+        new_done = spectrogram_end if final else spectrogram_end - margin
+
+        if new_done - peaks_done < (1 if final else block_frames):
+            return
+
+        lo = max(peaks_done - margin, 0)
+        with metrics.stage('peak_picking'):
+            times, freqs = pick_peaks(spectrogram[lo - spectrogram_start:], neighborhood_size=neighborhood_size,
+                                      size_window=size_window, threshold_db=threshold_db)
+        times += lo
+
+        ready = (times >= peaks_done) & (times < new_done)
+        peaks = np.concatenate([peaks, np.column_stack((times[ready], freqs[ready]))])
+        metrics.count('peaks', int(ready.sum()))
+
+        peaks_done = new_done
+        keep_from = peaks_done - margin - spectrogram_start
+        if keep_from > 0:
+            spectrogram = spectrogram[keep_from:]
+            spectrogram_start += keep_from
+
+        # Якорь готов, если все фреймы его target-зоны уже обработаны
+        anchors_limit = peaks_done if final else peaks_done - time_window
+        if anchors_limit <= anchors_done or peaks.shape[0] == 0:
+            return
+
+        with metrics.stage('pairing'):
+            times_a, freqs_a, times_b, freqs_b = make_pairs(peaks, time_window=time_window, freq_window=freq_window,
+                                                            fan_out=fan_out)
+        ready = (times_a >= anchors_done) & (times_a < anchors_limit)
+        times_a = times_a[ready]
+        delta_times = times_b[ready] - times_a
+
+        with metrics.stage('hashing'):
+            if hash_format == HASH_FORMAT_PACKED:
+                block_hashes = pack_hashes(freqs_a[ready], freqs_b[ready], delta_times)
+            else:
+                block_hashes = [hash_pair(freq_a, freq_b, delta_time)
+                                for freq_a, freq_b, delta_time in zip(freqs_a[ready].tolist(),
+                                                                      freqs_b[ready].tolist(),
+                                                                      delta_times.tolist())]
+        metrics.count('pairs', len(block_hashes))
+
+        yield block_hashes, times_a
+
+        anchors_done = anchors_limit
+        peaks = peaks[peaks[:, 0] >= anchors_done]
+
+    for block in iter_log_spectrogram_blocks(chunks, sample_rate, frame_size, hop_size, block_frames):
+        spectrogram = block if spectrogram is None else np.concatenate([spectrogram, block])
+
+        yield from emit(final=False)
+
+    if spectrogram is not None:
+        yield from emit(final=True)
+
+
+def create_audio_hashes_streaming(open_chunks, sample_rate: int, frame_size=2048, hop_size=512, size_window=3,
+                                  threshold_ratio=0.8, neighborhood_size=20, time_window=50, freq_window=20,
+                                  threshold_db=None, fan_out=None, hash_format=DEFAULT_HASH_FORMAT,
+                                  block_frames=1024) -> tuple[list[tuple[int | str, int]], float]:
+    """
+    Формирует те же хэши, что и create_audio_hashes, не держа в памяти ни сигнал, ни спектрограмму целиком:
+    хранятся только готовые хэши (для HASH_FORMAT_PACKED - 16 байт на хэш).
+
+    Порог пиков зависит от максимума спектрограммы всей записи, поэтому без threshold_db сигнал читается
+    дважды: первый проход вычисляет только максимум (spectrogram_max). Время опорных точек переводится
+    в миллисекунды после второго прохода, когда известны длительность и последняя опорная точка.
+
+    :param open_chunks: функция без аргументов, возвращающая новый итератор частей аудиоданных
+        (например, partial(iter_pcm_from_video_source, path)).
+    :param sample_rate: Частота дискретизации аудиоданных.
+    :param block_frames: количество фреймов, обрабатываемых за один раз (см. iter_audio_hash_blocks).
+
+    :return result_hashes: список (хэш, время якорной точки в миллисекундах), как у create_audio_hashes.
+    :return duration: длительность аудиозаписи в секундах.
+    """
+    samples_count = 0
+
+    def counted(chunks):
+        nonlocal samples_count
+        samples_count = 0
+
+        for chunk in chunks:
+            samples_count += chunk.shape[0]
+            yield chunk
+
+    if threshold_db is None:
+        max_db = spectrogram_max(counted(open_chunks()), sample_rate, frame_size, hop_size, block_frames)
+        if max_db is None:
+            return [], samples_count / sample_rate
+
+        # Как в pick_peaks: после первого фильтра отброшенные точки равны нулю
+        threshold_db = threshold_ratio * max(max_db, 0)
+
+    hashes_list = []
+    times_list = []
+    for block_hashes, times_a in iter_audio_hash_blocks(counted(open_chunks()), sample_rate, threshold_db,
+                                                        frame_size=frame_size, hop_size=hop_size,
+                                                        size_window=size_window, neighborhood_size=neighborhood_size,
+                                                        time_window=time_window, freq_window=freq_window,
+                                                        fan_out=fan_out, block_frames=block_frames,
+                                                        hash_format=hash_format):
+        hashes_list.append(block_hashes)
+        times_list.append(times_a)
+
+    duration = samples_count / sample_rate
+    times_a = np.concatenate(times_list) if times_list else np.empty(0, dtype=np.int64)
+    if len(times_a) == 0:
+        return [], duration
+
+    times_ms = anchor_times_ms(times_a, int(duration * 1000))
+
+    if hash_format == HASH_FORMAT_PACKED:
+        hashes = np.concatenate(hashes_list).tolist()
+    else:
+        hashes = [hash_value for block_hashes in hashes_list for hash_value in block_hashes]
+    metrics.count('hashes', len(hashes))
+
+    return list(zip(hashes, times_ms.tolist())), duration
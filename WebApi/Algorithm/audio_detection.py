@@ -1,65 +1,17 @@
+import os
+import asyncio
 from collections import defaultdict
-from bisect import bisect_left
+import numpy as np
+from Algorithm.async_db_service import AsyncDBService
+from Algorithm.audio_hash_index import SnapshotLookup
 from Algorithm.db_service import DBService
-from Algorithm.default_logger import logger
+from Algorithm.interval_set import IntervalSet, is_sorted_runs, merge_sorted_runs
+from Algorithm.metrics import metrics
 
-
-def merge_sequence(duration_list: list[tuple[int, int, int]], value: tuple[int, int, int], idx_start: int, idx_end: int):
-    """
-    Выполняет соединение последовательности с новым элементом (если есть пересечение). 
-
-    :param duration_list: список-кортежей (начало совпадения из БД, конец совпадения из БД, смещение для определения локального времени).
-    :param value: кортеж, который необходимо соединить с некоторой последовательностью.
-    :param idx_start: индекс начала последовательности.
-    :param idx_end: индекс конца последовательности.
-    """
-     
-    left_value = min(duration_list[idx_start][0], value[0])
-    right_value = max(duration_list[idx_end - 1][1], value[1])
-
-    duration = duration_list[idx_end - 1][2]
-    if duration_list[idx_end - 1][1] - duration_list[idx_start][0] < value[1] - value[0]:
-        duration = value[2]
-
-    duration_list[idx_start] = (left_value, right_value, duration)
-
-    if idx_end > idx_start + 1:
-        del duration_list[idx_start + 1:idx_end]
-
-
-def add_duration(duration_list: list[tuple[int, int, int]], value: tuple[int, int, int], max_distance=1):
-    """
-    Выполняет добавление нового промежутка (value) в список промежутков, которые не пересекаются, а также,
-    расстояние между границами, больше чем max_distance. После добавления нового промежутка свойства списка сохрананяются.
-    
-    :param duration_list: список промежутков, представлен в виде списка-кортежей, где элементы:
-        начало совпадения из БД, конец совпадения из БД, смещение для определения локального времени.
-    :param value: промежуток в виде кортежа для добавления в список.
-    :param max_distance: максимальное расстояние между границами для выполнения их объединения (в секундах).
-    """
-
-    if not duration_list:
-        duration_list.append(value)
-        return
-
-    idx_start = bisect_left(duration_list, value[0], key=lambda item: item[0])
-    idx_end = bisect_left(duration_list, value[1], lo=idx_start, key=lambda item: item[1])
-
-    if idx_start > 0 and value[0] - duration_list[idx_start - 1][1] <= max_distance:
-        idx_start -= 1
-    if idx_end < len(duration_list) and duration_list[idx_end][0] - value[1] <= max_distance:
-        idx_end += 1
-
-    if idx_start == idx_end:
-        duration_list.insert(idx_start, value)
-    else:
-        merge_sequence(duration_list, value, idx_start, idx_end)
-
-    if idx_start > 0 and duration_list[idx_start][0] - duration_list[idx_start - 1][1] <= max_distance:
-        merge_sequence(duration_list, duration_list[idx_start], idx_start - 1, idx_start + 1)
-    if idx_start < len(duration_list) - 1 and duration_list[idx_start + 1][0] - duration_list[idx_start][1]\
-            <= max_distance:
-        merge_sequence(duration_list, duration_list[idx_start], idx_start, idx_start + 2)
+# Хеши, которые встречаются в каталоге чаще (количество снимков), не используются для поиска (0 - без ограничения)
+MAX_HASH_FREQUENCY = int(os.environ.get('AUDIO_MAX_HASH_FREQUENCY', 0))
+# Количество контентов с наибольшим числом совпадений с одним смещением, для которых ищутся промежутки (0 - все)
+TOP_K_CONTENTS = int(os.environ.get('AUDIO_TOP_K_CONTENTS', 0))
 
 
 def find_durations(dict_audio: dict[list[tuple[int, int]]], max_diff_s=1, min_duration_s=10)\
@@ -67,9 +19,8 @@ def find_durations(dict_audio: dict[list[tuple[int, int]]], max_diff_s=1, min_du
     """
     Выполняет поиск промежутков совпадения.
     Идея: ранжировать время по разности локального и удаленного времени.
-    Ранжирование происходит в словаре data_duration.
-    Ключ это разность локального и удаленного времени, а значение это список удаленных времен.
-    Тогда для каждого ключа есть список, где времена совпадения в порядке возрастения в МС.
+    Ранжирование происходит по ключу (id контента, разность локального и удаленного времени в секундах),
+    для каждого ключа времена совпадения из БД идут в порядке их появления в МС.
     В таком случае необходимо найти все подпоследовательности, где разность не больше max_diff_s
     и выполнить их объединения с другими промежутками, если их разность соседних границ не больше max_diff_s.
     Итоговые последовательности должны быть не меньше min_duration_s.
@@ -82,85 +33,317 @@ def find_durations(dict_audio: dict[list[tuple[int, int]]], max_diff_s=1, min_du
         кортежа: начало совпадения из БД, конец совпадения из БД, смещение для определения локального времени.
     """
 
+    counts = [len(values) for values in dict_audio.values()]
+    hits = np.concatenate([np.array(values, dtype=np.int64).reshape(-1, 2) for values in dict_audio.values()]
+                          + [np.empty((0, 2), dtype=np.int64)])
+
+    return find_durations_arrays(np.repeat(np.array(list(dict_audio.keys()), dtype=np.int64), counts),
+                                 hits[:, 0], hits[:, 1], max_diff_s, min_duration_s)
+
+
+def concatenate_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    Индексы start, start + 1, ..., start + length - 1 для всех промежутков подряд.
+    """
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(int(lengths.sum()))
+
+
+def group_bounds(groups: np.ndarray) -> list[tuple[int, int]]:
+    """
+    Границы [начало, конец) подряд идущих одинаковых значений.
+    """
+    firsts = np.flatnonzero(np.r_[True, np.diff(groups) != 0]) if len(groups) else np.empty(0, dtype=np.int64)
+    return list(zip(firsts.tolist(), np.r_[firsts[1:], len(groups)].tolist()))
+
+
+def find_durations_arrays(id_contents: np.ndarray, db_times: np.ndarray, local_times: np.ndarray, max_diff_s=1,
+                          min_duration_s=10) -> dict[int, list[tuple[int, int, int]]]:
+    """
+    То же, что и 'find_durations', для совпадений в виде массивов (порядок совпадений как в списках словаря).
+    Группировка по (id контента, смещение), поиск подпоследовательностей и их границ выполняются numpy,
+    объединение промежутков - только для найденных подпоследовательностей.
+
+    :param id_contents: id контента для каждого совпадения.
+    :param db_times: время из БД (в МС).
+    :param local_times: время локального аудиофрагмента (в МС).
+    """
+
     result_dict = defaultdict(list[tuple[int, int, int]])
 
-    for id_content, values in dict_audio.items():
+    id_contents = np.asarray(id_contents, dtype=np.int64)
+    db_times = np.asarray(db_times, dtype=np.int64)
+    count = len(db_times)
+    if count == 0:
+        return result_dict
 
-        duration_list = []
-        data_duration = defaultdict(list)
+    offsets = np.floor_divide(np.asarray(local_times, dtype=np.int64) - db_times, 1000)
 
-        # Ранжируем по разности time2 и time1
-        for time1, time2 in values:
-            diff = int((time2 - time1) // 1000)
-            data_duration[diff].append(time1)
+    # Контенты в порядке первого совпадения
+    _, content_first, content_inverse = np.unique(id_contents, return_index=True, return_inverse=True)
+    content_rank = np.argsort(np.argsort(content_first))[content_inverse.reshape(-1)]
 
-        for diff_local, times in data_duration.items():
+    # Группы (контент, смещение); внутри группы совпадения остаются в исходном порядке
+    order = np.lexsort((offsets, content_rank))
+    group_starts = np.flatnonzero(np.r_[True, (np.diff(content_rank[order]) != 0) | (np.diff(offsets[order]) != 0)])
+    group_lengths = np.diff(np.r_[group_starts, count])
 
-            duration_list_local = []
+    # Группы контента в порядке первого совпадения смещения
+    group_order = np.lexsort((order[group_starts], content_rank[order[group_starts]]))
+    group_starts, group_lengths = group_starts[group_order], group_lengths[group_order]
+    hit_order = order[concatenate_ranges(group_starts, group_lengths)]
 
-            if len(times) < 2:
-                continue
+    times = db_times[hit_order]
+    groups = np.repeat(np.arange(len(group_starts)), group_lengths)
 
-            logger.debug(f'count: {len(times)}\n{diff_local}: {times}')
-            
-            count = 0
-            i = 0
-            while i < len(times):
-                j = i
-                while j < len(times) - 1:
-                    if (times[j + 1] - times[j]) // 1000 > max_diff_s:
-                        break
-                    j += 1
-                    
-                if j - i > 2:
-                    
-                    new_diff_local = int(diff_local)
-                    if times[i] // 1000 + int(diff_local) < 0:
-                        new_diff_local += 1
-                    
-                    add_duration(duration_list_local, (times[i] // 1000, times[j] // 1000, new_diff_local),
-                                 max_diff_s)
-                    count += j - i
-
-                i = j + 1
-
-            for tuple_value in duration_list_local:
-                if tuple_value[1] - tuple_value[0] >= min_duration_s:
-                    add_duration(duration_list, tuple_value, 5)
-
-        if duration_list:
-            result_dict[str(id_content)] = duration_list
+    # Подпоследовательности: разрыв при смене группы или если соседние времена дальше max_diff_s
+    breaks = (np.diff(groups) != 0) | (np.floor_divide(np.diff(times), 1000) > max_diff_s)
+    run_starts = np.flatnonzero(np.r_[True, breaks])
+    run_ends = np.r_[run_starts[1:], count] - 1
+
+    long_runs = run_ends - run_starts > 2
+    run_starts, run_ends = run_starts[long_runs], run_ends[long_runs]
+
+    starts_s = np.floor_divide(times[run_starts], 1000)
+    ends_s = np.floor_divide(times[run_ends], 1000)
+    run_offsets = offsets[hit_order[run_starts]]
+    run_offsets = run_offsets + (starts_s + run_offsets < 0)
+
+    run_groups = groups[run_starts]
+    run_contents = id_contents[hit_order[run_starts]]
+
+    # Объединение промежутков внутри группы: для упорядоченных времен - сразу для всех групп
+    if max_diff_s >= 0 and is_sorted_runs(starts_s, ends_s, run_groups):
+        local_groups, local_starts, local_ends, local_offsets = merge_sorted_runs(starts_s, ends_s, run_offsets,
+                                                                                  max_diff_s, run_groups)
+    else:
+        local = []
+        for group_first, group_last in group_bounds(run_groups):
+            interval_set = IntervalSet(max_diff_s)
+            interval_set.update(zip(starts_s[group_first:group_last].tolist(), ends_s[group_first:group_last].tolist(),
+                                    run_offsets[group_first:group_last].tolist()))
+            local.extend((run_groups[group_first], *interval) for interval in interval_set)
+
+        local_groups, local_starts, local_ends, local_offsets = np.array(local, dtype=np.int64).reshape(-1, 4).T
+
+    # Длинные промежутки групп добавляются в список контента
+    long_local = local_ends - local_starts >= min_duration_s
+    local_contents = run_contents[np.searchsorted(run_groups, local_groups)][long_local]
+    local_intervals = list(zip(local_starts[long_local].tolist(), local_ends[long_local].tolist(),
+                               local_offsets[long_local].tolist()))
+
+    for content_first, content_last in group_bounds(local_contents):
+        interval_set = IntervalSet(5)
+        interval_set.update(local_intervals[content_first:content_last])
+        result_dict[str(local_contents[content_first])] = interval_set.to_list()
 
     return result_dict
 
 
-def detect_audio(hashes_: list[tuple[str, int]], duration_audio, db_service_: DBService, max_diff_s=3, min_duration_s=10) -> dict[int, list[tuple[int, int, int]]]:
+def detect_audio(hashes_: list[tuple[str, int]], duration_audio, db_service_: DBService, max_diff_s=3, min_duration_s=10,
+                 max_hash_frequency=MAX_HASH_FREQUENCY, top_k=TOP_K_CONTENTS, match_info: dict = None)\
+        -> dict[int, list[tuple[int, int, int]]]:
     """
     Определение совпадений аудио фрагмента из БД
     
     :param hashes_: хеши аудио фрагмента для поиска совпадений из БД.
     :param duration_audio: длительность аудио фрагмента (в секундах).
-    :param db_service_: объект сервиса БД
+    :param db_service_: объект сервиса БД или индекс хешей в памяти ('AudioHashIndex')
     :param max_diff_s: максимальное расстояние между границами для выполнения их объединения (в секундах).
     :param min_duration_s: длительность минимального промежука совпадения (в секундах).
+    :param max_hash_frequency: хеши, у которых в каталоге больше снимков, не ищутся (0 - без ограничения).
+    :param top_k: промежутки ищутся только для top_k контентов с наибольшим числом совпадений
+        с одним смещением (0 - для всех).
+    :param match_info: словарь, в который записываются примененные ограничения и их результат (см. 'make_match_info').
     
     :result: промежутки совпадения в виде словаря, где ключ - id контента, а значение - список совпадений в виде
         кортежа: начало совпадения из БД, конец совпадения из БД, смещение для определения локального времени.
     """
 
-    result_hashes = db_service_.get_audio_snapshots_by_hashes([values[0] for values in hashes_])
+    hash_table = make_hash_table(hashes_)
+    info = make_match_info(hash_table, max_hash_frequency, top_k)
+
+    if max_hash_frequency:
+        with metrics.stage('hash_frequencies'):
+            frequencies = db_service_.get_hash_frequencies(hash_table[0])
+        hash_table = drop_stop_hashes(hash_table, frequencies, max_hash_frequency, info)
+
+    # Совпадения в виде массивов; строки из БД читаются пачками, индекс в памяти возвращает массивы сразу
+    # Ошибки поиска (БД, индекс, недоступный шард) не скрываются: иначе сбой выглядел бы как отсутствие совпадений
+    parts = []
+    with metrics.stage('db_query'):
+        if isinstance(db_service_, SnapshotLookup):
+            parts.append(db_service_.lookup(hash_table[0]))
+        else:
+            for rows in db_service_.iter_audio_snapshots_by_hashes(hash_table[0].tolist()):
+                parts.append(rows_to_arrays(rows))
+    hits = make_hits(hash_table, parts)
+    metrics.count('db_rows', len(hits[0]))
+
+    hits = select_top_contents(hits, top_k, info)
+    if match_info is not None:
+        match_info.update(info)
+
+    return match_durations(hits, duration_audio, max_diff_s, min_duration_s)
+
+
+async def detect_audio_async(hashes_: list[tuple[str, int]], duration_audio, db_service_: AsyncDBService, max_diff_s=3,
+                             min_duration_s=10, max_hash_frequency=MAX_HASH_FREQUENCY, top_k=TOP_K_CONTENTS,
+                             match_info: dict = None) -> dict[int, list[tuple[int, int, int]]]:
+    """
+    То же, что и 'detect_audio', для асинхронного сервиса БД: запрос к БД не блокирует цикл событий,
+    поиск промежутков выполняется в отдельном потоке.
+    """
+
+    hash_table = make_hash_table(hashes_)
+    info = make_match_info(hash_table, max_hash_frequency, top_k)
+
+    if max_hash_frequency:
+        with metrics.stage('hash_frequencies'):
+            frequencies = await db_service_.get_hash_frequencies(hash_table[0])
+        hash_table = drop_stop_hashes(hash_table, frequencies, max_hash_frequency, info)
 
-    # Для быстрого поиска по хешу
-    hash_table = defaultdict(int)
-    for hash_value, timestamp in hashes_:
-        hash_table[hash_value] = timestamp
+    parts = []
+    with metrics.stage('db_query'):
+        async for rows in db_service_.iter_audio_snapshots_by_hashes(hash_table[0].tolist()):
+            parts.append(rows_to_arrays(rows))
+    hits = make_hits(hash_table, parts)
+    metrics.count('db_rows', len(hits[0]))
 
-    # Ранжируем по id_content
-    dict_audio = defaultdict(list)
-    for id_content, timestamp, hash_value in result_hashes:
-        dict_audio[id_content].append((timestamp, hash_table[hash_value]))
+    hits = await asyncio.to_thread(select_top_contents, hits, top_k, info)
+    if match_info is not None:
+        match_info.update(info)
+
+    return await asyncio.to_thread(match_durations, hits, duration_audio, max_diff_s, min_duration_s)
+
+
+def make_hash_table(hashes_: list[tuple[str, int]]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Таблица для быстрого поиска локального времени по хешу: отсортированные хеши и их локальное время
+    (для повторяющегося хеша - время последнего вхождения).
+    """
+    hashes = np.array([hash_value for hash_value, _ in hashes_])
+    timestamps = np.array([timestamp for _, timestamp in hashes_], dtype=np.int64)
+
+    keys, last = np.unique(hashes[::-1], return_index=True)
+
+    return keys, timestamps[::-1][last]
+
+
+def make_match_info(hash_table: tuple[np.ndarray, np.ndarray], max_hash_frequency: int, top_k: int) -> dict:
+    """
+    Сведения об ограничениях поиска: 'hashes' - количество хешей фрагмента, 'max_hash_frequency' и 'stop_hashes' -
+    порог частоты и количество отброшенных частых хешей, 'top_k', 'candidates' и 'candidates_kept' - ограничение
+    и количество контентов с совпадениями до и после отбора, 'hits' и 'hits_kept' - количество совпадений
+    до и после отбора.
+    """
+    return {'hashes': len(hash_table[0]), 'max_hash_frequency': max_hash_frequency, 'stop_hashes': 0,
+            'top_k': top_k, 'candidates': 0, 'candidates_kept': 0, 'hits': 0, 'hits_kept': 0}
+
+
+def drop_stop_hashes(hash_table: tuple[np.ndarray, np.ndarray], frequencies: np.ndarray, max_hash_frequency: int,
+                     info: dict) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Убирает из таблицы хешей частые хеши (тишина, заставки, повторяющиеся фрагменты), которые совпадают
+    с большим количеством контентов.
+
+    :param hash_table: таблица из 'make_hash_table'.
+    :param frequencies: количество снимков каждого хеша в каталоге.
+    :param max_hash_frequency: максимальное количество снимков хеша.
+    :param info: сведения об ограничениях (см. 'make_match_info').
+    """
+    keep = np.asarray(frequencies) <= max_hash_frequency
+
+    info['stop_hashes'] = int(len(keep) - np.count_nonzero(keep))
+    metrics.count('stop_hashes', info['stop_hashes'])
+
+    return hash_table[0][keep], hash_table[1][keep]
+
+
+def select_top_contents(hits: tuple[np.ndarray, np.ndarray, np.ndarray], top_k: int, info: dict)\
+        -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Оставляет совпадения top_k контентов с наибольшим числом совпадений с одним смещением (в секундах),
+    как в 'find_durations'; при равенстве - контентов с меньшим id.
+
+    :param hits: совпадения (id контента, время из БД, локальное время).
+    :param top_k: количество контентов (0 - все).
+    :param info: сведения об ограничениях (см. 'make_match_info').
+    """
+    id_contents, db_times, local_times = hits
+    contents = np.unique(id_contents)
+
+    info['hits'] = info['hits_kept'] = len(id_contents)
+    info['candidates'] = info['candidates_kept'] = len(contents)
+
+    if not top_k or len(contents) <= top_k:
+        return hits
+
+    # Голоса: количество совпадений для каждой пары (контент, смещение), у контента - максимум по смещениям
+    offsets = np.floor_divide(local_times - db_times, 1000)
+    order = np.lexsort((offsets, id_contents))
+    sorted_contents, sorted_offsets = id_contents[order], offsets[order]
+
+    starts = np.flatnonzero(np.r_[True, (np.diff(sorted_contents) != 0) | (np.diff(sorted_offsets) != 0)])
+    votes = np.diff(np.r_[starts, len(order)])
+
+    content_index = np.searchsorted(contents, sorted_contents[starts])
+    content_votes = np.zeros(len(contents), dtype=np.int64)
+    np.maximum.at(content_votes, content_index, votes)
+
+    top = contents[np.argsort(-content_votes, kind='stable')[:top_k]]
+    keep = np.isin(id_contents, top)
+
+    info['hits_kept'] = int(np.count_nonzero(keep))
+    info['candidates_kept'] = len(top)
+    metrics.count('candidates_pruned', len(contents) - len(top))
+
+    return id_contents[keep], db_times[keep], local_times[keep]
+
+
+def rows_to_arrays(rows: list[tuple[int, int, str]]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Переводит строки из БД (id_content, timestamp, hash) в массивы столбцов.
+    """
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    id_contents, timestamps, hashes = zip(*rows)
+
+    return np.array(id_contents, dtype=np.int64), np.array(timestamps, dtype=np.int64), np.array(hashes)
+
+
+def make_hits(hash_table: tuple[np.ndarray, np.ndarray], parts: list[tuple[np.ndarray, np.ndarray, np.ndarray]])\
+        -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Собирает совпадения: id контента, время из БД и локальное время (по хешу строки).
+
+    :param hash_table: таблица из 'make_hash_table'.
+    :param parts: массивы строк (id_content, timestamp, hash) в порядке чтения из БД.
+    """
+    parts = [part for part in parts if len(part[0])]
+    if not parts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    id_contents = np.concatenate([part[0] for part in parts])
+    db_times = np.concatenate([part[1] for part in parts])
+    hashes = np.concatenate([part[2] for part in parts])
+
+    keys, local_times = hash_table
+    positions = np.minimum(np.searchsorted(keys, hashes), len(keys) - 1)
+    local_times = np.where(keys[positions] == hashes, local_times[positions], 0)
+
+    return id_contents, db_times, local_times
+
+
+def match_durations(hits: tuple[np.ndarray, np.ndarray, np.ndarray], duration_audio, max_diff_s, min_duration_s)\
+        -> dict[int, list[tuple[int, int, int]]]:
+    """
+    Поиск промежутков совпадения по совпадениям (id контента, время из БД, локальное время)
+    и уточнение границ (см. 'detect_audio').
+    """
 
-    result_dict = find_durations(dict_audio, max_diff_s=max_diff_s, min_duration_s=min_duration_s)
+    with metrics.stage('duration_finding'):
+        result_dict = find_durations_arrays(*hits, max_diff_s=max_diff_s, min_duration_s=min_duration_s)
      
     for id_content, values in result_dict.items():
         if values[0][0] <= 5:
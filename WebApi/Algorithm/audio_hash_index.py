@@ -0,0 +1,516 @@
+import os
+import json
+import uuid
+import argparse
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+import numpy as np
+
+from Algorithm.default_logger import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Services keep the index up to date only when the directory is configured (see 'open_hash_index')
+HASH_INDEX_DIRECTORY = os.environ.get('AUDIO_HASH_INDEX')
+DEFAULT_INDEX_DIRECTORY = HASH_INDEX_DIRECTORY or os.path.join(tempfile.gettempdir(), 'audio_hash_index')
+
+MANIFEST_FILE = 'manifest.json'
+# Reloads of a manifest whose segments were merged away meanwhile, before 'refresh' gives up
+REFRESH_ATTEMPTS = 5
+LOCK_FILE = 'index.lock'
+
+# Small segments written by incremental updates are merged when there are more segments than this
+MAX_SEGMENTS = 16
+# Rows returned by 'iter_audio_snapshots_by_hashes' at a time
+INDEX_BATCH_ROWS = 50000
+
+POSTING_DTYPE = np.dtype([('id_content', '<i4'), ('timestamp', '<i4')])
+
+
+def sort_rows(rows: tuple[np.ndarray, np.ndarray, np.ndarray]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Orders rows (id_content, timestamp, hash) by content and time, as 'find_durations' expects.
+    """
+    order = np.lexsort((rows[1], rows[0]))
+    return tuple(column[order] for column in rows)
+
+
+def concatenate_rows(parts: list[tuple[np.ndarray, np.ndarray, np.ndarray]])\
+        -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Concatenates row arrays (id_content, timestamp, hash) of several segments.
+    """
+    if not parts:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64)
+
+    return tuple(np.concatenate([part[idx] for part in parts]) for idx in range(3))
+
+
+class Segment:
+    """
+    Immutable part of the index: sorted unique hashes ('keys'), posting list boundaries ('offsets', one more
+    than keys) and postings (id_content, timestamp) of all keys in order. Arrays are memory-mapped read-only,
+    so processes that open the same index share the pages.
+    """
+
+    def __init__(self, keys: np.ndarray, offsets: np.ndarray, postings: np.ndarray, name=None):
+        self.keys = keys
+        self.offsets = offsets
+        self.postings = postings
+        self.name = name
+
+    @classmethod
+    def from_rows(cls, id_contents: np.ndarray, timestamps: np.ndarray, hashes: np.ndarray):
+        """
+        Builds a segment from snapshot rows.
+        """
+        hashes = np.asarray(hashes, dtype=np.int64)
+        order = np.argsort(hashes, kind='stable')
+        sorted_hashes = hashes[order]
+
+        keys, starts = np.unique(sorted_hashes, return_index=True)
+        offsets = np.append(starts, len(sorted_hashes)).astype(np.int64)
+
+        postings = np.empty(len(hashes), dtype=POSTING_DTYPE)
+        postings['id_content'] = np.broadcast_to(np.asarray(id_contents, dtype=np.int32), hashes.shape)[order]
+        postings['timestamp'] = np.asarray(timestamps, dtype=np.int32)[order]
+
+        return cls(keys, offsets, postings)
+
+    @classmethod
+    def load(cls, directory: str, name: str):
+        arrays = [np.load(os.path.join(directory, f'{name}.{part}.npy'), mmap_mode='r')
+                  for part in ('keys', 'offsets', 'postings')]
+
+        return cls(*arrays, name=name)
+
+    def save(self, directory: str, name: str):
+        for part, array in (('keys', self.keys), ('offsets', self.offsets), ('postings', self.postings)):
+            path = os.path.join(directory, f'{name}.{part}.npy')
+            temp_path = f'{path}.tmp'
+            with open(temp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(temp_path, path)
+
+        self.name = name
+
+    def remove_files(self, directory: str):
+        for part in ('keys', 'offsets', 'postings'):
+            try:
+                os.remove(os.path.join(directory, f'{self.name}.{part}.npy'))
+            except OSError:
+                pass
+
+    def lookup(self, query: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds postings of the hashes.
+
+        :param query: sorted unique hashes (int64).
+        :return: arrays (id_content, timestamp, hash) of matched postings.
+        """
+        positions = np.searchsorted(self.keys, query)
+        positions_clipped = np.minimum(positions, len(self.keys) - 1)
+        found = (positions < len(self.keys)) & (np.asarray(self.keys)[positions_clipped] == query)
+
+        positions = positions[found]
+        starts = np.asarray(self.offsets[positions])
+        lengths = np.asarray(self.offsets[positions + 1]) - starts
+
+        # Indices of all postings of the matched keys: start + 0..length-1 for every key
+        total = int(lengths.sum())
+        indices = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+
+        postings = self.postings[indices]
+
+        return postings['id_content'], postings['timestamp'], np.repeat(query[found], lengths)
+
+    def frequencies(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        :return: numbers of postings of the hashes (0 for unknown hashes).
+        """
+        frequencies = np.zeros(len(hashes), dtype=np.int64)
+        if len(self.keys) == 0:
+            return frequencies
+
+        positions = np.searchsorted(self.keys, hashes)
+        positions_clipped = np.minimum(positions, len(self.keys) - 1)
+        found = (positions < len(self.keys)) & (np.asarray(self.keys)[positions_clipped] == hashes)
+
+        positions = positions[found]
+        frequencies[found] = np.asarray(self.offsets[positions + 1]) - np.asarray(self.offsets[positions])
+
+        return frequencies
+
+    def range_rows(self, lo=None, hi=None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :param lo: smallest hash (None - no limit).
+        :param hi: hash after the largest one (None - no limit).
+        :return: rows (id_content, timestamp, hash) with lo <= hash < hi.
+        """
+        start = 0 if lo is None else int(np.searchsorted(self.keys, lo))
+        end = len(self.keys) if hi is None else int(np.searchsorted(self.keys, hi))
+        end = max(start, end)
+
+        postings = self.postings[self.offsets[start]:self.offsets[end]]
+        hashes = np.repeat(np.asarray(self.keys[start:end]), np.diff(self.offsets[start:end + 1]))
+
+        return postings['id_content'], postings['timestamp'], hashes
+
+    def __len__(self):
+        return len(self.postings)
+
+
+class SnapshotLookup(ABC):
+    """
+    'DBService'-compatible snapshot search on top of 'lookup' (arrays id_content, timestamp, hash).
+    """
+
+    @abstractmethod
+    def lookup(self, hashes) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :param hashes: packed hashes (int64).
+        :return: arrays (id_content, timestamp, hash), ordered by content and time.
+        """
+
+    def iter_audio_snapshots_by_hashes(self, hashes, batch_size=INDEX_BATCH_ROWS):
+        """
+        Same as 'DBService.iter_audio_snapshots_by_hashes'.
+
+        :return: iterator over lists of elements (‘id_content’, ‘timestamp’, ‘hash’).
+        """
+        id_contents, timestamps, found = self.lookup(hashes)
+
+        for start in range(0, len(found), batch_size):
+            end = start + batch_size
+            yield list(zip(id_contents[start:end].tolist(), timestamps[start:end].tolist(), found[start:end].tolist()))
+
+    def get_audio_snapshots_by_hashes(self, hashes) -> list[tuple[int, int, int]]:
+        """
+        Same as 'DBService.get_audio_snapshots_by_hashes'.
+        """
+        data = []
+        for rows in self.iter_audio_snapshots_by_hashes(hashes):
+            data.extend(rows)
+
+        return data
+
+
+class AudioHashIndex(SnapshotLookup):
+    """
+    Inverted index of packed audio hashes (hash -> postings (id_content, timestamp)), an in-process
+    replacement for 'snapshot_audio' lookups. The index is a set of immutable memory-mapped segments
+    listed in a manifest; updates add a segment, deleted contents are filtered out until compaction.
+
+    Implements 'iter_audio_snapshots_by_hashes' and 'get_audio_snapshots_by_hashes' like 'DBService',
+    so it can be passed to 'detect_audio' instead of the database service.
+    """
+
+    def __init__(self, directory=DEFAULT_INDEX_DIRECTORY):
+        """
+        :param directory: index directory (created if it does not exist).
+        """
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.segments = []
+        self.deleted = np.empty(0, dtype=np.int32)
+        self.manifest_version = None
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.refresh()
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Serializes index updates between threads and processes.
+        """
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+
+            with open(os.path.join(self.directory, LOCK_FILE), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, MANIFEST_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'segments': [], 'deleted': []}
+
+    def write_manifest(self, segments: list[str], deleted):
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+
+        with open(temp_path, 'w') as f:
+            json.dump({'segments': segments, 'deleted': sorted(int(id) for id in deleted)}, f)
+        os.replace(temp_path, path)
+
+    def refresh(self) -> bool:
+        """
+        Reloads the manifest if another process changed the index.
+
+        :return: boolean value that tells whether the index was reloaded.
+        :raises RuntimeError: if the segments kept disappearing for REFRESH_ATTEMPTS reloads.
+        """
+        path = os.path.join(self.directory, MANIFEST_FILE)
+
+        with self.lock:
+            for _ in range(REFRESH_ATTEMPTS):
+                try:
+                    # The manifest is replaced on every change, so a new inode means a new version
+                    stat = os.stat(path)
+                    version = (stat.st_ino, stat.st_mtime_ns)
+                except FileNotFoundError:
+                    version = None
+
+                if version == self.manifest_version:
+                    return False
+
+                manifest = self.read_manifest()
+                loaded = {segment.name: segment for segment in self.segments}
+
+                try:
+                    segments = [loaded.get(name) or Segment.load(self.directory, name)
+                                for name in manifest['segments']]
+                except FileNotFoundError:
+                    # Segments were merged by another process after the manifest was read
+                    continue
+
+                self.segments = segments
+                self.deleted = np.array(manifest['deleted'], dtype=np.int32)
+                self.manifest_version = version
+
+                return True
+
+        raise RuntimeError(f'index {self.directory}: segments changed during {REFRESH_ATTEMPTS} reloads')
+
+    def new_segment_name(self) -> str:
+        return f'segment-{uuid.uuid4().hex}'
+
+    def add(self, id_content, hashes: np.ndarray, timestamps: np.ndarray, replace=False):
+        """
+        Adds snapshots (incremental update): a new segment is written and small segments are merged
+        when there are too many of them.
+
+        :param id_content: id content (one value for all rows or an array, same length as 'hashes').
+        :param hashes: packed hashes (int64).
+        :param timestamps: snapshot times, same length as 'hashes'.
+        :param replace: replace the snapshots of the contents already in the index.
+        """
+        ids = np.unique(np.asarray(id_content, dtype=np.int32))
+
+        if len(hashes) == 0 and not replace:
+            return
+
+        segment = Segment.from_rows(id_content, timestamps, hashes)
+
+        with self.exclusive():
+            self.refresh()
+
+            segments, removed = list(self.segments), []
+            # The id is reused only if the content is added again after deletion: the hidden old snapshots
+            # are dropped from the segments before the id stops being deleted
+            deleted = np.setdiff1d(self.deleted, ids)
+            dropped = ids if replace else np.intersect1d(self.deleted, ids)
+
+            if len(dropped):
+                for idx, item in enumerate(segments):
+                    if len(item) and np.isin(item.postings['id_content'], dropped).any():
+                        segments[idx] = self.merge([item], dropped)
+                        removed.append(item)
+
+                removed.extend(item for item in segments if not len(item))
+                segments = [item for item in segments if len(item)]
+
+            if len(segment):
+                segment.save(self.directory, self.new_segment_name())
+                segments.append(segment)
+
+            if len(segments) > MAX_SEGMENTS:
+                # Keep the largest (base) segment, merge the rest
+                base = max(segments, key=len)
+                small = [item for item in segments if item is not base]
+                segments = [base, self.merge(small, deleted)]
+                removed.extend(small)
+
+            self.write_manifest([item.name for item in segments], deleted)
+            self.refresh()
+
+        for item in removed:
+            item.remove_files(self.directory)
+
+    def remove_content(self, id_content: int):
+        """
+        Hides snapshots of the content; they are dropped from the files by 'compact'.
+        """
+        with self.exclusive():
+            self.refresh()
+            self.write_manifest([segment.name for segment in self.segments], np.union1d(self.deleted, [id_content]))
+            self.refresh()
+
+    def merge(self, segments: list[Segment], deleted: np.ndarray, lo=None, hi=None) -> Segment:
+        """
+        Writes the rows of the segments as one segment, without deleted contents and hashes outside [lo, hi).
+        """
+        id_contents, timestamps, hashes = concatenate_rows([segment.range_rows(lo, hi) for segment in segments])
+
+        keep = ~np.isin(id_contents, deleted)
+        merged = Segment.from_rows(id_contents[keep], timestamps[keep], hashes[keep])
+        merged.save(self.directory, self.new_segment_name())
+
+        return merged
+
+    def compact(self, lo=None, hi=None):
+        """
+        Merges all segments into one and drops deleted contents.
+
+        :param lo: if set, hashes less than 'lo' are dropped too.
+        :param hi: if set, hashes from 'hi' are dropped too.
+        """
+        with self.exclusive():
+            self.refresh()
+            old_segments = self.segments
+
+            merged = self.merge(old_segments, self.deleted, lo, hi)
+            self.write_manifest([merged.name], [])
+            self.refresh()
+
+        for segment in old_segments:
+            segment.remove_files(self.directory)
+
+    def rebuild(self, batches):
+        """
+        Replaces the index with the given rows (for example, all rows of 'snapshot_audio').
+
+        :param batches: iterable of lists of tuples (id_content, timestamp, hash) or arrays with these columns.
+        """
+        chunks = []
+        for rows in batches:
+            if len(rows):
+                chunks.append(np.array(rows, dtype=np.int64).reshape(-1, 3))
+
+        data = np.concatenate(chunks) if chunks else np.empty((0, 3), dtype=np.int64)
+        segment = Segment.from_rows(data[:, 0], data[:, 1], data[:, 2])
+        del data, chunks
+
+        with self.exclusive():
+            self.refresh()
+            old_segments = self.segments
+
+            segment.save(self.directory, self.new_segment_name())
+            self.write_manifest([segment.name], [])
+            self.refresh()
+
+        for item in old_segments:
+            item.remove_files(self.directory)
+
+    def lookup(self, hashes) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds snapshots of the hashes.
+
+        :param hashes: packed hashes (int64).
+        :return: arrays (id_content, timestamp, hash) of all snapshots with these hashes, ordered by content and time.
+        """
+        query = np.unique(np.asarray(hashes, dtype=np.int64))
+
+        self.refresh()
+
+        with self.lock:
+            segments, deleted = self.segments, self.deleted
+
+        id_contents, timestamps, found = concatenate_rows([segment.lookup(query) for segment in segments
+                                                           if len(segment)])
+
+        if len(deleted):
+            keep = ~np.isin(id_contents, deleted)
+            id_contents, timestamps, found = id_contents[keep], timestamps[keep], found[keep]
+
+        return sort_rows((id_contents, timestamps, found))
+
+    def get_hash_frequencies(self, hashes) -> np.ndarray:
+        """
+        Same as 'DBService.get_hash_frequencies', exact for the index (deleted contents are counted
+        until compaction).
+
+        :param hashes: packed hashes (int64).
+        :return: array of numbers of snapshots, one per hash.
+        """
+        hashes = np.asarray(hashes, dtype=np.int64)
+
+        self.refresh()
+
+        with self.lock:
+            segments = self.segments
+
+        return sum((segment.frequencies(hashes) for segment in segments), np.zeros(len(hashes), dtype=np.int64))
+
+    def range_rows(self, lo=None, hi=None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Reads snapshots with hashes in [lo, hi) (for example, to move them to another shard).
+
+        :param lo: smallest hash (None - no limit).
+        :param hi: hash after the largest one (None - no limit).
+        :return: arrays (id_content, timestamp, hash).
+        """
+        self.refresh()
+
+        with self.lock:
+            segments, deleted = self.segments, self.deleted
+
+        id_contents, timestamps, hashes = concatenate_rows([segment.range_rows(lo, hi) for segment in segments])
+
+        keep = ~np.isin(id_contents, deleted)
+
+        return id_contents[keep], timestamps[keep], hashes[keep]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'segments': len(self.segments), 'postings': sum(len(segment) for segment in self.segments),
+                    'keys': sum(len(segment.keys) for segment in self.segments), 'deleted': len(self.deleted)}
+
+
+def open_hash_index(directory=HASH_INDEX_DIRECTORY):
+    """
+    :return: the configured index: client of the shards ('AUDIO_SHARD_MAP' environment variable, see 'audio_shards'),
+        a local index ('AUDIO_HASH_INDEX' environment variable) or None.
+    """
+    from Algorithm.audio_shards import open_sharded_index
+
+    sharded_index = open_sharded_index()
+    if sharded_index is not None:
+        return sharded_index
+
+    return AudioHashIndex(directory) if directory else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory-mapped inverted index of audio hashes.')
+    parser.add_argument('command', choices=('build', 'compact', 'stats'),
+                        help='build - from snapshot_audio; compact - merge segments; stats - print sizes')
+    parser.add_argument('--directory', default=DEFAULT_INDEX_DIRECTORY, help='index directory')
+    args = parser.parse_args()
+
+    index = AudioHashIndex(args.directory)
+
+    if args.command == 'build':
+        from Algorithm.db_service import DBService
+        from Algorithm.db_utilities import load_config
+
+        db_service = DBService(1, 1, load_config())
+        index.rebuild(db_service.iter_all_audio_snapshots())
+
+    elif args.command == 'compact':
+        index.compact()
+
+    logger.info(f'audio hash index {args.directory}: {index.stats()}')
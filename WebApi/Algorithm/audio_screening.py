@@ -0,0 +1,165 @@
+import os
+import asyncio
+from collections import defaultdict
+
+from Algorithm.audio_create_hashes import create_audio_hashes
+from Algorithm.audio_utility import decode_audio_from_video_source
+from Algorithm.interval_set import IntervalSet
+from Algorithm.default_logger import logger
+from Algorithm.metrics import metrics
+
+# Queries longer than this (seconds) are screened before full fingerprinting (0 - screening is disabled)
+SCREEN_MIN_LENGTH_S = float(os.environ.get('AUDIO_SCREEN_MIN_LENGTH_S', 0))
+# Sampling density: a window of SCREEN_WINDOW_S seconds every SCREEN_PERIOD_S seconds
+SCREEN_WINDOW_S = float(os.environ.get('AUDIO_SCREEN_WINDOW_S', 15))
+SCREEN_PERIOD_S = float(os.environ.get('AUDIO_SCREEN_PERIOD_S', 120))
+# Minimum match duration inside a window for the window to count as a hit
+SCREEN_MIN_DURATION_S = float(os.environ.get('AUDIO_SCREEN_MIN_DURATION_S', 5))
+
+
+def use_screening(duration: float | None, min_length_s=SCREEN_MIN_LENGTH_S) -> bool:
+    """
+    :param duration: query duration in seconds (None - unknown).
+    :return: True if the query should be screened first.
+    """
+    return duration is not None and 0 < min_length_s < duration
+
+
+def screening_windows(duration: float, window_s=SCREEN_WINDOW_S, period_s=SCREEN_PERIOD_S)\
+        -> list[tuple[float, float]]:
+    """
+    :return: sampled windows (start, length) in seconds.
+    """
+    windows = []
+
+    start = 0.0
+    while start < duration:
+        windows.append((start, min(window_s, duration - start)))
+        start += period_s
+
+    return windows
+
+
+def fingerprint_ranges(path: str, ranges: list[tuple[float, float]]) -> list[tuple[int, int]]:
+    """
+    Decodes and fingerprints only the given ranges of the file.
+
+    :param path: path to the media file.
+    :param ranges: ranges (start, length) in seconds.
+    :return: list of (hash, time); times are in milliseconds from the start of the file.
+    """
+    result_hashes = []
+
+    for start_s, length_s in ranges:
+        with metrics.stage('decode'):
+            audio_samples, sample_rate = decode_audio_from_video_source(path, start_s=start_s, duration_s=length_s)
+
+        shift_ms = int(round(start_s * 1000))
+        result_hashes.extend((hash_value, time_ms + shift_ms)
+                             for hash_value, time_ms in create_audio_hashes(audio_samples, sample_rate))
+
+    return result_hashes
+
+
+def hit_ranges(matches: dict[int, list[tuple[int, int, int]]], duration: float, margin_s: float)\
+        -> list[tuple[float, float]]:
+    """
+    Ranges of the query to fingerprint at full resolution: screening matches in query time,
+    widened by 'margin_s' on both sides (a match may continue up to the neighbouring windows) and merged.
+
+    :param matches: screening matches (see 'detect_audio').
+    :param duration: query duration in seconds.
+    :param margin_s: widening of a match in seconds.
+    :return: ranges (start, length) in seconds.
+    """
+    ranges = IntervalSet(max_gap=0)
+
+    for values in matches.values():
+        for start, end, offset in values:
+            # The payload is not used
+            ranges.add(max(start + offset - margin_s, 0), min(end + offset + margin_s, duration), 0)
+
+    return [(start, end - start) for start, end, _ in ranges if end > start]
+
+
+def screening_info(duration: float, windows: list[tuple[float, float]], matches: dict,
+                   ranges: list[tuple[float, float]]) -> dict:
+    """
+    Records how much work the screening skipped.
+
+    :return: 'duration', number of 'windows' and their total length 'screened_s', number of 'candidates' found
+        by the screening, number of full-resolution 'ranges' and their total length 'refined_s',
+        'skipped_s' - seconds of the query that were not fingerprinted at full resolution.
+    """
+    screened_s = sum(length for _, length in windows)
+    refined_s = sum(length for _, length in ranges)
+    skipped_s = max(duration - refined_s, 0)
+
+    metrics.count('screened_seconds', int(screened_s))
+    metrics.count('refined_seconds', int(refined_s))
+    metrics.count('skipped_seconds', int(skipped_s))
+
+    logger.info(f'screening: {len(windows)} windows ({screened_s} seconds), {len(matches)} candidates, '
+                f'{len(ranges)} ranges ({refined_s} seconds); skipped {skipped_s} of {duration} seconds')
+
+    return {'duration': duration, 'windows': len(windows), 'screened_s': screened_s, 'candidates': len(matches),
+            'ranges': len(ranges), 'refined_s': refined_s, 'skipped_s': skipped_s}
+
+
+def screen_and_match(path: str, duration: float, search, match_info: dict = None, window_s=SCREEN_WINDOW_S,
+                     period_s=SCREEN_PERIOD_S, min_duration_s=SCREEN_MIN_DURATION_S)\
+        -> dict[int, list[tuple[int, int, int]]]:
+    """
+    Two-tier search for long queries: sampled windows are fingerprinted and searched to find candidate ranges,
+    then only these ranges are fingerprinted at full resolution and searched for match durations.
+
+    :param path: path to the media file.
+    :param duration: query duration in seconds.
+    :param search: search(hashes, duration, match_info=None, min_duration_s=...) -> matches,
+        for example 'audio_hashes_match_search' bound to a database service.
+    :param match_info: dictionary that receives the search limits; screening statistics go to 'screening'
+        (see 'screening_info').
+    :param window_s: length of a sampled window in seconds.
+    :param period_s: distance between the starts of sampled windows in seconds.
+    :param min_duration_s: minimum match duration inside a window.
+    :return: matches in the 'detect_audio' format.
+    """
+    windows = screening_windows(duration, window_s, period_s)
+
+    with metrics.stage('screening'):
+        matches = search(fingerprint_ranges(path, windows), duration, min_duration_s=min_duration_s)
+
+    ranges = hit_ranges(matches, duration, period_s)
+    info = screening_info(duration, windows, matches, ranges)
+    if match_info is not None:
+        match_info['screening'] = info
+
+    if not ranges:
+        return defaultdict(list)
+
+    return search(fingerprint_ranges(path, ranges), duration, match_info=match_info)
+
+
+async def screen_and_match_async(path: str, duration: float, search, match_info: dict = None,
+                                 window_s=SCREEN_WINDOW_S, period_s=SCREEN_PERIOD_S,
+                                 min_duration_s=SCREEN_MIN_DURATION_S) -> dict[int, list[tuple[int, int, int]]]:
+    """
+    Same as 'screen_and_match' for an asynchronous 'search'; decoding and hashing run in a thread.
+    """
+    windows = screening_windows(duration, window_s, period_s)
+
+    with metrics.stage('screening'):
+        result_hashes = await asyncio.to_thread(fingerprint_ranges, path, windows)
+        matches = await search(result_hashes, duration, min_duration_s=min_duration_s)
+
+    ranges = hit_ranges(matches, duration, period_s)
+    info = screening_info(duration, windows, matches, ranges)
+    if match_info is not None:
+        match_info['screening'] = info
+
+    if not ranges:
+        return defaultdict(list)
+
+    result_hashes = await asyncio.to_thread(fingerprint_ranges, path, ranges)
+
+    return await search(result_hashes, duration, match_info=match_info)
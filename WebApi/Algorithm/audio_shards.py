@@ -0,0 +1,773 @@
+import os
+import json
+import queue
+import struct
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+from Algorithm.audio_hash_index import AudioHashIndex, SnapshotLookup, concatenate_rows, sort_rows
+from Algorithm.default_logger import logger
+
+# Path of the shard map (JSON, see 'ShardMap.save'); when set, services use the sharded index
+SHARD_MAP_PATH = os.environ.get('AUDIO_SHARD_MAP')
+# Key shared by the workers and their clients; required, workers and clients do not start without it
+SHARD_AUTHKEY = os.environ['AUDIO_SHARD_AUTHKEY'].encode() if os.environ.get('AUDIO_SHARD_AUTHKEY') else None
+
+# Hashes sampled from the shards to compute balanced boundaries
+REBALANCE_SAMPLE_SIZE = 100000
+
+
+class ShardError(RuntimeError):
+    """
+    A shard worker failed to execute a request.
+    """
+
+
+class StaleShardMapError(ShardError):
+    """
+    The client routes requests by an older shard map than the workers have (see 'ShardedHashIndex.rebalance').
+    """
+
+
+# Requests routed by the shard map: workers refuse them from clients with another map version
+VERSIONED_COMMANDS = ('lookup', 'get_hash_frequencies', 'add', 'remove_content')
+# Assignment of a worker (map version and hash range), kept in the index directory of the shard
+ASSIGNMENT_FILE = 'shard_assignment.json'
+
+
+# Message: header length, JSON header describing the values, raw buffers of the arrays
+# (the header and the buffers are padded to MESSAGE_ALIGNMENT, so the received arrays are aligned)
+MESSAGE_HEADER_STRUCT = struct.Struct('<I')
+MESSAGE_ALIGNMENT = 8
+# Only plain numeric arrays are accepted from the network
+MESSAGE_ARRAY_KINDS = 'biuf'
+
+
+def require_authkey(authkey: bytes | None) -> bytes:
+    """
+    :raises ShardError: if no key is configured.
+    """
+    if not authkey:
+        raise ShardError('AUDIO_SHARD_AUTHKEY is not set: shard workers and clients require a shared key')
+
+    return authkey
+
+
+def encode_value(value, buffers: list):
+    """
+    Describes a value for the JSON header of a message; array data is appended to 'buffers'.
+    """
+    if isinstance(value, np.ndarray):
+        array = np.ascontiguousarray(value)
+        buffers.append(array.tobytes())
+        buffers.append(bytes(-len(buffers[-1]) % MESSAGE_ALIGNMENT))
+        return {'array': array.dtype.str, 'shape': list(array.shape)}
+
+    if isinstance(value, (list, tuple)):
+        return {'list': [encode_value(item, buffers) for item in value]}
+
+    if isinstance(value, np.generic):
+        value = value.item()
+
+    return {'value': value}
+
+
+def decode_value(description: dict, data: memoryview, position: list):
+    """
+    Restores a value described by 'encode_value'; 'position' is the offset of the next array in 'data'.
+    """
+    if 'array' in description:
+        dtype = np.dtype(description['array'])
+        if dtype.kind not in MESSAGE_ARRAY_KINDS:
+            raise ValueError(f'unsupported array type {dtype}')
+
+        shape = tuple(int(size) for size in description['shape'])
+        count = int(np.prod(shape))
+        array = np.frombuffer(data, dtype=dtype, count=count, offset=position[0]).reshape(shape)
+        size = count * dtype.itemsize
+        position[0] += size + -size % MESSAGE_ALIGNMENT
+        return array
+
+    if 'list' in description:
+        return tuple(decode_value(item, data, position) for item in description['list'])
+
+    return description['value']
+
+
+def send_message(conn, *values):
+    """
+    Sends values (JSON-compatible values, numeric arrays and tuples of them) without pickle.
+    """
+    buffers = []
+    header = json.dumps([encode_value(value, buffers) for value in values]).encode()
+    header += b' ' * (-(MESSAGE_HEADER_STRUCT.size + len(header)) % MESSAGE_ALIGNMENT)
+
+    conn.send_bytes(b''.join([MESSAGE_HEADER_STRUCT.pack(len(header)), header, *buffers]))
+
+
+def recv_message(conn) -> tuple:
+    """
+    Receives values sent by 'send_message'.
+    """
+    data = memoryview(bytearray(conn.recv_bytes()))
+    length, = MESSAGE_HEADER_STRUCT.unpack_from(data)
+
+    start = MESSAGE_HEADER_STRUCT.size
+    position = [start + length]
+
+    return tuple(decode_value(item, data, position) for item in json.loads(bytes(data[start:start + length])))
+
+
+class ShardMap:
+    """
+    Partition of the hash space by ranges: shard i holds hashes in [boundaries[i - 1], boundaries[i]),
+    the first and the last ranges are open. Every rebalancing gives the map a new version.
+    """
+
+    def __init__(self, addresses: list[tuple[str, int]], boundaries: list[int], version=1):
+        """
+        :param addresses: worker addresses (host, port), one per shard.
+        :param boundaries: sorted hashes between neighbouring shards (one less than addresses).
+        :param version: map version; workers refuse requests routed by another version.
+        """
+        if len(boundaries) != len(addresses) - 1 or list(boundaries) != sorted(boundaries):
+            raise ValueError('expected sorted boundaries, one less than addresses')
+
+        self.addresses = [tuple(address) for address in addresses]
+        self.boundaries = [int(boundary) for boundary in boundaries]
+        self.version = int(version)
+
+    @classmethod
+    def from_sample(cls, addresses: list[tuple[str, int]], hashes: np.ndarray, version=1):
+        """
+        Creates a map with about the same number of snapshots per shard.
+
+        :param addresses: worker addresses.
+        :param hashes: hashes of snapshots (a random sample of the catalog).
+        :param version: map version.
+        """
+        hashes = np.sort(np.asarray(hashes, dtype=np.int64))
+        if len(hashes) == 0:
+            hashes = np.zeros(1, dtype=np.int64)
+
+        quantiles = np.arange(1, len(addresses)) / len(addresses)
+        boundaries = hashes[(quantiles * (len(hashes) - 1)).astype(np.int64)]
+
+        return cls(addresses, boundaries.tolist(), version)
+
+    @classmethod
+    def uniform(cls, addresses: list[tuple[str, int]]):
+        """
+        Creates a map with equal ranges of the packed hash space (non-negative int64).
+        """
+        return cls(addresses, [(1 << 63) * number // len(addresses) for number in range(1, len(addresses))])
+
+    def ranges(self) -> list[tuple[int, int]]:
+        """
+        :return: hash ranges [lo, hi) of the shards; None is an open end.
+        """
+        edges = [None] + self.boundaries + [None]
+        return list(zip(edges[:-1], edges[1:]))
+
+    def shard_of(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        :return: shard numbers of the hashes.
+        """
+        return np.searchsorted(np.array(self.boundaries, dtype=np.int64), hashes, side='right')
+
+    def to_dict(self) -> dict:
+        return {'addresses': [list(address) for address in self.addresses], 'boundaries': self.boundaries,
+                'version': self.version}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data['addresses'], data['boundaries'], data.get('version', 1))
+
+    def save(self, path: str):
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def intersect_ranges(a: tuple[int, int], b: tuple[int, int]):
+    """
+    :return: intersection of hash ranges [lo, hi) (None is an open end) or None if it is empty.
+    """
+    lo = a[0] if b[0] is None else b[0] if a[0] is None else max(a[0], b[0])
+    hi = a[1] if b[1] is None else b[1] if a[1] is None else min(a[1], b[1])
+
+    if lo is not None and hi is not None and lo >= hi:
+        return None
+
+    return lo, hi
+
+
+class ShardWorker:
+    """
+    Process that serves one shard: an 'AudioHashIndex' with the hashes of its range.
+    Requests (command, map version, *arguments) are sent over 'multiprocessing.connection' authenticated
+    with the shared key and encoded by 'send_message' (never unpickled); each client connection is served
+    by its own thread. Once the worker is assigned a map version ('assign'), it refuses requests routed
+    by another version (VERSIONED_COMMANDS), so clients with a stale map fail instead of missing rows.
+    """
+
+    def __init__(self, directory: str, address: tuple[str, int], authkey=SHARD_AUTHKEY):
+        """
+        :param directory: index directory of the shard.
+        :param address: address to listen on (port 0 - any free port, see 'listener.address').
+        :param authkey: key shared with the clients.
+        :raises ShardError: if no key is given.
+        """
+        authkey = require_authkey(authkey)
+
+        self.index = AudioHashIndex(directory)
+        self.listener = Listener(address, authkey=authkey)
+        self.authkey = authkey
+        self.staged = []
+        self.stopped = threading.Event()
+        self.assignment_path = os.path.join(directory, ASSIGNMENT_FILE)
+        self.assignment = self.load_assignment()
+
+    def serve_forever(self):
+        logger.info(f'shard worker {self.listener.address}: {self.index.stats()}')
+
+        while not self.stopped.is_set():
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError) as error:  # failed handshake
+                logger.warning(f'shard worker: rejected connection: {error}')
+                continue
+
+            threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+
+        self.listener.close()
+
+    def serve_connection(self, conn):
+        with conn:
+            while not self.stopped.is_set():
+                try:
+                    command, version, *args = recv_message(conn)
+                except (EOFError, OSError):
+                    return
+                except (ValueError, TypeError, KeyError, struct.error) as error:
+                    logger.error(f'Exception: shard worker: malformed request: {error}')
+                    return
+
+                assigned = self.assignment['version'] if self.assignment is not None else None
+                if command in VERSIONED_COMMANDS and assigned is not None and version != assigned:
+                    send_message(conn, 'stale', f'shard map version {version} is stale, the worker has {assigned}')
+                    continue
+
+                try:
+                    send_message(conn, 'ok', self.execute(command, *args))
+                except Exception as error:
+                    logger.error(f'Exception: shard worker {command}: {error}')
+                    send_message(conn, 'error', f'{type(error).__name__}: {error}')
+
+    def execute(self, command: str, *args):
+        if command == 'lookup':
+            return self.index.lookup(*args)
+        if command == 'get_hash_frequencies':
+            return self.index.get_hash_frequencies(*args)
+        if command == 'add':
+            return self.index.add(*args)
+        if command == 'remove_content':
+            return self.index.remove_content(*args)
+        if command == 'range_rows':
+            return self.index.range_rows(*args)
+        if command == 'compact':
+            return self.index.compact(*args)
+        if command == 'stats':
+            return self.index.stats()
+        if command == 'sample':
+            return self.sample(*args)
+        if command == 'stage':
+            return self.staged.append(args)
+        if command == 'rebuild_staged':
+            return self.rebuild_staged()
+        if command == 'assign':
+            return self.assign(*args)
+        if command == 'stop':
+            return self.stop()
+
+        raise ValueError(f'unknown command {command}')
+
+    def sample(self, size: int) -> np.ndarray:
+        """
+        :return: random hashes of the shard snapshots.
+        """
+        hashes = self.index.range_rows()[2]
+        if len(hashes) <= size:
+            return hashes
+
+        return hashes[np.random.default_rng().choice(len(hashes), size, replace=False)]
+
+    def load_assignment(self) -> dict | None:
+        try:
+            with open(self.assignment_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def assign(self, version: int, lo: int | None, hi: int | None):
+        """
+        Records the map version and the hash range of the worker (kept over restarts).
+        """
+        assignment = {'version': int(version), 'range': [lo, hi]}
+
+        temp_path = f'{self.assignment_path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(assignment, f)
+        os.replace(temp_path, self.assignment_path)
+
+        self.assignment = assignment
+
+    def rebuild_staged(self):
+        """
+        Replaces the index with the rows sent by 'stage' requests.
+        """
+        staged, self.staged = self.staged, []
+
+        id_contents, timestamps, hashes = concatenate_rows(staged)
+        self.index.rebuild([np.column_stack((id_contents, timestamps, hashes))])
+
+    def stop(self):
+        self.stopped.set()
+
+        # Wakes up 'accept'
+        try:
+            Client(self.listener.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+
+
+def run_shard_worker(directory: str, address: tuple[str, int], authkey: bytes, ready=None):
+    """
+    Entry point of a shard worker process.
+
+    :param ready: connection to send the listening address to, once the worker accepts requests.
+    """
+    worker = ShardWorker(directory, address, authkey)
+
+    if ready is not None:
+        ready.send(worker.listener.address)
+        ready.close()
+
+    worker.serve_forever()
+
+
+class ShardedHashIndex(SnapshotLookup):
+    """
+    Client of the shard workers. Lookups and updates are split by hash range and sent to the shards
+    in parallel; results are gathered into one answer, so the client is used like 'AudioHashIndex'
+    (for example, by 'detect_audio' or as 'DBService.hash_index').
+    """
+
+    def __init__(self, shard_map: ShardMap, authkey=SHARD_AUTHKEY):
+        """
+        :raises ShardError: if no key is given.
+        """
+        self.shard_map = shard_map
+        self.authkey = require_authkey(authkey)
+        self.connections = {}  # address -> queue of idle connections
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(len(shard_map.addresses), 1),
+                                           thread_name_prefix='shard-client')
+
+    def close(self):
+        self.executor.shutdown()
+
+        with self.lock:
+            connections, self.connections = self.connections, {}
+
+        for idle in connections.values():
+            while not idle.empty():
+                idle.get_nowait().close()
+
+    def call(self, address: tuple[str, int], command: str, *args):
+        """
+        Sends a request to the worker and waits for the answer.
+
+        :raises StaleShardMapError: if the worker has another version of the shard map.
+        :raises ShardError: if the worker failed or is unreachable.
+        """
+        with self.lock:
+            idle = self.connections.setdefault(tuple(address), queue.SimpleQueue())
+
+        try:
+            conn = idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = Client(tuple(address), authkey=self.authkey)
+            except OSError as error:
+                raise ShardError(f'shard {address} is unreachable: {error}') from error
+
+        try:
+            send_message(conn, command, self.shard_map.version, *args)
+            status, result = recv_message(conn)
+
+        except (EOFError, OSError, ValueError, struct.error) as error:
+            conn.close()
+            raise ShardError(f'shard {address} failed: {error}') from error
+
+        idle.put(conn)
+
+        if status == 'stale':
+            raise StaleShardMapError(f'shard {address}: {result}; reload the shard map (AUDIO_SHARD_MAP)')
+        if status != 'ok':
+            raise ShardError(f'shard {address}: {result}')
+
+        return result
+
+    def scatter(self, requests: list[tuple]) -> list:
+        """
+        Sends requests (address, command, *arguments) in parallel.
+
+        :return: answers in the order of the requests.
+        """
+        futures = [self.executor.submit(self.call, *request) for request in requests]
+        return [future.result() for future in futures]
+
+    def split(self, hashes: np.ndarray) -> list[tuple[int, np.ndarray]]:
+        """
+        :return: list of (shard number, indices of its hashes) for shards that have hashes.
+        """
+        shards = self.shard_map.shard_of(hashes)
+        order = np.argsort(shards, kind='stable')
+        numbers, starts = np.unique(shards[order], return_index=True)
+
+        return list(zip(numbers.tolist(), np.split(order, starts[1:])))
+
+    def lookup(self, hashes) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds snapshots of the hashes on the shards that hold them.
+
+        :param hashes: packed hashes (int64).
+        :return: arrays (id_content, timestamp, hash), ordered by content and time.
+        """
+        query = np.unique(np.asarray(hashes, dtype=np.int64))
+        addresses = self.shard_map.addresses
+
+        parts = self.scatter([(addresses[shard], 'lookup', query[indices]) for shard, indices in self.split(query)])
+
+        return sort_rows(concatenate_rows(parts))
+
+    def get_hash_frequencies(self, hashes) -> np.ndarray:
+        """
+        Returns the numbers of snapshots of the hashes from the shards that hold them.
+        """
+        hashes = np.asarray(hashes, dtype=np.int64)
+        frequencies = np.zeros(len(hashes), dtype=np.int64)
+
+        parts = self.split(hashes)
+        answers = self.scatter([(self.shard_map.addresses[shard], 'get_hash_frequencies', hashes[indices])
+                                for shard, indices in parts])
+
+        for (_, indices), answer in zip(parts, answers):
+            frequencies[indices] = answer
+
+        return frequencies
+
+    def add(self, id_content, hashes: np.ndarray, timestamps: np.ndarray, replace=False):
+        """
+        Adds snapshots to the shards of their hashes (see 'AudioHashIndex.add').
+        With 'replace', every shard drops the previous snapshots of the contents.
+        """
+        hashes = np.asarray(hashes, dtype=np.int64)
+        id_contents = np.broadcast_to(np.asarray(id_content, dtype=np.int32), hashes.shape)
+        timestamps = np.asarray(timestamps, dtype=np.int32)
+
+        parts = dict(self.split(hashes))
+        requests = []
+
+        for shard, address in enumerate(self.shard_map.addresses):
+            indices = parts.get(shard)
+
+            if indices is not None:
+                requests.append((address, 'add', id_contents[indices], hashes[indices], timestamps[indices], replace))
+            elif replace:
+                requests.append((address, 'add', np.unique(id_contents), hashes[:0], timestamps[:0], replace))
+
+        self.scatter(requests)
+
+    def remove_content(self, id_content: int):
+        self.scatter([(address, 'remove_content', id_content) for address in self.shard_map.addresses])
+
+    def stats(self) -> list[dict]:
+        return self.scatter([(address, 'stats') for address in self.shard_map.addresses])
+
+    def rebuild(self, batches):
+        """
+        Replaces the shard indexes with the given rows (for example, all rows of 'snapshot_audio').
+        Each worker keeps only the rows of its range.
+
+        :param batches: iterable of lists of tuples (id_content, timestamp, hash).
+        """
+        addresses = self.shard_map.addresses
+
+        for rows in batches:
+            if not rows:
+                continue
+
+            data = np.array(rows, dtype=np.int64).reshape(-1, 3)
+            self.scatter([(addresses[shard], 'stage', data[indices, 0].astype(np.int32),
+                           data[indices, 1].astype(np.int32), data[indices, 2])
+                          for shard, indices in self.split(data[:, 2])])
+
+        self.scatter([(address, 'rebuild_staged') for address in addresses])
+        self.assign_map(self.shard_map)
+
+    def assign_map(self, shard_map: ShardMap, retired=()):
+        """
+        Assigns the map version and ranges to its workers; 'retired' workers get the version with no range.
+        """
+        self.scatter([(address, 'assign', shard_map.version, *hash_range)
+                      for address, hash_range in zip(shard_map.addresses, shard_map.ranges())] +
+                     [(address, 'assign', shard_map.version, None, None) for address in retired])
+
+    def balanced_map(self, addresses=None, sample_size=REBALANCE_SAMPLE_SIZE) -> ShardMap:
+        """
+        Computes a map with about the same number of snapshots per shard from a sample of the current shards.
+
+        :param addresses: workers of the new map (by default - the current ones).
+        :param sample_size: number of sampled hashes.
+        """
+        counts = [stats['postings'] for stats in self.stats()]
+        total = max(sum(counts), 1)
+
+        samples = self.scatter([(address, 'sample', max(1, sample_size * count // total))
+                                for address, count in zip(self.shard_map.addresses, counts)])
+
+        return ShardMap.from_sample(addresses or self.shard_map.addresses, np.concatenate(samples),
+                                    self.shard_map.version + 1)
+
+    def rebalance(self, new_map: ShardMap):
+        """
+        Moves snapshots between workers to match the new map, then switches to it.
+        Rows are copied to their new shards first; then the workers are assigned the new map version
+        and drop the rows outside their ranges. Lookups of this client do not miss rows. Other clients
+        that still hold the previous map get 'StaleShardMapError' from the workers instead of partial
+        results and must reload the map. Updates should be paused while rebalancing.
+        Workers that are not in the new map keep their data and can be stopped.
+
+        :param new_map: new shard map (boundaries and/or workers) with a greater version.
+        :raises ValueError: if the version of the new map is not greater than the current one.
+        """
+        old_map = self.shard_map
+        if new_map.version <= old_map.version:
+            raise ValueError(f'the new shard map must have a version greater than {old_map.version}')
+
+        for old_address, old_range in zip(old_map.addresses, old_map.ranges()):
+            for new_address, new_range in zip(new_map.addresses, new_map.ranges()):
+                common = intersect_ranges(old_range, new_range)
+                if new_address == old_address or common is None:
+                    continue
+
+                id_contents, timestamps, hashes = self.call(old_address, 'range_rows', *common)
+                if len(hashes):
+                    logger.info(f'rebalance: moving {len(hashes)} snapshots {old_address} -> {new_address}')
+                    self.call(new_address, 'add', id_contents, hashes, timestamps)
+
+        if len(new_map.addresses) > len(old_map.addresses):
+            executor, self.executor = self.executor, ThreadPoolExecutor(max_workers=len(new_map.addresses),
+                                                                        thread_name_prefix='shard-client')
+            executor.shutdown(wait=False)
+
+        self.assign_map(new_map, [address for address in old_map.addresses if address not in new_map.addresses])
+        self.shard_map = new_map
+        self.scatter([(address, 'compact', *hash_range) for address, hash_range in zip(new_map.addresses,
+                                                                                        new_map.ranges())])
+
+
+class LocalShardCluster:
+    """
+    Shard workers in local processes (for development and checks), used as a context manager:
+
+        with LocalShardCluster(4) as cluster:
+            index = ShardedHashIndex(cluster.shard_map(), cluster.authkey)
+    """
+
+    def __init__(self, count: int, directory=None, authkey=SHARD_AUTHKEY, host='127.0.0.1'):
+        """
+        :param count: number of workers.
+        :param directory: parent directory of the shard indexes (by default - a temporary one).
+        :param authkey: key shared with the clients (by default - the configured one or a random key).
+        :param host: address to listen on.
+        """
+        self.count = count
+        self.directory = directory or tempfile.mkdtemp(prefix='audio_shards_')
+        self.authkey = authkey or os.urandom(32)
+        self.host = host
+        self.processes = []
+        self.addresses = []
+
+    def start_worker(self, number: int) -> tuple[str, int]:
+        """
+        Starts a worker and waits until it listens.
+
+        :return: worker address.
+        """
+        context = multiprocessing.get_context('spawn')
+        receiver, sender = context.Pipe(duplex=False)
+
+        process = context.Process(target=run_shard_worker, daemon=True,
+                                  args=(os.path.join(self.directory, f'shard_{number}'), (self.host, 0),
+                                        self.authkey, sender))
+        process.start()
+        sender.close()
+
+        address = receiver.recv()
+        receiver.close()
+
+        self.processes.append(process)
+        self.addresses.append(tuple(address))
+
+        return tuple(address)
+
+    def start(self):
+        for number in range(self.count):
+            self.start_worker(number)
+
+        return self
+
+    def shard_map(self, hashes=None) -> ShardMap:
+        """
+        :param hashes: sample of hashes to balance the shards (by default - equal ranges of the packed hash space).
+        """
+        if hashes is None:
+            return ShardMap.uniform(self.addresses)
+
+        return ShardMap.from_sample(self.addresses, hashes)
+
+    def stop(self):
+        for address in self.addresses:
+            try:
+                conn = Client(address, authkey=self.authkey)
+                send_message(conn, 'stop', None)
+                recv_message(conn)
+                conn.close()
+            except (OSError, EOFError):
+                pass
+
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+        self.processes, self.addresses = [], []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
+
+
+def check_local_cluster(count: int, rows=200000, contents=200, seed=0):
+    """
+    Compares sharded lookups with a single index on random snapshots, before and after rebalancing
+    to one more worker.
+    """
+    rng = np.random.default_rng(seed)
+    id_contents = rng.integers(1, contents + 1, rows).astype(np.int32)
+    timestamps = rng.integers(0, 10000, rows).astype(np.int32)
+    # Skewed distribution: equal ranges of the hash space do not hold equal numbers of snapshots
+    hashes = (rng.pareto(2.0, rows) * (1 << 40)).astype(np.int64)
+    query = np.concatenate((rng.choice(hashes, 5000), rng.integers(0, 1 << 42, 1000)))
+
+    reference = AudioHashIndex(tempfile.mkdtemp(prefix='audio_index_'))
+    reference.rebuild([np.column_stack((id_contents, timestamps, hashes))])
+    expected = sorted(reference.get_audio_snapshots_by_hashes(query))
+
+    with LocalShardCluster(count + 1) as cluster:
+        client = ShardedHashIndex(ShardMap(cluster.addresses[:count], cluster.shard_map().boundaries[:count - 1]),
+                                  cluster.authkey)
+
+        half = rows // 2
+        client.rebuild([list(zip(id_contents[:half].tolist(), timestamps[:half].tolist(), hashes[:half].tolist()))])
+        client.add(id_contents[half:], hashes[half:], timestamps[half:])
+        logger.info(f'shards: {[stats["postings"] for stats in client.stats()]}')
+
+        assert sorted(client.get_audio_snapshots_by_hashes(query)) == expected, 'sharded lookup differs'
+
+        stale_client = ShardedHashIndex(client.shard_map, cluster.authkey)
+        client.rebalance(client.balanced_map(cluster.addresses))
+        logger.info(f'shards after rebalancing: {[stats["postings"] for stats in client.stats()]}')
+
+        assert sorted(client.get_audio_snapshots_by_hashes(query)) == expected, 'lookup differs after rebalancing'
+
+        try:
+            stale_client.lookup(query)
+            raise AssertionError('a client with the previous shard map was served')
+        except StaleShardMapError:
+            pass
+
+        stale_client.close()
+        client.close()
+
+    logger.info(f'sharded lookups match: {len(expected)} snapshots')
+
+
+def open_sharded_index(path=SHARD_MAP_PATH):
+    """
+    :return: client of the configured shards ('AUDIO_SHARD_MAP' environment variable) or None.
+    """
+    return ShardedHashIndex(ShardMap.load(path)) if path else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sharded audio hash index.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve = subparsers.add_parser('serve', help='run a shard worker')
+    serve.add_argument('--directory', required=True, help='index directory of the shard')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, required=True)
+
+    build = subparsers.add_parser('build', help='load snapshot_audio into the shards of the map')
+    build.add_argument('--map', default=SHARD_MAP_PATH, required=SHARD_MAP_PATH is None, help='shard map file')
+
+    rebalance = subparsers.add_parser('rebalance', help='balance the shards (optionally onto other workers)')
+    rebalance.add_argument('--map', default=SHARD_MAP_PATH, required=SHARD_MAP_PATH is None, help='shard map file')
+    rebalance.add_argument('--worker', action='append', default=[], help='host:port of the new map workers')
+
+    check = subparsers.add_parser('check', help='compare local shards with a single index')
+    check.add_argument('--shards', type=int, default=3)
+
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        run_shard_worker(args.directory, (args.host, args.port), SHARD_AUTHKEY)
+
+    elif args.command == 'build':
+        from Algorithm.db_service import DBService
+        from Algorithm.db_utilities import load_config
+
+        index = ShardedHashIndex(ShardMap.load(args.map))
+        index.rebuild(DBService(1, 1, load_config()).iter_all_audio_snapshots())
+        logger.info(f'shards: {index.stats()}')
+
+    elif args.command == 'rebalance':
+        index = ShardedHashIndex(ShardMap.load(args.map))
+        workers = [(host, int(port)) for host, port in (worker.rsplit(':', 1) for worker in args.worker)]
+
+        new_map = index.balanced_map(workers or None)
+        index.rebalance(new_map)
+        new_map.save(args.map)
+        logger.info(f'shards: {index.stats()}')
+
+    elif args.command == 'check':
+        check_local_cluster(args.shards)
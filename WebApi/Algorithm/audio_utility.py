@@ -1,8 +1,17 @@
+import threading
+from contextlib import contextmanager
+
 import numpy as np
 import ffmpeg
 from io import BytesIO
 from scipy.io import wavfile
 
+# Частота дискретизации (моно), к которой приводится аудио перед созданием слепка.
+FINGERPRINT_SAMPLE_RATE = 11025
+
+# Количество отсчетов в одной части при потоковом чтении PCM из ffmpeg (~10 секунд).
+PCM_CHUNK_SAMPLES = 1 << 17
+
 
 def extract_audio_from_video_source(input_source) -> BytesIO:
     """
@@ -22,6 +31,156 @@ def extract_audio_from_video_source(input_source) -> BytesIO:
     return BytesIO(out)
 
 
+def read_pcm_into(stream, buffer: np.ndarray) -> int:
+    """
+    Заполняет буфер данными из потока без промежуточных копий (readinto напрямую в память массива).
+
+    :param stream: бинарный поток (stdout процесса ffmpeg).
+    :param buffer: массив, в который выполняется чтение.
+    :return count: количество прочитанных элементов (меньше размера буфера только в конце потока).
+    """
+    view = memoryview(buffer).cast('B')
+    item_size = buffer.itemsize
+
+    filled = 0
+    while filled < len(view):
+        read = stream.readinto(view[filled:])
+        if not read:
+            break
+        filled += read
+
+    return filled // item_size
+
+
+@contextmanager
+def open_pcm_process(input_source, sample_rate=FINGERPRINT_SAMPLE_RATE, start_s: float = None,
+                     duration_s: float = None):
+    """
+    Запускает ffmpeg, декодирующий аудиодорожку в моно 16-битный PCM (s16le), и возвращает его stdout.
+    stderr читается в отдельном потоке: иначе ffmpeg блокируется на заполненном канале stderr,
+    пока читается stdout. Если чтение прервано, процесс завершается.
+
+    :param input_source: Путь к видео- или аудиофайлу.
+    :param sample_rate: Частота дискретизации результата.
+    :param start_s: Начало декодируемого фрагмента в секундах (None - с начала). ffmpeg переходит к нему
+        по индексу файла, не декодируя предыдущие данные.
+    :param duration_s: Длительность декодируемого фрагмента в секундах (None - до конца).
+    :raises ffmpeg.Error: если ffmpeg завершился с ошибкой.
+    """
+    input_args = {}
+    if start_s is not None:
+        input_args['ss'] = start_s
+    if duration_s is not None:
+        input_args['t'] = duration_s
+
+    process = (
+        ffmpeg
+        .input(input_source, **input_args)
+        .output('pipe:', format='s16le', acodec='pcm_s16le', ac=1, ar=sample_rate)
+        .global_args('-loglevel', 'error', '-nostdin')
+        .run_async(pipe_stdout=True, pipe_stderr=True)
+    )
+
+    stderr = []
+    stderr_reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    stderr_reader.start()
+
+    try:
+        yield process.stdout
+
+    except BaseException:
+        process.kill()
+        raise
+
+    finally:
+        process.stdout.close()
+        process.wait()
+        stderr_reader.join()
+        process.stderr.close()
+
+    if process.returncode != 0:
+        raise ffmpeg.Error('ffmpeg', None, b''.join(stderr))
+
+
+def iter_pcm_from_video_source(input_source, sample_rate=FINGERPRINT_SAMPLE_RATE, chunk_samples=PCM_CHUNK_SAMPLES,
+                               start_s: float = None, duration_s: float = None):
+    """
+    Потоково декодирует аудиодорожку через ffmpeg в моно 16-битный PCM (s16le) с заданной частотой дискретизации.
+    Данные читаются из канала частями и сразу записываются в numpy массивы,
+    поэтому в памяти не хранится ни WAV файл целиком, ни весь сигнал.
+
+    :param input_source: Путь к видео- или аудиофайлу.
+    :param sample_rate: Частота дискретизации результата.
+    :param chunk_samples: Количество отсчетов в одной части.
+    :param start_s: Начало декодируемого фрагмента в секундах (None - с начала).
+    :param duration_s: Длительность декодируемого фрагмента в секундах (None - до конца).
+    :return: генератор массивов int16 (последняя часть может быть короче).
+    """
+    with open_pcm_process(input_source, sample_rate, start_s, duration_s) as stdout:
+        while True:
+            chunk = np.empty(chunk_samples, dtype='<i2')
+            count = read_pcm_into(stdout, chunk)
+
+            if count > 0:
+                yield chunk[:count]
+            if count < chunk_samples:
+                break
+
+
+def expected_samples(input_source, sample_rate: int, start_s: float = None, duration_s: float = None) -> int:
+    """
+    Оценивает количество отсчетов декодируемого фрагмента по заголовку файла.
+
+    :return: количество отсчетов (0, если длительность неизвестна).
+    """
+    if duration_s is None:
+        try:
+            duration_s = probe_media_duration(input_source) if isinstance(input_source, str) else None
+        except ffmpeg.Error:
+            duration_s = None
+
+        if duration_s is not None and start_s is not None:
+            duration_s -= start_s
+
+    return max(int(duration_s * sample_rate), 0) if duration_s is not None else 0
+
+
+def decode_audio_from_video_source(input_source, sample_rate=FINGERPRINT_SAMPLE_RATE, start_s: float = None,
+                                   duration_s: float = None) -> tuple[np.ndarray, int]:
+    """
+    Декодирует аудиодорожку через ffmpeg в моно 16-битный PCM с заданной частотой дискретизации.
+    Отсчеты читаются в один массив, выделенный по длительности из заголовка файла (с запасом);
+    если длительность неизвестна или занижена, массив увеличивается вдвое.
+
+    :param input_source: Путь к видео- или аудиофайлу.
+    :param sample_rate: Частота дискретизации результата.
+    :param start_s: Начало декодируемого фрагмента в секундах (None - с начала).
+    :param duration_s: Длительность декодируемого фрагмента в секундах (None - до конца).
+    :return audio_samples: Аудиоданные (int16, один канал).
+    :return sample_rate: Частота дискретизации аудиоданных.
+    """
+    # Запас в одну секунду: при точной оценке массив не увеличивается ради чтения конца потока
+    capacity = max(expected_samples(input_source, sample_rate, start_s, duration_s) + sample_rate, PCM_CHUNK_SAMPLES)
+    audio_samples = np.empty(capacity, dtype='<i2')
+    filled = 0
+
+    with open_pcm_process(input_source, sample_rate, start_s, duration_s) as stdout:
+        while True:
+            filled += read_pcm_into(stdout, audio_samples[filled:])
+            if filled < len(audio_samples):
+                break
+
+            grown = np.empty(2 * len(audio_samples), dtype='<i2')
+            grown[:filled] = audio_samples
+            audio_samples = grown
+
+    # Срез держит весь массив: при сильно завышенной оценке лишняя память освобождается копией
+    if filled < len(audio_samples) // 2:
+        return audio_samples[:filled].copy(), sample_rate
+
+    return audio_samples[:filled], sample_rate
+
+
 def read_audio(input_source) -> tuple[np.ndarray, int]:
     """
     Выполняет чтение аудиоданных в формате 'wav'
@@ -42,6 +201,18 @@ def read_audio(input_source) -> tuple[np.ndarray, int]:
     return audio_samples, sample_rate
 
 
+def probe_media_duration(input_source: str) -> float | None:
+    """
+    Получает длительность медиафайла по его заголовку (ffprobe), без декодирования.
+
+    :param input_source: Путь к видео- или аудиофайлу.
+    :return duration: Длительность в секундах или None, если она не указана в файле.
+    """
+    duration = ffmpeg.probe(input_source)['format'].get('duration')
+
+    return float(duration) if duration is not None else None
+
+
 def get_audio_duration(audio_samples: np.ndarray, sample_rate: int) -> float:
     """
     Получает длительность аудиозаписи в секундах.
@@ -64,8 +235,7 @@ def example1(filename_: str):
     :param filename_: Путь к видеофайлу.
     """
 
-    audio_stream = extract_audio_from_video_source(filename_)
-    audio_samples, sample_rate = read_audio(audio_stream)
+    audio_samples, sample_rate = decode_audio_from_video_source(filename_)
 
     duration = get_audio_duration(audio_samples, sample_rate)
 
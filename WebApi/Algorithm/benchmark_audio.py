@@ -0,0 +1,221 @@
+import gc
+import sys
+import json
+import platform
+import argparse
+import tracemalloc
+from time import perf_counter, process_time
+
+import numpy as np
+
+from Algorithm.audio_create_hashes import compute_log_spectrogram, pick_peaks, make_pairs, generate_hashes, \
+    create_audio_hashes, create_audio_hashes_streaming
+from Algorithm.audio_detection import find_durations, find_durations_arrays
+
+DEFAULT_LENGTHS_S = (10, 60, 300)
+DEFAULT_SAMPLE_RATES = (11025, 44100)
+SIGNALS = ('tone', 'chirp', 'noise', 'music')
+STREAM_CHUNK_SAMPLES = 1 << 16
+
+
+def synthesize(kind: str, duration_s: float, sample_rate: int, seed=0) -> np.ndarray:
+    """
+    Generates deterministic synthetic 16-bit mono audio.
+
+    :param kind: 'tone', 'chirp', 'noise' or 'music' (notes with harmonics, percussive bursts and noise).
+    :param duration_s: duration in seconds.
+    :param sample_rate: sample rate.
+    :param seed: random generator seed.
+    :return: int16 samples.
+    """
+    rng = np.random.default_rng(seed)
+    count = int(duration_s * sample_rate)
+    t = np.arange(count, dtype=np.float64) / sample_rate
+
+    if kind == 'tone':
+        signal = 0.5 * np.sin(2 * np.pi * 440 * t) + 0.25 * np.sin(2 * np.pi * 1320 * t)
+
+    elif kind == 'chirp':
+        # Logarithmic sweep 100 Hz -> 4 kHz repeated every 10 seconds
+        period = 10.0
+        phase_t = t % period
+        k = np.log(4000 / 100) / period
+        signal = 0.7 * np.sin(2 * np.pi * 100 * (np.exp(k * phase_t) - 1) / k)
+
+    elif kind == 'noise':
+        signal = 0.3 * rng.standard_normal(count)
+
+    elif kind == 'music':
+        note_s = 0.25
+        notes = 110 * 2 ** (rng.integers(0, 36, int(duration_s / note_s) + 1) / 12)
+        frequency = notes[(t / note_s).astype(np.int64)]
+        phase = 2 * np.pi * np.cumsum(frequency) / sample_rate
+
+        signal = sum(0.4 / harmonic * np.sin(harmonic * phase) for harmonic in range(1, 5))
+
+        # Percussion: decaying noise bursts on every beat
+        beat = (t % 0.5) < 0.05
+        signal += beat * np.exp(-(t % 0.5) * 60) * rng.standard_normal(count) * 0.5
+        signal += 0.02 * rng.standard_normal(count)
+
+    else:
+        raise ValueError(f'unknown signal: {kind}')
+
+    return (np.clip(signal, -1, 1) * 32767).astype(np.int16)
+
+
+def synthesize_hits(hashes_count: int, duration_s: float, seed=0, contents=50) -> dict[int, list[tuple[int, int]]]:
+    """
+    Generates DB matches in the 'find_durations' format: one content matches along a diagonal with jitter,
+    the others get random hits.
+
+    :param hashes_count: total number of hits.
+    :param duration_s: duration of the query in seconds.
+    :param seed: random generator seed.
+    :param contents: number of content ids.
+    :return: dictionary id_content -> list of (db time, local time) in milliseconds.
+    """
+    rng = np.random.default_rng(seed)
+    duration_ms = int(duration_s * 1000)
+
+    matched = hashes_count // 2
+    local = np.sort(rng.integers(0, duration_ms, matched))
+    db = local + 120000 + rng.integers(-40, 40, matched)
+
+    dict_audio = {1: list(zip(db.tolist(), local.tolist()))}
+
+    noise_ids = rng.integers(2, contents + 2, hashes_count - matched)
+    noise_db = rng.integers(0, duration_ms * 4, hashes_count - matched)
+    noise_local = rng.integers(0, duration_ms, hashes_count - matched)
+    for id_content, db_time, local_time in zip(noise_ids.tolist(), noise_db.tolist(), noise_local.tolist()):
+        dict_audio.setdefault(id_content, []).append((db_time, local_time))
+
+    return dict_audio
+
+
+def measure(function, repeat: int) -> dict:
+    """
+    Runs the function 'repeat' times and returns the best CPU and wall times, then runs it once more
+    under tracemalloc for the peak traced memory: tracing slows allocations down, so timed runs are not traced.
+    """
+    best_cpu = best_wall = float('inf')
+    result = None
+
+    for _ in range(repeat):
+        gc.collect()
+        cpu_start, wall_start = process_time(), perf_counter()
+
+        result = function()
+
+        cpu, wall = process_time() - cpu_start, perf_counter() - wall_start
+        best_cpu, best_wall = min(best_cpu, cpu), min(best_wall, wall)
+
+    result = None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'cpu_s': best_cpu, 'wall_s': best_wall, 'peak_bytes': peak_bytes}, result
+
+
+def run_case(kind: str, duration_s: float, sample_rate: int, repeat: int) -> dict:
+    """
+    Benchmarks every stage and the end-to-end fingerprinting for one synthetic signal.
+    """
+    samples = synthesize(kind, duration_s, sample_rate)
+    duration_ms = int(duration_s * 1000)
+    stages = {}
+
+    stages['stft'], (spectrogram, _, _, _) = measure(lambda: compute_log_spectrogram(samples, sample_rate), repeat)
+    stages['peak_picking'], peaks = measure(lambda: pick_peaks(spectrogram), repeat)
+    coordinates = np.column_stack(peaks)
+    stages['pairing'], pairs = measure(lambda: make_pairs(coordinates), repeat)
+    stages['hashing'], hashes = measure(lambda: generate_hashes(pairs, duration_ms), repeat)
+
+    dict_audio = synthesize_hits(max(len(hashes), 1000), duration_s)
+    stages['duration_finding'], _ = measure(lambda: find_durations(dict_audio), repeat)
+
+    # 'detect_audio' passes the hits as arrays
+    hits = (np.repeat(np.array(list(dict_audio.keys())), [len(values) for values in dict_audio.values()]),
+            *np.concatenate([np.array(values).reshape(-1, 2) for values in dict_audio.values()]).T)
+    stages['duration_finding_arrays'], _ = measure(lambda: find_durations_arrays(*hits), repeat)
+
+    stages['end_to_end'], _ = measure(lambda: create_audio_hashes(samples, sample_rate), repeat)
+
+    chunks = [samples[start:start + STREAM_CHUNK_SAMPLES] for start in range(0, len(samples), STREAM_CHUNK_SAMPLES)]
+    stages['end_to_end_streaming'], _ = measure(lambda: create_audio_hashes_streaming(lambda: iter(chunks),
+                                                                                      sample_rate), repeat)
+
+    for stage in stages.values():
+        stage['audio_s_per_cpu_s'] = duration_s / stage['cpu_s'] if stage['cpu_s'] > 0 else float('inf')
+
+    return {
+        'signal': kind,
+        'duration_s': duration_s,
+        'sample_rate': sample_rate,
+        'counts': {'frames': int(spectrogram.shape[0]), 'peaks': int(len(peaks[0])), 'pairs': int(len(pairs[0])),
+                   'hashes': len(hashes)},
+        'stages': stages,
+    }
+
+
+def case_key(case: dict) -> str:
+    return f'{case["signal"]}/{case["duration_s"]:g}s/{case["sample_rate"]}Hz'
+
+
+def print_results(cases: list[dict]):
+    print(f'{"case":<28}{"stage":<22}{"cpu s":>10}{"audio s/cpu s":>16}{"peak MiB":>10}')
+    for case in cases:
+        for name, stage in case['stages'].items():
+            print(f'{case_key(case):<28}{name:<22}{stage["cpu_s"]:>10.4f}{stage["audio_s_per_cpu_s"]:>16.1f}'
+                  f'{stage["peak_bytes"] / (1 << 20):>10.1f}')
+
+
+def compare(baseline_path: str, current_path: str):
+    """
+    Prints the throughput and memory ratio (current / baseline) of two saved runs.
+    """
+    with open(baseline_path) as f:
+        baseline = {case_key(case): case for case in json.load(f)['cases']}
+    with open(current_path) as f:
+        current = {case_key(case): case for case in json.load(f)['cases']}
+
+    print(f'{"case":<28}{"stage":<22}{"speedup":>10}{"memory":>10}')
+    for key in sorted(baseline.keys() & current.keys()):
+        for name, stage in current[key]['stages'].items():
+            base = baseline[key]['stages'].get(name)
+            if base is None:
+                continue
+
+            speedup = base['cpu_s'] / stage['cpu_s'] if stage['cpu_s'] > 0 else float('inf')
+            memory = stage['peak_bytes'] / base['peak_bytes'] if base['peak_bytes'] > 0 else float('inf')
+            print(f'{key:<28}{name:<22}{speedup:>9.2f}x{memory:>9.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Audio fingerprint micro-benchmarks (offline, no database).')
+    parser.add_argument('--lengths', type=float, nargs='+', default=DEFAULT_LENGTHS_S, help='durations in seconds')
+    parser.add_argument('--sample-rates', type=int, nargs='+', default=DEFAULT_SAMPLE_RATES)
+    parser.add_argument('--signals', nargs='+', default=SIGNALS, choices=SIGNALS)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the best is reported')
+    parser.add_argument('--output', help='path to save results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help='compare two saved runs')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    cases = [run_case(kind, duration_s, sample_rate, args.repeat)
+             for sample_rate in args.sample_rates for duration_s in args.lengths for kind in args.signals]
+
+    print_results(cases)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': sys.version, 'numpy': np.__version__, 'machine': platform.platform(),
+                       'cases': cases}, f, indent=2)
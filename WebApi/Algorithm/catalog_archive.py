@@ -0,0 +1,372 @@
+import os
+import json
+import zlib
+import struct
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import numpy as np
+
+from Algorithm.db_service import DBService
+from Algorithm.db_utilities import load_config
+from Algorithm.default_logger import logger
+
+ARCHIVE_MAGIC = b'XKCATLG1'
+ARCHIVE_VERSION = 1
+FOOTER_STRUCT = struct.Struct('<QI8s')  # footer length, footer CRC-32, magic
+
+# Rows per chunk: a chunk is the unit of compression, checksum and parallel import
+CHUNK_ROWS = 1 << 20
+COMPRESSION_LEVEL = 6
+# Chunks compressed in the background while the next rows are read
+EXPORT_PENDING_CHUNKS = 4
+IMPORT_WORKERS = 4
+
+# Columns of the exported tables and their types in the archive ('json' - variable-length values with NULLs)
+CONTENT_COLUMNS = [('id', '<i4'), ('title', 'json'), ('duration', 'json')]
+TABLE_COLUMNS = {
+    'snapshot_audio': [('id_content', '<i4'), ('timestamp', '<i4'), ('hash', 'hash')],
+    'fingerprint_video_packed': [('id_content', '<i4'), ('timestamp', '<i4'), ('size', '<i4'), ('fingerprint', 'bytea')],
+    'fingerprint_video': [('id_content', '<i4'), ('column', '<i4'), ('row', '<i4'), ('timestamp', '<i4')],
+}
+
+
+class ArchiveError(ValueError):
+    """
+    The archive is damaged or has an unsupported format.
+    """
+
+
+def encode_column(values, kind: str) -> tuple[str, bytes]:
+    """
+    Converts column values to bytes.
+
+    :param values: column values (one per row).
+    :param kind: numpy dtype string, 'hash' (bigint or fixed-length text), 'bytea' (fixed-length in a chunk)
+        or 'json'.
+    :return: dtype string stored in the archive and the data.
+    """
+    if kind == 'json':
+        return 'json', json.dumps(list(values), ensure_ascii=False).encode()
+
+    if kind == 'hash':
+        column = np.asarray(values)
+        column = column.astype(bytes) if column.dtype.kind in 'US' else column.astype('<i8')
+    elif kind == 'bytea':
+        values = [bytes(value) for value in values]
+        column = np.frombuffer(b''.join(values), dtype=f'V{len(values[0])}') if values else np.empty(0, 'V1')
+    else:
+        column = np.asarray(values, dtype=kind)
+
+    return column.dtype.str, column.tobytes()
+
+
+def decode_column(data: bytes, dtype: str):
+    """
+    :return: column values (numpy array or list for 'json' columns).
+    """
+    if dtype == 'json':
+        return json.loads(data)
+
+    return np.frombuffer(data, dtype=np.dtype(dtype))
+
+
+class ArchiveWriter:
+    """
+    Writes a catalog archive: chunks of compressed columns followed by a JSON footer
+    with the chunk positions and CRC-32 checksums of the uncompressed columns.
+    Columns are compressed in background threads (zlib releases the GIL).
+    """
+
+    def __init__(self, path: str, level=COMPRESSION_LEVEL, pending=EXPORT_PENDING_CHUNKS):
+        self.path = path
+        self.level = level
+        self.file = open(path, 'wb')
+        self.file.write(ARCHIVE_MAGIC)
+        self.chunks = []
+        self.executor = ThreadPoolExecutor(max_workers=pending, thread_name_prefix='archive-compress')
+        self.pending = deque()
+        self.max_pending = pending
+
+    def compress(self, table: str, columns: list[tuple[str, str, bytes]], rows: int) -> tuple:
+        return table, rows, [(name, dtype, zlib.crc32(data), len(data), zlib.compress(data, self.level))
+                             for name, dtype, data in columns]
+
+    def write_chunk(self, table: str, column_names: list[str], kinds: list[str], values: list, rows: int):
+        """
+        Queues a chunk; the oldest chunks are written once they are compressed.
+
+        :param values: column values, one list per column.
+        """
+        columns = [(name, *encode_column(column, kind)) for name, kind, column in zip(column_names, kinds, values)]
+        self.pending.append(self.executor.submit(self.compress, table, columns, rows))
+
+        while len(self.pending) >= self.max_pending:
+            self.flush_one()
+
+    def flush_one(self):
+        table, rows, columns = self.pending.popleft().result()
+
+        chunk = {'table': table, 'rows': rows, 'columns': []}
+        for name, dtype, crc, length, compressed in columns:
+            chunk['columns'].append({'name': name, 'dtype': dtype, 'offset': self.file.tell(),
+                                     'size': len(compressed), 'length': length, 'crc32': crc})
+            self.file.write(compressed)
+
+        self.chunks.append(chunk)
+
+    def close(self) -> dict:
+        """
+        Writes the remaining chunks and the footer.
+
+        :return: footer (the archive table of contents).
+        """
+        while self.pending:
+            self.flush_one()
+        self.executor.shutdown()
+
+        footer = {'version': ARCHIVE_VERSION, 'chunks': self.chunks}
+        data = json.dumps(footer).encode()
+
+        self.file.write(data)
+        self.file.write(FOOTER_STRUCT.pack(len(data), zlib.crc32(data), ARCHIVE_MAGIC))
+        self.file.close()
+
+        return footer
+
+    def abort(self):
+        """
+        Removes an unfinished archive.
+        """
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+        self.file.close()
+        os.remove(self.path)
+
+
+def read_footer(path: str) -> dict:
+    """
+    Reads and checks the archive table of contents.
+
+    :raises ArchiveError: if the archive is damaged.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            raise ArchiveError(f'{path} is not a catalog archive')
+
+        f.seek(-FOOTER_STRUCT.size, os.SEEK_END)
+        length, crc, magic = FOOTER_STRUCT.unpack(f.read(FOOTER_STRUCT.size))
+        if magic != ARCHIVE_MAGIC:
+            raise ArchiveError(f'{path}: the archive is truncated')
+
+        f.seek(-FOOTER_STRUCT.size - length, os.SEEK_END)
+        data = f.read(length)
+
+    if zlib.crc32(data) != crc:
+        raise ArchiveError(f'{path}: footer checksum mismatch')
+
+    footer = json.loads(data)
+    if footer['version'] != ARCHIVE_VERSION:
+        raise ArchiveError(f'{path}: unsupported archive version {footer["version"]}')
+
+    return footer
+
+
+def read_chunk(fd: int, chunk: dict) -> list:
+    """
+    Reads, decompresses and checks the columns of a chunk.
+
+    :param fd: descriptor of the archive file (read with 'pread', so it is shared by threads).
+    :return: column values.
+    :raises ArchiveError: if a checksum does not match.
+    """
+    values = []
+
+    for column in chunk['columns']:
+        try:
+            data = zlib.decompress(os.pread(fd, column['size'], column['offset']))
+        except zlib.error as error:
+            raise ArchiveError(f'{chunk["table"]}.{column["name"]}: {error}') from error
+
+        if len(data) != column['length'] or zlib.crc32(data) != column['crc32']:
+            raise ArchiveError(f'{chunk["table"]}.{column["name"]}: chunk checksum mismatch')
+
+        values.append(decode_column(data, column['dtype']))
+
+    return values
+
+
+def export_table(writer: ArchiveWriter, db_service_: DBService, table: str, columns: list[tuple[str, str]],
+                 chunk_rows: int, conn=None) -> int:
+    """
+    Writes all rows of the table to the archive in chunks.
+    'bytea' values of different length go to different chunks, so the columns stay fixed-size.
+
+    :param conn: connection of the export transaction (see 'DBService.read_snapshot').
+    :return: number of rows.
+    """
+    column_names = [name for name, _ in columns]
+    kinds = [kind for _, kind in columns]
+    bytea_idx = kinds.index('bytea') if 'bytea' in kinds else None
+
+    buffers = {}  # value length of the 'bytea' column (None without it) -> rows
+    count = 0
+
+    for rows in db_service_.iter_rows(table, column_names, conn=conn):
+        if bytea_idx is None:
+            groups = {None: rows}
+        else:
+            groups = {}
+            for row in rows:
+                groups.setdefault(len(row[bytea_idx]), []).append(row)
+
+        for key, group in groups.items():
+            buffer = buffers.setdefault(key, [])
+            buffer.extend(group)
+
+            while len(buffer) >= chunk_rows:
+                writer.write_chunk(table, column_names, kinds, list(zip(*buffer[:chunk_rows])), chunk_rows)
+                del buffer[:chunk_rows]
+
+        count += len(rows)
+
+    for buffer in buffers.values():
+        if buffer:
+            writer.write_chunk(table, column_names, kinds, list(zip(*buffer)), len(buffer))
+
+    return count
+
+
+def export_catalog(db_service_: DBService, path: str, chunk_rows=CHUNK_ROWS, level=COMPRESSION_LEVEL) -> dict:
+    """
+    Exports the catalog ('content', audio snapshots and video fingerprints) to an archive.
+    All tables are read in one REPEATABLE READ transaction, so the archive is a consistent snapshot
+    even if ingestion or deletion is running.
+
+    :param db_service_: Database access object
+    :param path: archive file
+    :param chunk_rows: maximum number of rows in a chunk
+    :param level: zlib compression level
+    :return: number of exported rows by table
+    """
+    start = time()
+    writer = ArchiveWriter(path, level)
+    counts = {}
+
+    try:
+        with db_service_.read_snapshot() as conn:
+            for table, columns in TABLE_COLUMNS.items():
+                counts[table] = export_table(writer, db_service_, table, columns, chunk_rows, conn)
+                logger.info(f'exported {table}: {counts[table]} rows; time: {time() - start} seconds')
+
+            counts['content'] = export_table(writer, db_service_, 'content', CONTENT_COLUMNS, chunk_rows, conn)
+
+        writer.close()
+
+    except Exception:
+        writer.abort()
+        raise
+
+    logger.info(f'catalog exported to {path}: {counts}; size: {os.path.getsize(path)} bytes; '
+                f'time: {time() - start} seconds')
+    return counts
+
+
+def import_chunk(db_service_: DBService, fd: int, chunk: dict) -> int:
+    values = read_chunk(fd, chunk)
+    column_names = [column['name'] for column in chunk['columns']]
+
+    return db_service_.copy_rows(chunk['table'], column_names, values)
+
+
+def import_catalog(config: dict, path: str, workers=IMPORT_WORKERS) -> dict:
+    """
+    Loads an archive into an empty catalog. Contents are inserted first with their ids,
+    then chunks of the other tables are checked and loaded with binary COPY by 'workers' connections in parallel.
+    If the import fails, the inserted contents and their rows are deleted, so the catalog stays empty.
+    The audio hash index (if used) should be rebuilt afterwards.
+
+    :param config: connection parameters
+    :param path: archive file
+    :param workers: number of parallel loads
+    :return: number of imported rows by table
+    :raises ArchiveError: if the archive is damaged.
+    """
+    start = time()
+    footer = read_footer(path)
+    db_service_ = DBService(workers, workers, config)
+
+    counts = {}
+    imported_ids = []  # contents inserted so far: the rows to delete if the import fails
+    fd = os.open(path, os.O_RDONLY)
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='archive-import')
+
+    try:
+        contents = [chunk for chunk in footer['chunks'] if chunk['table'] == 'content']
+        for chunk in contents:
+            ids, titles, durations = read_chunk(fd, chunk)
+            counts['content'] = counts.get('content', 0) + db_service_.import_contents(ids.tolist(), titles, durations)
+            imported_ids.extend(ids.tolist())
+
+        chunks = [chunk for chunk in footer['chunks'] if chunk['table'] != 'content']
+        for chunk, count in zip(chunks, executor.map(lambda item: import_chunk(db_service_, fd, item), chunks)):
+            counts[chunk['table']] = counts.get(chunk['table'], 0) + count
+
+        executor.shutdown()
+
+    except Exception as ex:
+        # No chunk may be loaded after the cleanup
+        executor.shutdown(cancel_futures=True)
+
+        if imported_ids:
+            logger.error(f'import of {path} failed: {ex}; deleting {len(imported_ids)} imported contents')
+            db_service_.cascade_delete_contents(imported_ids)
+        raise
+
+    finally:
+        os.close(fd)
+        db_service_.close()
+
+    logger.info(f'catalog imported from {path}: {counts}; time: {time() - start} seconds')
+    return counts
+
+
+def verify_archive(path: str) -> dict:
+    """
+    Checks all chunk checksums.
+
+    :return: number of rows by table.
+    :raises ArchiveError: if the archive is damaged.
+    """
+    counts = {}
+    fd = os.open(path, os.O_RDONLY)
+
+    try:
+        for chunk in read_footer(path)['chunks']:
+            read_chunk(fd, chunk)
+            counts[chunk['table']] = counts.get(chunk['table'], 0) + chunk['rows']
+    finally:
+        os.close(fd)
+
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Catalog export and import.')
+    parser.add_argument('command', choices=('export', 'import', 'verify'))
+    parser.add_argument('path', help='archive file')
+    parser.add_argument('--workers', type=int, default=IMPORT_WORKERS, help='parallel loads (import)')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='rows per chunk (export)')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_catalog(DBService(1, 1, load_config()), args.path, args.chunk_rows)
+
+    elif args.command == 'import':
+        import_catalog(load_config(), args.path, args.workers)
+
+    else:
+        logger.info(f'{args.path} is valid: {verify_archive(args.path)}')
@@ -0,0 +1,71 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+DEFAULT_CONTENT_CACHE_SIZE = 10000
+DEFAULT_CONTENT_CACHE_TTL_S = 300.0
+
+
+class ContentCache:
+    """
+    Thread-safe in-process cache of 'content' rows (id -> (title, duration)) with a time to live
+    and least recently used eviction.
+    """
+
+    def __init__(self, max_entries=DEFAULT_CONTENT_CACHE_SIZE, ttl_s=DEFAULT_CONTENT_CACHE_TTL_S):
+        """
+        :param max_entries: maximum number of cached rows.
+        :param ttl_s: time in seconds after which a row is read from the database again.
+        """
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.entries = OrderedDict()  # id -> (expiration time, (title, duration))
+        self.lock = threading.Lock()
+
+    def get_many(self, ids) -> tuple[dict[int, tuple[str, int]], list[int]]:
+        """
+        Looks up content rows.
+
+        :param ids: content ids.
+        :return: tuple (dictionary id -> (title, duration) of cached rows, list of ids that are not cached).
+        """
+        found, missing = {}, []
+        now = monotonic()
+
+        with self.lock:
+            for id in dict.fromkeys(ids):
+                entry = self.entries.get(id)
+
+                if entry is None or entry[0] <= now:
+                    self.entries.pop(id, None)
+                    missing.append(id)
+                    continue
+
+                self.entries.move_to_end(id)
+                found[id] = entry[1]
+
+        return found, missing
+
+    def put_many(self, contents: dict[int, tuple[str, int]]):
+        """
+        Caches content rows.
+
+        :param contents: dictionary id -> (title, duration).
+        """
+        expires = monotonic() + self.ttl_s
+
+        with self.lock:
+            for id, data in contents.items():
+                self.entries[id] = (expires, data)
+                self.entries.move_to_end(id)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, id: int):
+        with self.lock:
+            self.entries.pop(id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,69 @@
+from time import time
+
+import numpy as np
+
+from Algorithm.db_service import DBService
+from Algorithm.db_utilities import load_config
+from Algorithm.default_logger import logger
+from Algorithm.video_fingerprint_pack import pack_fingerprints
+
+PACKED_TABLE = 'fingerprint_video_packed'
+TIMESTAMP_MIN, TIMESTAMP_MAX = -(1 << 31), (1 << 31) - 1
+
+
+def rows_to_fingerprints(rows: list[tuple[int, int, int]]) -> list[tuple[list[int], int]]:
+    """
+    Rebuilds fingerprints from 'fingerprint_video' rows.
+
+    :param rows: list of tuple (‘column’, ‘row’, ‘timestamp’) as returned by 'get_video_fingerprints_by_hash'.
+    :return: list with tuple (fingerprint data and fingerprint timestamp), ordered by time.
+    """
+    if not rows:
+        return []
+
+    data = np.array(rows, dtype=np.int64)
+    columns, values, timestamps = data[:, 0], data[:, 1], data[:, 2]
+
+    order = np.lexsort((columns, timestamps))
+    values, timestamps = values[order], timestamps[order]
+
+    starts = np.flatnonzero(np.r_[True, timestamps[1:] != timestamps[:-1]])
+    ends = np.r_[starts[1:], len(timestamps)]
+
+    return [(values[start:end].tolist(), int(timestamps[start])) for start, end in zip(starts, ends)]
+
+
+def convert_content(db_service_: DBService, id_content: int) -> int:
+    """
+    Converts video fingerprints of one content to the packed format.
+    Content that already has packed fingerprints is skipped, so the conversion can be resumed.
+
+    :param db_service_: Database access object
+    :param id_content: id content
+    :return: number of inserted fingerprints
+    """
+
+    if db_service_.count_content_rows(id_content, PACKED_TABLE) > 0:
+        logger.info(f'[{id_content}] already converted')
+        return 0
+
+    start = time()
+    fingerprints = rows_to_fingerprints(db_service_.get_video_fingerprints_by_hash(id_content, TIMESTAMP_MIN,
+                                                                                   TIMESTAMP_MAX))
+
+    count = db_service_.add_packed_video_fingerprints(id_content, *pack_fingerprints(fingerprints), replace=True)
+    logger.info(f'[{id_content}] converted {count} fingerprints; time: {time() - start} seconds')
+
+    return count
+
+
+if __name__ == '__main__':
+
+    config = load_config()
+    db_service = DBService(1, 1, config)
+
+    ids = db_service.get_video_fingerprint_content_ids()
+    logger.info(f'count contents: {len(ids)}')
+
+    for id_content in ids:
+        convert_content(db_service, id_content)
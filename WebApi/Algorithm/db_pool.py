@@ -0,0 +1,190 @@
+import threading
+from collections import deque
+from time import monotonic, perf_counter
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from Algorithm.default_logger import logger
+from Algorithm.metrics import metrics
+
+DEFAULT_POOL_TIMEOUT_S = 30.0
+# Idle connections older than this are checked with a query before they are handed out
+DEFAULT_HEALTH_CHECK_INTERVAL_S = 30.0
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """
+    No connection became available within the timeout.
+    """
+
+
+class BlockingConnectionPool:
+    """
+    Thread-safe connection pool. When all 'max_conn' connections are in use, 'getconn' waits for one
+    to be returned (up to 'timeout' seconds) instead of failing.
+    Connections are initialized once on creation; idle connections are health-checked before reuse,
+    and broken ones are replaced.
+    """
+
+    def __init__(self, min_conn: int, max_conn: int, timeout=DEFAULT_POOL_TIMEOUT_S,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL_S, **kwargs):
+        """
+        :param min_conn: number of connections opened at once.
+        :param max_conn: maximum number of connections.
+        :param timeout: default time to wait for a connection in seconds (None - wait forever).
+        :param health_check_interval: idle time in seconds after which a connection is checked before reuse.
+        :param kwargs: connection parameters passed to 'psycopg2.connect' (including 'connection_factory').
+        """
+        if not 0 <= min_conn <= max_conn or max_conn < 1:
+            raise ValueError('expected 0 <= min_conn <= max_conn and max_conn >= 1')
+
+        self.max_conn = max_conn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.kwargs = kwargs
+
+        self.condition = threading.Condition()
+        self.idle = deque()  # (connection, time of return to the pool)
+        self.used = set()
+        self.size = 0
+        self.closed = False
+
+        for _ in range(min_conn):
+            self.idle.append((self.connect(), monotonic()))
+            self.size += 1
+
+    def connect(self):
+        conn = psycopg2.connect(**self.kwargs)
+
+        initialize = getattr(conn, 'initialize', None)
+        if initialize is not None:  # logging connections
+            initialize(logger)
+
+        return conn
+
+    def is_healthy(self, conn, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+
+        if monotonic() - idle_since < self.health_check_interval:
+            return True
+
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, timeout=None):
+        """
+        Takes a connection from the pool, opening a new one if the pool is not full.
+
+        :param timeout: time to wait in seconds (by default - the pool timeout).
+        :return: connection.
+        :raises PoolTimeout: if no connection became available in time.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = perf_counter()
+        deadline = None if timeout is None else monotonic() + timeout
+
+        while True:
+            with self.condition:
+                while not self.idle and self.size >= self.max_conn and not self.closed:
+                    remaining = None if deadline is None else deadline - monotonic()
+                    if remaining is not None and remaining <= 0:
+                        metrics.observe_pool_timeout()
+                        raise PoolTimeout(f'no database connection available in {timeout} seconds')
+                    self.condition.wait(remaining)
+
+                if self.closed:
+                    raise psycopg2.pool.PoolError('connection pool is closed')
+
+                if self.idle:
+                    conn, idle_since = self.idle.pop()
+                else:
+                    conn, idle_since = None, None
+                    self.size += 1
+
+            # Connecting and health checks run outside the lock
+            if conn is None:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    self.discard(None)
+                    raise
+
+            elif not self.is_healthy(conn, idle_since):
+                logger.warning('discarding broken database connection')
+                self.discard(conn)
+                continue
+
+            with self.condition:
+                self.used.add(id(conn))
+
+            metrics.observe_pool_checkout(perf_counter() - start)
+            return conn
+
+    def putconn(self, conn, close=False):
+        """
+        Returns the connection to the pool. Closed (broken) connections are discarded.
+
+        :param conn: connection taken with 'getconn'.
+        :param close: close the connection instead of keeping it.
+        """
+        with self.condition:
+            if id(conn) not in self.used:
+                raise psycopg2.pool.PoolError('trying to put unkeyed connection')
+            self.used.discard(id(conn))
+
+        metrics.observe_pool_checkin()
+
+        if close or self.closed or conn.closed:
+            self.discard(conn)
+            return
+
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self.discard(conn)
+                return
+
+        with self.condition:
+            self.idle.append((conn, monotonic()))
+            self.condition.notify()
+
+    def discard(self, conn):
+        """
+        Closes the connection and frees its place in the pool.
+        """
+        if conn is not None and not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    def closeall(self):
+        """
+        Closes idle connections; connections in use are closed when they are returned.
+        """
+        with self.condition:
+            self.closed = True
+            idle, self.idle = list(self.idle), deque()
+            self.size -= len(idle)
+            self.condition.notify_all()
+
+        for conn, _ in idle:
+            if not conn.closed:
+                conn.close()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {'size': self.size, 'idle': len(self.idle), 'used': len(self.used), 'max': self.max_conn}
@@ -0,0 +1,230 @@
+import os
+from psycopg2 import sql
+
+# Number of hash partitions of 'snapshot_audio' (0 - a plain table). Used only when the table is created.
+SNAPSHOT_AUDIO_PARTITIONS = int(os.environ.get('SNAPSHOT_AUDIO_PARTITIONS', '0'))
+
+# Serializes concurrent migrations (several services or ingestion writers starting at once)
+SCHEMA_LOCK_ID = 0x786b37
+
+
+
+class SchemaError(RuntimeError):
+    """
+    The database has a layout that the migrations cannot adopt.
+    """
+
+
+VERSION_TABLE = """ CREATE TABLE IF NOT EXISTS schema_version (
+                        version integer PRIMARY KEY,
+                        description text NOT NULL,
+                        applied_at timestamptz NOT NULL DEFAULT now()
+                    );
+                """
+
+
+def create_content(partitions: int) -> list:
+    return [""" CREATE TABLE IF NOT EXISTS content (
+                    id serial PRIMARY KEY,
+                    title text NOT NULL,
+                    duration integer
+                );
+            """]
+
+
+def create_snapshot_audio(partitions: int, table='snapshot_audio') -> list:
+    """
+    'snapshot_audio' with packed (bigint) hashes. With partitions the table is partitioned by hash of 'hash':
+    a lookup touches only the partitions of its hashes, and every partition has its own small index and vacuum.
+
+    :param table: table name (another name - a table with the same layout, see 'DBService.swap_audio_snapshot_tables').
+    """
+    if partitions <= 0:
+        return [sql.SQL(""" CREATE TABLE IF NOT EXISTS {} (
+                                id bigserial PRIMARY KEY,
+                                id_content integer NOT NULL,
+                                timestamp integer NOT NULL,
+                                hash bigint NOT NULL
+                            );
+                        """).format(sql.Identifier(table))]
+
+    # The primary key of a partitioned table must include the partition key
+    statements = [sql.SQL(""" CREATE TABLE IF NOT EXISTS {} (
+                                  id bigserial,
+                                  id_content integer NOT NULL,
+                                  timestamp integer NOT NULL,
+                                  hash bigint NOT NULL,
+                                  PRIMARY KEY (hash, id)
+                              ) PARTITION BY HASH (hash);
+                          """).format(sql.Identifier(table))]
+
+    for remainder in range(partitions):
+        statements.append(sql.SQL(""" CREATE TABLE IF NOT EXISTS {} PARTITION OF {}
+                                      FOR VALUES WITH (MODULUS {}, REMAINDER {});
+                                  """).format(sql.Identifier(f'{table}_p{remainder}'), sql.Identifier(table),
+                                              sql.Literal(partitions), sql.Literal(remainder)))
+
+    return statements
+
+
+def create_snapshot_audio_indexes(partitions: int) -> list:
+    """
+    With partitions the primary key (hash, id) already serves lookups by hash, so only 'id_content' is indexed.
+    """
+    statements = [""" CREATE INDEX IF NOT EXISTS snapshot_audio_id_content_idx ON snapshot_audio (id_content); """]
+
+    if partitions <= 0:
+        statements.insert(0, """ CREATE INDEX IF NOT EXISTS snapshot_audio_hash_idx ON snapshot_audio (hash); """)
+
+    return statements
+
+
+def create_fingerprint_video(partitions: int) -> list:
+    return [""" CREATE TABLE IF NOT EXISTS fingerprint_video (
+                    "column" integer NOT NULL,
+                    row integer NOT NULL,
+                    id_content integer NOT NULL,
+                    timestamp integer NOT NULL
+                );
+            """,
+            """ CREATE INDEX IF NOT EXISTS fingerprint_video_id_content_timestamp_idx
+                ON fingerprint_video (id_content, timestamp);
+            """]
+
+
+def create_fingerprint_video_packed(partitions: int) -> list:
+    """
+    One row per video fingerprint: the numbers of the fingerprint packed into a bit string
+    ('size' numbers of FINGERPRINT_VALUE_BITS bits, padded to 64-bit words).
+    """
+    return [""" CREATE TABLE IF NOT EXISTS fingerprint_video_packed (
+                    id_content integer NOT NULL,
+                    timestamp integer NOT NULL,
+                    size integer NOT NULL,
+                    fingerprint bytea NOT NULL
+                );
+            """,
+            """ CREATE INDEX IF NOT EXISTS fingerprint_video_packed_id_content_timestamp_idx
+                ON fingerprint_video_packed (id_content, timestamp);
+            """]
+
+
+def create_audio_hash_stats(partitions: int) -> list:
+    """
+    Numbers of snapshots of popular hashes, refreshed from 'snapshot_audio' (see 'DBService.refresh_hash_stats').
+    """
+    return [""" CREATE TABLE IF NOT EXISTS audio_hash_stats (
+                    hash bigint PRIMARY KEY,
+                    snapshots integer NOT NULL
+                );
+            """]
+
+
+# Applied in order; a migration is never changed after release, new changes get a new version.
+# Tables are created with 'IF NOT EXISTS', so databases that were set up by hand are adopted as they are,
+# except a 'snapshot_audio' with SHA-256 (text) hashes (see 'check_snapshot_audio_hash')
+# and a plain 'snapshot_audio' when partitions are requested (see 'check_snapshot_audio_partitions').
+MIGRATIONS = [
+    (1, 'content table', create_content),
+    (2, 'snapshot_audio table', create_snapshot_audio),
+    (3, 'snapshot_audio indexes on hash and id_content', create_snapshot_audio_indexes),
+    (4, 'fingerprint_video table with (id_content, timestamp) index', create_fingerprint_video),
+    (5, 'fingerprint_video_packed table', create_fingerprint_video_packed),
+    (6, 'audio_hash_stats table', create_audio_hash_stats),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+SNAPSHOT_AUDIO_INDEXES_VERSION = 3
+
+
+def get_schema_version(cur) -> int:
+    """
+    Returns the version of the database schema (0 - no migrations were applied).
+    """
+    cur.execute(VERSION_TABLE)
+    cur.execute(""" SELECT coalesce(max(version), 0) FROM schema_version; """)
+
+    return cur.fetchone()[0]
+
+
+def check_snapshot_audio_hash(cur):
+    """
+    Checks that an existing 'snapshot_audio' has packed (bigint) hashes.
+
+    :raises SchemaError: if the table has SHA-256 (text) hashes: the packed inserts and hash statistics would fail.
+    """
+    cur.execute(""" SELECT data_type
+                    FROM information_schema.columns
+                    WHERE table_schema = current_schema() AND table_name = 'snapshot_audio' AND column_name = 'hash';
+                """)
+    row = cur.fetchone()
+
+    if row is not None and row[0] != 'bigint':
+        raise SchemaError(f'snapshot_audio.hash is {row[0]} (SHA-256 hashes), the schema requires packed bigint hashes: '
+                          f're-fingerprint the catalog with "python -m Algorithm.migrate_audio_hashes <data.txt> --swap"')
+
+
+def check_snapshot_audio_partitions(cur, partitions: int) -> int:
+    """
+    Checks that an existing 'snapshot_audio' has the requested layout.
+
+    :param partitions: requested number of hash partitions (0 - a plain table).
+    :return: number of partitions for the migrations: 'partitions' if the table does not exist,
+        otherwise the number of partitions of the existing table (0 - a plain table).
+    :raises SchemaError: if partitions are requested and the existing table is plain: a table cannot be
+        partitioned in place.
+    """
+    cur.execute(""" SELECT parent.relkind = 'p', (SELECT count(*) FROM pg_inherits WHERE inhparent = parent.oid)
+                    FROM pg_class parent
+                    WHERE parent.relname = 'snapshot_audio' AND parent.relnamespace = current_schema()::regnamespace;
+                """)
+    row = cur.fetchone()
+
+    if row is None:
+        return partitions
+
+    partitioned, existing = row
+    if partitioned:
+        return existing
+
+    if partitions > 0:
+        raise SchemaError(f'SNAPSHOT_AUDIO_PARTITIONS is {partitions}, but snapshot_audio is a plain table: '
+                          f'unset it or reload the catalog into a new database '
+                          f'(see "python -m Algorithm.catalog_archive")')
+
+    return 0
+
+
+def apply_migrations(cur, partitions=SNAPSHOT_AUDIO_PARTITIONS) -> list[int]:
+    """
+    Applies the migrations that are missing in the database. Must run in one transaction:
+    either all missing migrations are applied or none.
+
+    :param cur: cursor.
+    :param partitions: number of hash partitions of 'snapshot_audio' if the table is created.
+    :return: versions of the applied migrations.
+    :raises SchemaError: if 'snapshot_audio' has SHA-256 hashes or is not partitioned as requested
+        (nothing is applied).
+    """
+    cur.execute(""" SELECT pg_advisory_xact_lock(%s); """, (SCHEMA_LOCK_ID,))
+    check_snapshot_audio_hash(cur)
+
+    current = get_schema_version(cur)
+    applied = []
+
+    # The layout of 'snapshot_audio' matters only to its own migrations
+    if current < SNAPSHOT_AUDIO_INDEXES_VERSION:
+        partitions = check_snapshot_audio_partitions(cur, partitions)
+
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+
+        for statement in statements(partitions):
+            cur.execute(statement)
+
+        cur.execute(""" INSERT INTO schema_version(version, description) VALUES (%s, %s); """,
+                    (version, description))
+        applied.append(version)
+
+    return applied
@@ -1,14 +1,31 @@
 import time
+from collections.abc import Iterator
+from contextlib import contextmanager
 import numpy
-import psycopg2.pool
 import psycopg2
-from psycopg2.extras import execute_values
+from psycopg2 import sql
 from psycopg2.extras import LoggingConnection, LoggingCursor
 from psycopg2.extensions import register_adapter, AsIs
+from Algorithm.content_cache import ContentCache
+from Algorithm.db_pool import BlockingConnectionPool, DEFAULT_POOL_TIMEOUT_S
+from Algorithm.db_schema import apply_migrations, create_snapshot_audio, SchemaError, SNAPSHOT_AUDIO_PARTITIONS
 from Algorithm.default_logger import logger
+from Algorithm.pg_copy import BinaryCopyStream, COPY_READ_SIZE
+from Algorithm.video_fingerprint_pack import FINGERPRINT_WORD_DTYPE
 
 register_adapter(numpy.int64, AsIs)
 
+# Lookups with more distinct hashes load them into a temporary table with COPY instead of an array parameter
+LOOKUP_ARRAY_MAX_HASHES = 10000
+# Rows fetched from the server-side cursor at a time
+LOOKUP_BATCH_ROWS = 50000
+
+# Hashes with fewer snapshots are not kept in 'audio_hash_stats'
+HASH_STATS_MIN_SNAPSHOTS = 16
+
+# Word type of packed video fingerprints
+PACKED_WORD_DTYPE = FINGERPRINT_WORD_DTYPE
+
 
 class MyLoggingCursor(LoggingCursor):
     def execute(self, query, vars=None):
@@ -30,21 +47,33 @@ class MyLoggingConnection(LoggingConnection):
         return LoggingConnection.cursor(self, *args, **kwargs)
 
 
+def fetch_all_rows(conn, query, name: str, batch_size: int) -> Iterator[list[tuple]]:
+    """
+    Runs the query through a server-side cursor.
+
+    :return: iterator over lists of rows.
+    """
+    with conn.cursor(name=name) as cur:
+        cur.itersize = batch_size
+        cur.execute(query)
+
+        while rows := cur.fetchmany(batch_size):
+            yield rows
+
+
 class ConnectionFromPool:
     """
     Context Manager issues a connection from the pool.
     In case of an error, cancels the transaction.
     """
 
-    def __init__(self, pool: psycopg2.pool.AbstractConnectionPool):
+    def __init__(self, pool: BlockingConnectionPool):
         self.pool = pool
         self.conn = None
         self.exception = None
 
     def __enter__(self):
         self.conn = self.pool.getconn()
-        if self.conn is not None:
-            self.conn.initialize(logger)
         return self.conn
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -52,8 +81,12 @@ class ConnectionFromPool:
         if exc_type is not None:
             self.exception = exc_val
 
-            if self.conn:
-                self.conn.rollback()
+            # A broken connection cannot be rolled back; the pool discards it
+            if self.conn and not self.conn.closed:
+                try:
+                    self.conn.rollback()
+                except psycopg2.Error:
+                    pass
 
             self.pool.putconn(self.conn)
 
@@ -67,17 +100,138 @@ class ConnectionFromPool:
             return True
 
 
+def copy_binary(cur, table: str, column_names: list[str], columns: list[numpy.ndarray]) -> int:
+    """
+    Loads rows into the table with 'COPY ... FROM STDIN' in the binary format.
+
+    :param cur: cursor.
+    :param table: table name.
+    :param column_names: names of the table columns.
+    :param columns: arrays of values, one per column (see 'BinaryCopyStream').
+    :return: number of loaded rows.
+    """
+
+    query = sql.SQL(""" COPY {} ({}) FROM STDIN WITH (FORMAT binary) """).format(
+        sql.Identifier(table), sql.SQL(', ').join(map(sql.Identifier, column_names)))
+
+    cur.copy_expert(query.as_string(cur), BinaryCopyStream(columns), size=COPY_READ_SIZE)
+
+    # COPY is all-or-nothing: if the server does not report the count, all rows were loaded
+    return cur.rowcount if cur.rowcount >= 0 else len(columns[0])
+
+
+def hash_column(hashes) -> numpy.ndarray:
+    """
+    Converts hashes to a 'snapshot_audio.hash' column: bigint (packed hashes) or text (SHA-256 hex digests).
+    """
+    hashes = numpy.asarray(hashes)
+    if hashes.dtype.kind in 'US':
+        return hashes.astype(bytes)
+
+    return hashes.astype(numpy.int64, copy=False)
+
+
+def audio_snapshot_columns(id_content, timestamps, hashes) -> list[numpy.ndarray]:
+    """
+    Converts audio snapshots to 'snapshot_audio' columns: id_content and timestamp are integer,
+    hash is bigint (packed hashes) or text (SHA-256 hex digests).
+    """
+    hashes = hash_column(hashes)
+
+    return [numpy.broadcast_to(numpy.asarray(id_content, dtype=numpy.int32), hashes.shape),
+            numpy.asarray(timestamps, dtype=numpy.int32), hashes]
+
+
+def frequencies_of(hashes: numpy.ndarray, rows) -> numpy.ndarray:
+    """
+    Converts 'audio_hash_stats' rows (hash, snapshots) to frequencies of the hashes (0 for hashes without a row).
+    """
+    frequencies = numpy.zeros(len(hashes), dtype=numpy.int64)
+    if not rows:
+        return frequencies
+
+    known, snapshots = (numpy.array(column, dtype=numpy.int64) for column in zip(*rows))
+    order = numpy.argsort(known)
+    known, snapshots = known[order], snapshots[order]
+
+    positions = numpy.minimum(numpy.searchsorted(known, hashes), len(known) - 1)
+    found = known[positions] == hashes
+    frequencies[found] = snapshots[positions[found]]
+
+    return frequencies
+
+
+def packed_video_fingerprints_from_rows(rows) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """
+    Converts rows ('timestamp', 'size', 'fingerprint') of 'fingerprint_video_packed' to numpy arrays:
+    timestamps, packed fingerprints (uint64 words, one row per fingerprint) and numbers of values in fingerprints.
+    """
+    timestamps = numpy.fromiter((row[0] for row in rows), dtype=numpy.int32, count=len(rows))
+    sizes = numpy.fromiter((row[1] for row in rows), dtype=numpy.int32, count=len(rows))
+
+    words = max((len(row[2]) for row in rows), default=0) // PACKED_WORD_DTYPE.itemsize
+    fingerprints = numpy.zeros((len(rows), words), dtype=PACKED_WORD_DTYPE)
+    for idx, row in enumerate(rows):
+        values = numpy.frombuffer(row[2], dtype=PACKED_WORD_DTYPE)
+        fingerprints[idx, :len(values)] = values
+
+    return timestamps, fingerprints, sizes
+
+
 class DBService:
-    def __init__(self, min_conn: int, max_conn: int, config):
+    def __init__(self, min_conn: int, max_conn: int, config, migrate=True, pool_timeout=DEFAULT_POOL_TIMEOUT_S,
+                 hash_index=None):
         """
         Creates a service to work with the database. Uses the connection pool.
 
         :param min_conn: minimum number of connections.
         :param max_conn: the maximum number of connections.
         :param config: connection parameters.
+        :param migrate: create or update the database schema (see 'db_schema').
+        :param pool_timeout: time to wait for a free connection in seconds when all 'max_conn' are in use.
+        :param hash_index: 'AudioHashIndex' updated with the packed audio snapshots written to 'snapshot_audio'.
+        """
+        self.pool = BlockingConnectionPool(min_conn, max_conn, timeout=pool_timeout,
+                                           connection_factory=MyLoggingConnection, **config)
+        self.content_cache = ContentCache()
+        self.hash_index = hash_index
+
+        if migrate:
+            self.migrate_schema()
+
+    def close(self):
+        """
+        Closes all connections of the pool.
+        """
+        self.pool.closeall()
+
+    def migrate_schema(self, partitions=SNAPSHOT_AUDIO_PARTITIONS) -> bool:
+        """
+        Applies missing schema migrations: tables 'content', 'snapshot_audio', 'fingerprint_video' and their indexes.
+
+        :param partitions: number of hash partitions of 'snapshot_audio' if the table is created (0 - no partitions).
+        :return: boolean value that tells whether the schema is up to date.
+        :raises SchemaError: if the catalog has to be migrated to packed hashes first (see 'migrate_audio_hashes').
         """
-        self.pool = psycopg2.pool.SimpleConnectionPool(min_conn, max_conn,
-                                                       connection_factory=MyLoggingConnection, **config)
+
+        result = False
+
+        try:
+            with ConnectionFromPool(self.pool) as conn:
+                with conn.cursor() as cur:
+                    applied = apply_migrations(cur, partitions)
+                    if applied:
+                        logger.info(f'applied schema migrations: {applied}')
+                    result = True
+
+        except SchemaError as error:
+            logger.error(f'Exception: {error}')
+            raise
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'Exception: {error}')
+
+        return result
 
     def add_content(self, title, duration) -> int:
         """
@@ -103,6 +257,7 @@ class DBService:
                     rows = cur.fetchone()
                     if rows:
                         id = rows[0]
+                        self.content_cache.invalidate(id)
 
         except (Exception, psycopg2.DatabaseError) as error:
             logger.error(f'Exception: {error}')
@@ -110,6 +265,41 @@ class DBService:
         finally:
             return id
 
+    def import_contents(self, ids: list[int], titles: list[str], durations: list[int]) -> int:
+        """
+        Adds contents with the given ids (for example, from a catalog archive) and moves the id sequence
+        past them.
+
+        :param ids: content ids.
+        :param titles: titles of the contents.
+        :param durations: durations of the contents (None - unknown).
+        :return: number of inserted rows.
+        :raises psycopg2.DatabaseError: if the rows were not inserted (nothing is inserted in this case).
+        """
+
+        query = """ INSERT INTO content(id, title, duration)
+                    SELECT * FROM unnest(%s::integer[], %s::text[], %s::integer[]);
+                """
+
+        try:
+            with ConnectionFromPool(self.pool) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, (list(ids), list(titles), list(durations),))
+                    count = cur.rowcount
+
+                    cur.execute(""" SELECT setval(pg_get_serial_sequence('content', 'id'),
+                                                  GREATEST((SELECT max(id) FROM content), 1));
+                                """)
+
+            for id in ids:
+                self.content_cache.invalidate(id)
+
+            return count
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'Exception: {error}')
+            raise
+
     def get_content_by_id(self, id: int) -> tuple[str, int]:
         """
         Getting content data by id content.
@@ -118,21 +308,33 @@ class DBService:
         :return: content data (title and duration in seconds).
         """
 
-        query = """ SELECT title, duration
+        return self.get_contents_by_ids([id]).get(id)
+
+    def get_contents_by_ids(self, ids: list[int]) -> dict[int, tuple[str, int]]:
+        """
+        Getting content data of several contents in one query. Cached rows are not requested from the database.
+
+        :param ids: list of id content.
+        :return: dictionary id content -> content data (title and duration in seconds); unknown ids are omitted.
+        """
+
+        data, missing = self.content_cache.get_many(ids)
+        if not missing:
+            return data
+
+        query = """ SELECT id, title, duration
                     FROM content
-                    WHERE id = %s;
+                    WHERE id = ANY(%s);
                 """
 
-        data = None
-
         try:
             with ConnectionFromPool(self.pool) as conn:
                 with conn.cursor() as cur:
-                    cur.execute(query, (id,))
+                    cur.execute(query, ([int(id) for id in missing],))
 
-                    rows = cur.fetchone()
-                    if rows:
-                        data = rows[0:2]
+                    rows = {row[0]: row[1:3] for row in cur.fetchall()}
+                    self.content_cache.put_many(rows)
+                    data.update(rows)
 
         except (Exception, psycopg2.DatabaseError) as error:
             logger.error(f'Exception: {error}')
@@ -166,6 +368,7 @@ class DBService:
             logger.error(f'Exception: {error}')
 
         finally:
+            self.content_cache.invalidate(id)
             return result
 
     def cascade_delete_content_by_id(self, id: int) -> bool:
@@ -179,7 +382,8 @@ class DBService:
         """
 
         query = """ DELETE FROM snapshot_audio WHERE id_content = %s;
-                    DELETE FROM snapshot_video WHERE id_content = %s;
+                    DELETE FROM fingerprint_video WHERE id_content = %s;
+                    DELETE FROM fingerprint_video_packed WHERE id_content = %s;
                     DELETE FROM content WHERE id = %s;
                 """
         result = False
@@ -187,7 +391,7 @@ class DBService:
         try:
             with ConnectionFromPool(self.pool) as conn:
                 with conn.cursor() as cur:
-                    cur.execute(query, (id, id, id,))
+                    cur.execute(query, (id, id, id, id,))
 
                     if cur.rowcount > 0:
                         result = True
@@ -196,8 +400,54 @@ class DBService:
             logger.error(f'Exception: {error}')
 
         finally:
+            self.content_cache.invalidate(id)
+            if result and self.hash_index is not None:
+                self.update_hash_index(self.hash_index.remove_content, id)
             return result
 
+    def cascade_delete_contents(self, ids: list[int]) -> int:
+        """
+        Deletes contents and their rows in the child tables in one transaction
+        (for example, to undo a failed catalog import).
+
+        :param ids: id of the contents.
+        :return: number of deleted contents.
+        :raises psycopg2.DatabaseError: if the deletion failed (nothing is deleted).
+        """
+
+        query = """ DELETE FROM snapshot_audio WHERE id_content = ANY(%(ids)s);
+                    DELETE FROM fingerprint_video WHERE id_content = ANY(%(ids)s);
+                    DELETE FROM fingerprint_video_packed WHERE id_content = ANY(%(ids)s);
+                    DELETE FROM content WHERE id = ANY(%(ids)s);
+                """
+
+        try:
+            with ConnectionFromPool(self.pool) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, {'ids': ids})
+                    result = cur.rowcount
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'Exception: {error}')
+            raise
+
+        finally:
+            for id in ids:
+                self.content_cache.invalidate(id)
+
+        return result
+
+    def update_hash_index(self, update, *args, **kwargs):
+        """
+        Applies a change to the hash index. The database stays the source of truth: a failed update is logged
+        and the index can be rebuilt from 'snapshot_audio'.
+        """
+        try:
+            update(*args, **kwargs)
+
+        except Exception as error:
+            logger.error(f'Exception: hash index update failed: {error}')
+
     def add_audio_snapshot(self, id_content, timestamp, hash):
         """
         Adds a new audio snapshot with 'id_content', 'timestamp' and 'hash' fields.
@@ -230,30 +480,18 @@ class DBService:
         finally:
             return id
 
-    def add_audio_snapshots(self, data: list[tuple[int, int, str]]):
+    def add_audio_snapshots(self, data: list[tuple[int, int, str]]) -> int:
         """
         Adds a list of audio snapshot data.
 
         :param data: list with tuple ('id_content', 'timestamp' and 'hash').
-        :return: two values: id of the first inserted line and the number of inserted elements.
+        :return: number of inserted rows.
+        :raises psycopg2.DatabaseError: if the rows were not inserted (nothing is inserted in this case).
         """
 
-        query = """ INSERT INTO snapshot_audio(id_content, timestamp, hash)
-                    VALUES %s
-                """
+        id_contents, timestamps, hashes = zip(*data) if data else ((), (), numpy.empty(0, dtype=numpy.int64))
 
-        result = []
-
-        try:
-            with ConnectionFromPool(self.pool) as conn:
-                with conn.cursor() as cur:
-                    execute_values(cur, query, data, page_size=10000)
-
-        except (Exception, psycopg2.DatabaseError) as error:
-            logger.error(f'Exception: {error}')
-
-        finally:
-            return result
+        return self.copy_audio_snapshots(id_contents, hashes, timestamps)
 
     def get_audio_snapshots_by_hash(self, hash) -> list[tuple[int, int]]:
         """
@@ -291,75 +529,453 @@ class DBService:
 
         :param hashes: list of snapshot hash.
         :return: list of hashes from elements (‘id_content’, ‘timestamp’, ‘hash’).
+        :raises psycopg2.DatabaseError: if the search failed (a failed search is not "no matches").
         """
 
-        query = """ SELECT id_content, timestamp, hash
-                    FROM snapshot_audio
-                    WHERE hash IN %s
-                """
-
         data = []
 
+        for rows in self.iter_audio_snapshots_by_hashes(hashes):
+            data.extend(rows)
+
+        return data
+
+    def iter_audio_snapshots_by_hashes(self, hashes, batch_size=LOOKUP_BATCH_ROWS, table='snapshot_audio')\
+            -> Iterator[list[tuple[int, int, str]]]:
+        """
+        Performs a hash search and yields matches from the database in batches.
+
+        The distinct hashes are sent as one array parameter ('= ANY'); when there are more than
+        'LOOKUP_ARRAY_MAX_HASHES', they are loaded into a temporary table with binary COPY and joined.
+        Rows are read through a server-side cursor, so the client holds at most 'batch_size' rows at a time.
+        The connection is taken from the pool until the iteration ends.
+
+        :param hashes: snapshot hashes (packed int64 hashes or SHA-256 hex digests).
+        :param batch_size: maximum number of rows in a batch.
+        :param table: table with snapshots.
+        :return: iterator over lists of elements (‘id_content’, ‘timestamp’, ‘hash’).
+        :raises psycopg2.DatabaseError: if the search failed.
+        """
+
+        hashes = numpy.unique(hash_column(hashes))
+        if len(hashes) == 0:
+            return
+
+        try:
+            with ConnectionFromPool(self.pool) as conn:
+                if len(hashes) <= LOOKUP_ARRAY_MAX_HASHES:
+                    query = sql.SQL(""" SELECT id_content, timestamp, hash
+                                        FROM {}
+                                        WHERE hash = ANY(%s)
+                                    """).format(sql.Identifier(table))
+                    params = (hashes.astype(str).tolist() if hashes.dtype.kind == 'S' else hashes.tolist(),)
+
+                else:
+                    with conn.cursor() as cur:
+                        cur.execute(sql.SQL(""" CREATE TEMPORARY TABLE lookup_hashes ON COMMIT DROP AS
+                                                SELECT hash FROM {} WITH NO DATA;
+                                            """).format(sql.Identifier(table)))
+                        copy_binary(cur, 'lookup_hashes', ['hash'], [hashes])
+                        cur.execute(""" ANALYZE lookup_hashes; """)
+
+                    query = sql.SQL(""" SELECT s.id_content, s.timestamp, s.hash
+                                        FROM {} s
+                                        JOIN lookup_hashes USING (hash)
+                                    """).format(sql.Identifier(table))
+                    params = None
+
+                with conn.cursor(name='audio_snapshot_lookup') as cur:
+                    cur.itersize = batch_size
+                    cur.execute(query, params)
+
+                    while rows := cur.fetchmany(batch_size):
+                        yield rows
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'Exception: {error}')
+            raise
+
+    def refresh_hash_stats(self, min_snapshots=HASH_STATS_MIN_SNAPSHOTS) -> int:
+        """
+        Recounts popular hashes of 'snapshot_audio' into 'audio_hash_stats' in one transaction.
+
+        :param min_snapshots: hashes with fewer snapshots are not kept (their frequency is considered low).
+        :return: number of kept hashes.
+        :raises psycopg2.DatabaseError: if the statistics were not refreshed.
+        """
+
+        query = """ DELETE FROM audio_hash_stats;
+                    INSERT INTO audio_hash_stats(hash, snapshots)
+                    SELECT hash, count(*) FROM snapshot_audio GROUP BY hash HAVING count(*) >= %s;
+                """
+
         try:
             with ConnectionFromPool(self.pool) as conn:
                 with conn.cursor() as cur:
-                    cur.execute(query, (tuple(hashes),))
+                    cur.execute(query, (min_snapshots,))
+                    return cur.rowcount
 
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'Exception: {error}')
+            raise
+
+    def get_hash_frequencies(self, hashes) -> numpy.ndarray:
+        """
+        Returns the numbers of snapshots of the hashes in the catalog from 'audio_hash_stats'.
+
+        :param hashes: packed hashes (int64); text hashes have no statistics.
+        :return: array of frequencies, one per hash (0 - less than the statistics minimum or unknown).
+        """
+
+        hashes = hash_column(hashes)
+        frequencies = numpy.zeros(len(hashes), dtype=numpy.int64)
+        if len(hashes) == 0 or hashes.dtype.kind == 'S':
+            return frequencies
+
+        query = """ SELECT hash, snapshots FROM audio_hash_stats WHERE hash = ANY(%s); """
+
+        try:
+            with ConnectionFromPool(self.pool) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, (numpy.unique(hashes).tolist(),))
                     rows = cur.fetchall()
-                    if cur.rowcount > 0:
-                        data = rows
+
+            frequencies = frequencies_of(hashes, rows)
 
         except (Exception, psycopg2.DatabaseError) as error:
             logger.error(f'Exception: {error}')
 
         finally:
-            return data
+            return frequencies
 
-    def add_video_fingerprint(self, hash: list[int], id_content: int, timestamp: int):
+    def iter_all_audio_snapshots(self, batch_size=LOOKUP_BATCH_ROWS, table='snapshot_audio')\
+            -> Iterator[list[tuple[int, int, int]]]:
         """
-        Adds a list of video fingerprint data. Function returns nothing.
+        Reads all audio snapshots (for example, to build 'AudioHashIndex') through a server-side cursor.
+
+        :param batch_size: maximum number of rows in a batch.
+        :param table: table with snapshots.
+        :return: iterator over lists of elements (‘id_content’, ‘timestamp’, ‘hash’).
+        :raises psycopg2.DatabaseError: if the reading failed.
+        """
+
+        return self.iter_rows(table, ['id_content', 'timestamp', 'hash'], batch_size)
+
+    @contextmanager
+    def read_snapshot(self):
+        """
+        Opens a read-only REPEATABLE READ transaction: all queries on the connection see the same snapshot
+        of the database, whatever is committed meanwhile.
+
+        :return: context manager over the connection (pass it to 'iter_rows').
+        """
+
+        with ConnectionFromPool(self.pool) as conn:
+            with conn.cursor() as cur:
+                # Must be the first statement of the transaction
+                cur.execute(""" SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY; """)
+
+            yield conn
+
+    def iter_rows(self, table: str, column_names: list[str], batch_size=LOOKUP_BATCH_ROWS, conn=None)\
+            -> Iterator[list[tuple]]:
+        """
+        Reads all rows of the table through a server-side cursor.
+
+        :param table: table name.
+        :param column_names: names of the columns to read.
+        :param batch_size: maximum number of rows in a batch.
+        :param conn: connection of an open transaction (see 'read_snapshot'); a connection from the pool if None.
+        :return: iterator over lists of rows.
+        :raises psycopg2.DatabaseError: if the reading failed.
+        """
+
+        query = sql.SQL(""" SELECT {} FROM {} """).format(sql.SQL(', ').join(map(sql.Identifier, column_names)),
+                                                         sql.Identifier(table))
+
+        try:
+            if conn is not None:
+                yield from fetch_all_rows(conn, query, f'{table}_scan', batch_size)
+            else:
+                with ConnectionFromPool(self.pool) as conn:
+                    yield from fetch_all_rows(conn, query, f'{table}_scan', batch_size)
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'Exception: {error}')
+            raise
+
+    def add_packed_audio_snapshots(self, id_content: int, hashes: numpy.ndarray, timestamps: numpy.ndarray,
+                                   table='snapshot_audio') -> int:
+        """
+        Adds audio snapshots of one content in the packed format ('hash' is bigint).
 
-        :param hash: list with decimal number (number - part of fingerprint).
         :param id_content: id content.
-        :param timestamp: fingerprint timestamp
+        :param hashes: array of packed hashes (int64).
+        :param timestamps: array of snapshot times, same length as 'hashes'.
+        :param table: target table.
+        :return: number of inserted rows.
+        :raises psycopg2.DatabaseError: if the rows were not inserted.
         """
 
-        query = f"""INSERT INTO fingerprint_video("column", row, id_content, timestamp)
-                    VALUES %s;
-                """
+        return self.copy_audio_snapshots(id_content, hashes, timestamps, table)
+
+    def copy_audio_snapshots(self, id_content, hashes, timestamps, table='snapshot_audio', replace=False) -> int:
+        """
+        Loads audio snapshots with binary COPY in one transaction.
+
+        With 'replace', rows are loaded into a temporary staging table first, then the previous snapshots
+        of the content are replaced by the staged rows, so readers see either the old or the new fingerprint.
+
+        :param id_content: id content (one value for all rows or an array, same length as 'hashes').
+        :param hashes: array of packed hashes (int64) or SHA-256 hex digests.
+        :param timestamps: array of snapshot times, same length as 'hashes'.
+        :param table: target table.
+        :param replace: replace the snapshots of the content ('id_content' must be one value).
+        :return: number of inserted rows.
+        :raises psycopg2.DatabaseError: if the rows were not inserted (nothing is inserted in this case).
+        """
+
+        columns = audio_snapshot_columns(id_content, timestamps, hashes)
 
-        data = [(idx, value, id_content, timestamp) for idx, value in enumerate(hash)]
+        count = self.copy_rows(table, ['id_content', 'timestamp', 'hash'], columns,
+                               id_content if replace else None)
+
+        # The index holds packed hashes of 'snapshot_audio' only
+        if self.hash_index is not None and table == 'snapshot_audio' and columns[2].dtype.kind == 'i':
+            self.update_hash_index(self.hash_index.add, columns[0], columns[2], columns[1], replace=replace)
+
+        return count
+
+    def copy_rows(self, table: str, column_names: list[str], columns: list[numpy.ndarray], replace_id_content=None)\
+            -> int:
+        """
+        Loads rows into the table with binary COPY in one transaction.
+
+        :param table: table name.
+        :param column_names: names of the table columns.
+        :param columns: arrays of values, one per column.
+        :param replace_id_content: if set, rows are staged in a temporary table and replace the rows
+            of this content.
+        :return: number of inserted rows.
+        :raises psycopg2.DatabaseError: if the rows were not inserted (nothing is inserted in this case).
+        """
 
         try:
             with ConnectionFromPool(self.pool) as conn:
                 with conn.cursor() as cur:
-                    execute_values(cur, query, data, page_size=100000)
+                    if replace_id_content is None:
+                        return copy_binary(cur, table, column_names, columns)
+
+                    staging = f'{table}_staging'
+                    names = sql.SQL(', ').join(map(sql.Identifier, column_names))
+
+                    cur.execute(sql.SQL(""" CREATE TEMPORARY TABLE {staging} ON COMMIT DROP AS
+                                            SELECT {names} FROM {table} WITH NO DATA;
+                                        """).format(staging=sql.Identifier(staging), names=names,
+                                                    table=sql.Identifier(table)))
+                    copy_binary(cur, staging, column_names, columns)
+
+                    cur.execute(sql.SQL(""" DELETE FROM {table} WHERE id_content = %s;
+                                            INSERT INTO {table} ({names})
+                                            SELECT {names} FROM {staging};
+                                        """).format(table=sql.Identifier(table), names=names,
+                                                    staging=sql.Identifier(staging)),
+                                (int(replace_id_content),))
+
+                    return cur.rowcount
 
         except (Exception, psycopg2.DatabaseError) as error:
             logger.error(f'Exception: {error}')
+            raise
 
-    def add_video_fingerprints(self, hashes: list[tuple[list[int]], int], id_content: int):
+    def get_audio_snapshots_by_packed_hashes(self, hashes: numpy.ndarray) -> list[tuple[int, int, int]]:
         """
-         Adds a list of video fingerprint data. Function returns nothing. Function returns nothing.
+        Performs a search by packed (bigint) hashes and returns matches from the database.
+
+        :param hashes: array of packed hashes (int64).
+        :return: list of elements (‘id_content’, ‘timestamp’, ‘hash’).
+        :raises psycopg2.DatabaseError: if the search failed.
+        """
+
+        return self.get_audio_snapshots_by_hashes(numpy.asarray(hashes, dtype=numpy.int64))
+
+    def create_packed_audio_snapshot_table(self, table='snapshot_audio_packed',
+                                           partitions=SNAPSHOT_AUDIO_PARTITIONS) -> bool:
+        """
+        Creates a table for audio snapshots in the packed format ('hash' is bigint), with the same layout
+        as 'snapshot_audio' (see 'db_schema.create_snapshot_audio').
+        Used to re-fingerprint an existing catalog next to the table with SHA-256 hashes.
+
+        :param table: table name.
+        :param partitions: number of hash partitions (0 - a plain table).
+        :return: boolean value that tells whether the table is ready.
+        """
+
+        result = False
+
+        try:
+            with ConnectionFromPool(self.pool) as conn:
+                with conn.cursor() as cur:
+                    for statement in create_snapshot_audio(partitions, table):
+                        cur.execute(statement)
+                    result = True
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'Exception: {error}')
+
+        finally:
+            return result
+
+    def count_audio_snapshots(self, id_content: int, table='snapshot_audio') -> int:
+        """
+        Counts audio snapshots of the content.
 
-        :param hashes: list with tuple (fingerprint data and fingerprint timestamp).
         :param id_content: id content.
+        :param table: table name.
+        :return: number of rows.
         """
 
-        query = f"""INSERT INTO fingerprint_video("column", row, id_content, timestamp)
-                    VALUES %s;
-                """
+        return self.count_content_rows(id_content, table)
+
+    def count_content_rows(self, id_content: int, table: str) -> int:
+        """
+        Counts rows of the content in a table with the 'id_content' column.
+
+        :param id_content: id content.
+        :param table: table name.
+        :return: number of rows.
+        """
+
+        query = sql.SQL(""" SELECT count(*)
+                            FROM {}
+                            WHERE id_content = %s;
+                        """).format(sql.Identifier(table))
 
-        data = [(idx, value, id_content, timestamp) for hash, timestamp in hashes for idx, value in enumerate(hash)]
+        count = 0
 
         try:
             with ConnectionFromPool(self.pool) as conn:
                 with conn.cursor() as cur:
-                    execute_values(cur, query, data, page_size=100000)
+                    cur.execute(query, (id_content,))
+                    count = cur.fetchone()[0]
 
         except (Exception, psycopg2.DatabaseError) as error:
             logger.error(f'Exception: {error}')
 
+        finally:
+            return count
+
+    def swap_audio_snapshot_tables(self, packed_table='snapshot_audio_packed',
+                                   legacy_table='snapshot_audio_sha256') -> bool:
+        """
+        Makes the packed table the active 'snapshot_audio' in one transaction.
+        The previous table is kept under the 'legacy_table' name.
+        Lookup indexes of the packed table are built here, after the bulk load (a partitioned table gets no
+        separate hash index, see 'db_schema.create_snapshot_audio_indexes'). Indexes and hash partitions
+        take the names of the schema migrations ('snapshot_audio_hash_idx', 'snapshot_audio_p0', ...),
+        the previous ones are renamed after 'legacy_table'.
+
+        :param packed_table: table with re-fingerprinted packed hashes.
+        :param legacy_table: new name of the previous 'snapshot_audio' table.
+        :return: boolean value that tells whether the tables were swapped.
+        """
+
+        query = sql.SQL(""" CREATE INDEX IF NOT EXISTS {packed_id_content_idx} ON {packed} (id_content);
+                            ALTER TABLE snapshot_audio RENAME TO {legacy};
+                            ALTER INDEX IF EXISTS snapshot_audio_hash_idx RENAME TO {legacy_hash_idx};
+                            ALTER INDEX IF EXISTS snapshot_audio_id_content_idx RENAME TO {legacy_id_content_idx};
+                            ALTER TABLE {packed} RENAME TO snapshot_audio;
+                            ALTER INDEX {packed_id_content_idx} RENAME TO snapshot_audio_id_content_idx;
+                        """).format(legacy=sql.Identifier(legacy_table), packed=sql.Identifier(packed_table),
+                                    packed_id_content_idx=sql.Identifier(f'{packed_table}_id_content_idx'),
+                                    legacy_hash_idx=sql.Identifier(f'{legacy_table}_hash_idx'),
+                                    legacy_id_content_idx=sql.Identifier(f'{legacy_table}_id_content_idx'))
+
+        # Partitioned tables are looked up through the primary key (hash, id)
+        packed_hash_idx = sql.Identifier(f'{packed_table}_hash_idx')
+
+        partitions_query = """ SELECT child.relname
+                               FROM pg_inherits
+                               JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                               JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+                               WHERE parent.relname = %s AND parent.relnamespace = current_schema()::regnamespace;
+                           """
+
+        result = False
+
+        try:
+            with ConnectionFromPool(self.pool) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(partitions_query, ('snapshot_audio',))
+                    legacy_partitions = [row[0] for row in cur.fetchall()]
+                    cur.execute(partitions_query, (packed_table,))
+                    packed_partitions = [row[0] for row in cur.fetchall()]
+
+                    if not packed_partitions:
+                        cur.execute(sql.SQL(""" CREATE INDEX IF NOT EXISTS {} ON {} (hash); """)
+                                    .format(packed_hash_idx, sql.Identifier(packed_table)))
+
+                    cur.execute(query)
+
+                    if not packed_partitions:
+                        cur.execute(sql.SQL(""" ALTER INDEX {} RENAME TO snapshot_audio_hash_idx; """)
+                                    .format(packed_hash_idx))
+
+                    # Partitions are named '<table>_p<remainder>' (see 'db_schema.create_snapshot_audio')
+                    renames = [(name, legacy_table + name[len('snapshot_audio'):]) for name in legacy_partitions
+                               if name.startswith('snapshot_audio_p')]
+                    renames += [(name, 'snapshot_audio' + name[len(packed_table):]) for name in packed_partitions
+                                if name.startswith(f'{packed_table}_p')]
+
+                    for name, new_name in renames:
+                        cur.execute(sql.SQL(""" ALTER TABLE {} RENAME TO {}; """)
+                                    .format(sql.Identifier(name), sql.Identifier(new_name)))
+                    result = True
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'Exception: {error}')
+
+        finally:
+            return result
+
+    def add_video_fingerprint(self, hash: list[int], id_content: int, timestamp: int) -> int:
+        """
+        Adds a list of video fingerprint data.
+
+        :param hash: list with decimal number (number - part of fingerprint).
+        :param id_content: id content.
+        :param timestamp: fingerprint timestamp
+        :return: number of inserted rows.
+        """
+
+        return self.add_video_fingerprints([(hash, timestamp)], id_content)
+
+    def add_video_fingerprints(self, hashes: list[tuple[list[int], int]], id_content: int, replace=False) -> int:
+        """
+        Adds a list of video fingerprint data with binary COPY (one row per number of a fingerprint).
+
+        :param hashes: list with tuple (fingerprint data and fingerprint timestamp).
+        :param id_content: id content.
+        :param replace: replace the fingerprints of the content (see 'copy_rows').
+        :return: number of inserted rows.
+        :raises psycopg2.DatabaseError: if the rows were not inserted (nothing is inserted in this case).
+        """
+
+        lengths = numpy.fromiter((len(hash) for hash, _ in hashes), dtype=numpy.int64, count=len(hashes))
+        values = numpy.fromiter((value for hash, _ in hashes for value in hash), dtype=numpy.int32,
+                                count=int(lengths.sum()))
+
+        # Position of every number inside its fingerprint
+        starts = numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        columns_idx = (numpy.arange(len(values)) - starts).astype(numpy.int32)
+
+        timestamps = numpy.fromiter((timestamp for _, timestamp in hashes), dtype=numpy.float64, count=len(hashes))
+        timestamps = numpy.repeat(numpy.rint(timestamps).astype(numpy.int32), lengths)
+
+        columns = [columns_idx, values, numpy.full(len(values), id_content, dtype=numpy.int32), timestamps]
+
+        return self.copy_rows('fingerprint_video', ['column', 'row', 'id_content', 'timestamp'], columns,
+                              id_content if replace else None)
+
     def get_video_fingerprints_by_hash(self, id_content, timestamp_start, timestamp_end) -> list[tuple[int, int, str]]:
         """
          Performs a fingerprint search and returns matches from the database.
@@ -391,3 +1007,82 @@ class DBService:
 
         finally:
             return data
+
+    def add_packed_video_fingerprints(self, id_content: int, timestamps: numpy.ndarray, fingerprints: numpy.ndarray,
+                                      sizes: numpy.ndarray, replace=False) -> int:
+        """
+        Adds video fingerprints in the packed format: one row per fingerprint (see 'pack_fingerprints').
+
+        :param id_content: id content.
+        :param timestamps: fingerprint timestamps (milliseconds).
+        :param fingerprints: packed fingerprints (uint64 words, one row per fingerprint).
+        :param sizes: numbers of values in fingerprints.
+        :param replace: replace the fingerprints of the content (see 'copy_rows').
+        :return: number of inserted rows.
+        :raises psycopg2.DatabaseError: if the rows were not inserted (nothing is inserted in this case).
+        """
+
+        fingerprints = numpy.ascontiguousarray(fingerprints, dtype=PACKED_WORD_DTYPE)
+        fingerprint_bytes = fingerprints.view(f'V{fingerprints.shape[1] * PACKED_WORD_DTYPE.itemsize}').ravel()
+
+        columns = [numpy.full(len(fingerprints), id_content, dtype=numpy.int32),
+                   numpy.asarray(timestamps, dtype=numpy.int32), numpy.asarray(sizes, dtype=numpy.int32),
+                   fingerprint_bytes]
+
+        return self.copy_rows('fingerprint_video_packed', ['id_content', 'timestamp', 'size', 'fingerprint'],
+                              columns, id_content if replace else None)
+
+    def get_packed_video_fingerprints(self, id_content, timestamp_start, timestamp_end)\
+            -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """
+        Reads packed video fingerprints of the content in the time range with one index range scan.
+
+        :param id_content: id content.
+        :param timestamp_start: start time.
+        :param timestamp_end: end time.
+        :return: timestamps (int32), packed fingerprints (uint64 words, one row per fingerprint, ordered by time)
+            and numbers of values in fingerprints (int32).
+        """
+
+        query = """ SELECT timestamp, size, fingerprint
+                    FROM fingerprint_video_packed
+                    WHERE id_content = %s AND timestamp BETWEEN %s AND %s
+                    ORDER BY timestamp
+                """
+
+        rows = []
+
+        try:
+            with ConnectionFromPool(self.pool) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, (id_content, timestamp_start, timestamp_end,))
+                    rows = cur.fetchall()
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'Exception: {error}')
+
+        return packed_video_fingerprints_from_rows(rows)
+
+    def get_video_fingerprint_content_ids(self, table='fingerprint_video') -> list[int]:
+        """
+        Returns ids of the contents that have video fingerprints in the table.
+
+        :param table: table with video fingerprints.
+        :return: sorted list of id content.
+        """
+
+        query = sql.SQL(""" SELECT DISTINCT id_content FROM {} ORDER BY id_content; """).format(sql.Identifier(table))
+
+        data = []
+
+        try:
+            with ConnectionFromPool(self.pool) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query)
+                    data = [row[0] for row in cur.fetchall()]
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'Exception: {error}')
+
+        finally:
+            return data
@@ -0,0 +1,127 @@
+import os
+import hashlib
+import tempfile
+import threading
+import numpy as np
+from Algorithm.default_logger import logger
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(tempfile.gettempdir(), 'xk7_fingerprint_cache')
+DEFAULT_CACHE_MAX_BYTES = 1 << 30
+
+CACHE_FILE_EXTENSION = '.npz'
+READ_BLOCK_SIZE = 1 << 20
+
+
+class FingerprintCache:
+    """
+    On-disk cache of audio fingerprints, keyed by a digest of the media file bytes and the fingerprint parameters.
+    Entries are stored as binary numpy arrays; the least recently used entries are removed
+    when the total size exceeds 'max_bytes'.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        """
+        :param directory: cache directory (created if it does not exist).
+        :param max_bytes: maximum total size of cache files.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(path: str, params: dict) -> str:
+        """
+        Computes the cache key of a media file.
+
+        :param path: path to the media file.
+        :param params: fingerprint parameters; a change of any parameter gives a different key.
+        :return: hex digest.
+        """
+        digest = hashlib.blake2b(digest_size=20)
+
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(READ_BLOCK_SIZE), b''):
+                digest.update(block)
+
+        digest.update(repr(sorted(params.items())).encode())
+
+        return digest.hexdigest()
+
+    def get(self, key: str) -> tuple[list[tuple[int, int]], float] | None:
+        """
+        Reads fingerprint from the cache.
+
+        :param key: cache key (see 'make_key').
+        :return: tuple (list of (hash, time) and audio duration in seconds) or None if there is no entry.
+        """
+        path = self.entry_path(key)
+
+        try:
+            with np.load(path) as entry:
+                hashes = entry['hashes']
+                duration = float(entry['duration'])
+
+            # The modification time is used as the last access time for LRU eviction
+            os.utime(path)
+
+        except (OSError, KeyError, ValueError):
+            return None
+
+        return list(zip(hashes[:, 0].tolist(), hashes[:, 1].tolist())), duration
+
+    def put(self, key: str, result_hashes: list[tuple[int, int]], duration: float):
+        """
+        Stores fingerprint in the cache and evicts old entries if needed.
+
+        :param key: cache key (see 'make_key').
+        :param result_hashes: list of (packed hash, time).
+        :param duration: audio duration in seconds.
+        """
+        hashes = np.array(result_hashes, dtype=np.int64).reshape(-1, 2)
+
+        path = self.entry_path(key)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, hashes=hashes, duration=np.float64(duration))
+            os.replace(temp_path, path)
+
+        except OSError as error:
+            logger.error(f'fingerprint cache: {error}')
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the total size is not greater than 'max_bytes'.
+        """
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(CACHE_FILE_EXTENSION):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+            entries.sort()
+
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + CACHE_FILE_EXTENSION)
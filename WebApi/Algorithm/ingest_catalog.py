@@ -0,0 +1,315 @@
+import os
+import queue
+import multiprocessing
+import argparse
+import threading
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from time import perf_counter
+
+import numpy as np
+
+from Algorithm.audio_create_hashes import create_audio_hashes
+from Algorithm.audio_utility import decode_audio_from_video_source, get_audio_duration
+from Algorithm.db_service import DBService
+from Algorithm.audio_hash_index import open_hash_index
+from Algorithm.db_utilities import load_config
+from Algorithm.default_logger import logger
+from Algorithm.upload_all_audio_to_db import get_duration_video
+from Algorithm.video_create_hash import create_video_fingerprints
+from Algorithm.video_fingerprint_pack import pack_fingerprints
+
+STOP = None
+# How long to wait for the writers to flush the last results after the fingerprinting stages have finished
+WRITER_JOIN_TIMEOUT_S = float(os.environ.get('INGEST_WRITER_JOIN_TIMEOUT_S', 600))
+
+
+class IngestStats:
+    """
+    Thread-safe counters of the ingestion pipeline.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {'files': 0, 'decoded': 0, 'audio_seconds': 0.0, 'audio_done': 0, 'video_done': 0,
+                       'hashes': 0, 'video_fingerprints': 0, 'rows_written': 0, 'failures': 0,
+                       'failed_writers': 0}
+
+    def add(self, name: str, value=1):
+        with self.lock:
+            self.values[name] += value
+
+    def report(self, elapsed: float) -> str:
+        values = self.values
+        hours = values['audio_seconds'] / 3600
+
+        return (f'files: {values["files"]}; decoded: {values["decoded"]}; audio: {values["audio_done"]}; '
+                f'video: {values["video_done"]}; failures: {values["failures"]}; '
+                f'failed writers: {values["failed_writers"]}\n'
+                f'hashes: {values["hashes"]}; video fingerprints: {values["video_fingerprints"]}; '
+                f'rows written: {values["rows_written"]}\n'
+                f'time: {elapsed:.1f} seconds; {values["files"] / elapsed:.3f} files/s; '
+                f'{hours / (elapsed / 3600):.2f} hours of audio per hour; '
+                f'{values["hashes"] / elapsed:.0f} hashes/s')
+
+
+def fingerprint_audio_samples(id_content: int, audio_samples: np.ndarray, sample_rate: int):
+    """
+    Process pool task: creates audio hashes of decoded samples.
+
+    :return: tuple ('audio', id content, hashes, timestamps).
+    """
+    result_hashes = create_audio_hashes(audio_samples, sample_rate)
+    data = np.array(result_hashes, dtype=np.int64).reshape(-1, 2)
+
+    return 'audio', id_content, data[:, 0], data[:, 1]
+
+
+def fingerprint_video_file(id_content: int, path: str):
+    """
+    Process pool task: creates video fingerprints of the file and packs them.
+
+    :return: tuple ('video', id content, timestamps, packed fingerprints, sizes).
+    """
+    return 'video', id_content, *pack_fingerprints(create_video_fingerprints(path))
+
+
+def decode_stage(files: queue.Queue, pcm: queue.Queue, stats: IngestStats):
+    """
+    Decodes audio of files into PCM. ffmpeg runs in its own process, so threads are enough for this stage.
+    """
+    while True:
+        item = files.get()
+        if item is STOP:
+            break
+
+        id_content, path = item
+        try:
+            audio_samples, sample_rate = decode_audio_from_video_source(path)
+            stats.add('decoded')
+            stats.add('audio_seconds', get_audio_duration(audio_samples, sample_rate))
+            pcm.put((id_content, audio_samples, sample_rate))
+
+        except Exception as ex:
+            stats.add('failures')
+            logger.error(f'[{id_content}] decode failed: {ex}')
+
+
+def pool_stage(executor: ProcessPoolExecutor, function, source: queue.Queue, sink: queue.Queue, max_in_flight: int,
+               stats: IngestStats, done_counter: str):
+    """
+    Feeds items from 'source' to the process pool and puts results to 'sink'.
+    The number of tasks in flight is bounded, so a slow consumer blocks the producers (backpressure).
+    If the pool breaks, 'source' is still read until STOP, so the producers finish.
+    """
+    in_flight = deque()
+
+    def drain(block: bool):
+        if block:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        else:
+            done = [future for future in in_flight if future.done()]
+
+        for future in done:
+            in_flight.remove(future)
+            try:
+                sink.put(future.result())
+                stats.add(done_counter)
+            except Exception as ex:
+                stats.add('failures')
+                logger.error(f'{function.__name__} failed: {ex}')
+
+    try:
+        while True:
+            item = source.get()
+            if item is STOP:
+                break
+
+            while len(in_flight) >= max_in_flight:
+                drain(block=True)
+
+            in_flight.append(executor.submit(function, *item))
+            drain(block=False)
+
+    except Exception as ex:
+        # For example BrokenProcessPool after a worker was killed
+        stats.add('failures')
+        logger.error(f'[{item[0]}] {function.__name__} dispatcher failed: {ex}')
+
+        # Producers block on the bounded 'source' queue: the remaining items are taken as failures until STOP
+        while source.get() is not STOP:
+            stats.add('failures')
+
+    finally:
+        while in_flight:
+            drain(block=True)
+
+
+def writer_stage(config: dict, results: queue.Queue, stats: IngestStats):
+    """
+    Writes fingerprints to the database. Each writer uses its own connection.
+    A writer that cannot connect keeps taking results (counted as failures): otherwise the queue fills up
+    and the fingerprinting stages block on it forever.
+    """
+    try:
+        db_service_ = DBService(1, 1, config, hash_index=open_hash_index())
+    except Exception as ex:
+        db_service_ = None
+        stats.add('failed_writers')
+        logger.error(f'writer failed to start: {ex}')
+
+    while True:
+        item = results.get()
+        if item is STOP:
+            break
+
+        kind, id_content, *data = item
+        if db_service_ is None:
+            stats.add('failures')
+            logger.error(f'[{id_content}] {kind} dropped: the writer has no database connection')
+            continue
+
+        try:
+            if kind == 'audio':
+                hashes, timestamps = data
+                count = db_service_.add_packed_audio_snapshots(id_content, hashes, timestamps)
+                if count != len(hashes):
+                    raise RuntimeError(f'inserted {count} of {len(hashes)} hashes')
+                stats.add('hashes', len(hashes))
+                stats.add('rows_written', count)
+
+            else:
+                timestamps, fingerprints, sizes = data
+                count = db_service_.add_packed_video_fingerprints(id_content, timestamps, fingerprints, sizes)
+                stats.add('video_fingerprints', len(fingerprints))
+                stats.add('rows_written', count)
+
+            logger.info(f'[{id_content}] {kind} written')
+
+        except Exception as ex:
+            stats.add('failures')
+            logger.error(f'[{id_content}] {kind} write failed: {ex}')
+
+    if db_service_ is not None:
+        db_service_.close()
+
+
+def register_contents(db_service_: DBService, directory: str, list_path: str, stats: IngestStats)\
+        -> list[tuple[int, str]]:
+    """
+    Adds 'content' rows for all files of the directory and saves the list of (file, id) as 'upload_all_audio_to_db'.
+    """
+    data = []
+
+    for file in sorted(os.listdir(directory)):
+        full_path = os.path.join(directory, file)
+        if not os.path.isfile(full_path):
+            logger.warning(f'Skipping {full_path} as it is not a file.')
+            continue
+
+        duration = get_duration_video(full_path)
+        id_content = db_service_.add_content(file, int(duration) if duration else None)
+        if id_content is None:
+            stats.add('failures')
+            continue
+
+        data.append((id_content, full_path))
+        stats.add('files')
+
+    with open(list_path, 'w') as f:
+        for id_content, full_path in data:
+            f.write(f'{full_path} {id_content}\n')
+
+    return data
+
+
+def ingest(directory: str, config: dict, audio_workers: int, video_workers: int, decode_workers: int,
+           db_writers: int, queue_size: int, list_path: str) -> IngestStats:
+    """
+    Ingests all files of the directory: decoding -> audio / video fingerprinting (process pools) -> DB writers.
+    Stages are connected by bounded queues.
+    """
+    stats = IngestStats()
+
+    db_service_ = DBService(1, 1, config)
+    try:
+        data = register_contents(db_service_, directory, list_path, stats)
+    finally:
+        db_service_.close()
+    logger.info(f'count data: {len(data)}')
+
+    audio_files = queue.Queue()
+    video_files = queue.Queue()
+    for item in data:
+        audio_files.put(item)
+        if video_workers > 0:
+            video_files.put(item)
+
+    pcm = queue.Queue(maxsize=queue_size)
+    results = queue.Queue(maxsize=queue_size)
+
+    writers = [threading.Thread(target=writer_stage, args=(config, results, stats), daemon=True)
+               for _ in range(db_writers)]
+    decoders = [threading.Thread(target=decode_stage, args=(audio_files, pcm, stats), daemon=True)
+                for _ in range(decode_workers)]
+    for _ in decoders:
+        audio_files.put(STOP)
+    video_files.put(STOP)
+
+    # Workers are started while decoder threads hold ffmpeg pipes: forked workers would inherit the pipe ends
+    # and ffmpeg would never see its output closed
+    mp_context = multiprocessing.get_context('spawn')
+
+    with ExitStack() as stack:
+        audio_executor = stack.enter_context(ProcessPoolExecutor(max_workers=audio_workers, mp_context=mp_context))
+        dispatchers = [threading.Thread(target=pool_stage, daemon=True,
+                                        args=(audio_executor, fingerprint_audio_samples, pcm, results,
+                                              audio_workers * 2, stats, 'audio_done'))]
+
+        if video_workers > 0:
+            video_executor = stack.enter_context(ProcessPoolExecutor(max_workers=video_workers, mp_context=mp_context))
+            dispatchers.append(threading.Thread(target=pool_stage, daemon=True,
+                                                args=(video_executor, fingerprint_video_file, video_files, results,
+                                                      video_workers * 2, stats, 'video_done')))
+
+        for thread in writers + decoders + dispatchers:
+            thread.start()
+
+        for thread in decoders:
+            thread.join()
+        pcm.put(STOP)
+
+        for thread in dispatchers:
+            thread.join()
+
+    for _ in writers:
+        results.put(STOP)
+    for thread in writers:
+        thread.join(WRITER_JOIN_TIMEOUT_S)
+        if thread.is_alive():
+            logger.error(f'writer did not finish in {WRITER_JOIN_TIMEOUT_S} seconds; the last results may be lost')
+
+    return stats
+
+
+if __name__ == '__main__':
+    cpu_count = os.cpu_count() or 1
+
+    parser = argparse.ArgumentParser(description='Parallel ingestion of a media catalog into the database.')
+    parser.add_argument('directory', help='directory with media files')
+    parser.add_argument('--audio-workers', type=int, default=cpu_count, help='audio fingerprint processes')
+    parser.add_argument('--video-workers', type=int, default=0, help='video fingerprint processes (0 - no video)')
+    parser.add_argument('--decode-workers', type=int, default=2, help='ffmpeg decoding threads')
+    parser.add_argument('--db-writers', type=int, default=2, help='concurrent DB writers (one connection each)')
+    parser.add_argument('--queue-size', type=int, default=4, help='capacity of the queues between stages')
+    parser.add_argument('--list', default='data.txt', help='where to save the list of (file, id content)')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        parser.error(f'{args.directory} is not a directory')
+
+    start = perf_counter()
+    result_stats = ingest(args.directory, load_config(), args.audio_workers, args.video_workers,
+                          args.decode_workers, args.db_writers, args.queue_size, args.list)
+    logger.info(result_stats.report(perf_counter() - start))
@@ -0,0 +1,174 @@
+from bisect import bisect_left
+
+import numpy as np
+
+
+class IntervalSet:
+    """
+    Ordered set of closed intervals (start, end, payload): intervals do not overlap and the gap between neighbouring
+    bounds is greater than 'max_gap'. An added interval is merged with every interval closer than 'max_gap';
+    the merged interval keeps the payload of the longer part (the payload is the local time offset for match
+    durations).
+
+    Bounds are kept in parallel plain lists: positions are found by binary search (O(log n)), but an insert
+    or merge shifts the list tails, so adding an interval is O(n) in the worst case. Sorted runs are merged
+    without inserts by 'from_sorted_runs' and 'merge_sorted_runs'.
+    """
+
+    def __init__(self, max_gap=1):
+        """
+        :param max_gap: maximum distance between bounds of intervals that are merged.
+        """
+        self.max_gap = max_gap
+        self.starts = []
+        self.ends = []
+        self.payloads = []
+
+    @classmethod
+    def from_sorted_runs(cls, starts, ends, payloads, max_gap=1) -> 'IntervalSet':
+        """
+        Builds the set from runs ordered by start (start <= end) without inserting them one by one.
+        The result is the same as adding the runs in order.
+
+        :param starts: starts of the runs.
+        :param ends: ends of the runs.
+        :param payloads: payloads of the runs.
+        :param max_gap: maximum distance between bounds of intervals that are merged.
+        """
+        interval_set = cls(max_gap)
+        _, starts, ends, payloads = merge_sorted_runs(starts, ends, payloads, max_gap)
+
+        interval_set.starts = starts.tolist()
+        interval_set.ends = ends.tolist()
+        interval_set.payloads = payloads.tolist()
+
+        return interval_set
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends, self.payloads)
+
+    def __repr__(self):
+        return f'IntervalSet({self.to_list()}, max_gap={self.max_gap})'
+
+    def to_list(self) -> list[tuple]:
+        """
+        :return: intervals as tuples (start, end, payload).
+        """
+        return list(self)
+
+    def merge(self, start, end, payload, lo: int, hi: int):
+        """
+        Replaces the intervals lo..hi-1 with their union with the interval (start, end, payload).
+        The payload of the longer of the two parts is kept.
+        """
+        length = self.ends[hi - 1] - self.starts[lo]
+
+        self.starts[lo] = min(self.starts[lo], start)
+        self.ends[lo] = max(self.ends[hi - 1], end)
+        self.payloads[lo] = payload if length < end - start else self.payloads[hi - 1]
+
+        if hi > lo + 1:
+            del self.starts[lo + 1:hi]
+            del self.ends[lo + 1:hi]
+            del self.payloads[lo + 1:hi]
+
+    def add(self, start, end, payload):
+        """
+        Adds the interval, merging it with the intervals closer than 'max_gap'.
+        """
+        if not self.starts:
+            self.starts.append(start)
+            self.ends.append(end)
+            self.payloads.append(payload)
+            return
+
+        idx_start = bisect_left(self.starts, start)
+        idx_end = bisect_left(self.ends, end, lo=idx_start)
+
+        if idx_start > 0 and start - self.ends[idx_start - 1] <= self.max_gap:
+            idx_start -= 1
+        if idx_end < len(self.starts) and self.starts[idx_end] - end <= self.max_gap:
+            idx_end += 1
+
+        if idx_start == idx_end:
+            self.starts.insert(idx_start, start)
+            self.ends.insert(idx_start, end)
+            self.payloads.insert(idx_start, payload)
+        else:
+            self.merge(start, end, payload, idx_start, idx_end)
+
+        # The merged interval may have reached its neighbours
+        if idx_start > 0 and self.starts[idx_start] - self.ends[idx_start - 1] <= self.max_gap:
+            self.merge(self.starts[idx_start], self.ends[idx_start], self.payloads[idx_start],
+                       idx_start - 1, idx_start + 1)
+        if idx_start < len(self.starts) - 1 and self.starts[idx_start + 1] - self.ends[idx_start] <= self.max_gap:
+            self.merge(self.starts[idx_start], self.ends[idx_start], self.payloads[idx_start],
+                       idx_start, idx_start + 2)
+
+    def update(self, intervals):
+        """
+        Adds intervals (start, end, payload) in order.
+        """
+        for start, end, payload in intervals:
+            self.add(start, end, payload)
+
+
+def is_sorted_runs(starts: np.ndarray, ends: np.ndarray, groups: np.ndarray = None) -> bool:
+    """
+    :return: True if the runs of every group are ordered by start and no run ends before it starts
+        ('merge_sorted_runs' applies to them).
+    """
+    starts, ends = np.asarray(starts), np.asarray(ends)
+
+    ordered = np.diff(starts) >= 0
+    if groups is not None:
+        ordered |= np.diff(groups) != 0
+
+    return bool(np.all(ordered) and np.all(starts <= ends))
+
+
+def merge_sorted_runs(starts, ends, payloads, max_gap=1, groups=None)\
+        -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Merges runs of many groups at once; the result for each group is the same as adding its runs
+    to an 'IntervalSet' in order. Runs of a group must be consecutive and ordered by start, and max_gap >= 0.
+
+    :param starts: starts of the runs.
+    :param ends: ends of the runs.
+    :param payloads: payloads of the runs.
+    :param max_gap: maximum distance between bounds of runs that are merged.
+    :param groups: group of each run (None - one group).
+    :return: group, start, end and payload of the merged intervals.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    payloads = np.asarray(payloads)
+    groups = np.zeros(len(starts), dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)
+
+    if len(starts) == 0:
+        return groups, starts, ends, payloads
+
+    group_first = np.r_[True, np.diff(groups) != 0]
+
+    # Running maximum of the ends inside a group: the ends are shifted so that every group lies above the previous one
+    group_ids = np.cumsum(group_first) - 1
+    span = int(ends.max() - ends.min()) + 1
+    shift = group_ids * span - ends.min()
+    max_ends = np.maximum.accumulate(ends + shift) - shift
+
+    # The end of the interval built from the previous runs of the group
+    previous_ends = np.r_[ends[0], max_ends[:-1]]
+    first = group_first | (starts - previous_ends > max_gap)
+    interval_ids = np.cumsum(first) - 1
+    interval_starts = starts[first]
+
+    # A run gives its payload to the interval if it is longer than the interval built before it
+    take = first | (previous_ends - interval_starts[interval_ids] < ends - starts)
+    payload_idx = np.maximum.accumulate(np.where(take, np.arange(len(starts)), 0))
+
+    last = np.r_[np.flatnonzero(first)[1:] - 1, len(starts) - 1]
+
+    return groups[first], interval_starts, max_ends[last], payloads[payload_idx[last]]
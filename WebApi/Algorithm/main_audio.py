@@ -1,15 +1,15 @@
 from collections import defaultdict
-from datetime import time
 
 from Algorithm.default_logger import logger
+from Algorithm.metrics import metrics
 from Algorithm.db_service import DBService
 from Algorithm.db_utilities import load_config
 from Algorithm.audio_utility import get_audio_duration
 from Algorithm.audio_utility import read_audio
-from Algorithm.audio_utility import extract_audio_from_video_source
-from Algorithm.audio_detection import detect_audio
+from Algorithm.audio_utility import decode_audio_from_video_source
+from Algorithm.async_db_service import AsyncDBService
+from Algorithm.audio_detection import detect_audio, detect_audio_async
 from Algorithm.audio_create_hashes import create_audio_hashes
-from time import time
 import sys
 import traceback 
 
@@ -36,8 +36,8 @@ def add_audio_to_db(db_service_: DBService, audio_source_, id_content_: int) ->
 
         audio_data = [(id_content_, time_s, hash_value) for hash_value, time_s in result_hashes]
 
-        db_service_.add_audio_snapshots(audio_data)
-        logger.info(f'added hashes to DB')
+        count = db_service_.add_audio_snapshots(audio_data)
+        logger.info(f'added {count} rows to DB')
 
     except Exception as ex_:
         logger.error(ex_)
@@ -50,7 +50,7 @@ def audio_match_search(db_service_: DBService, audio_source_) -> dict[int, list[
     """
 
     :param db_service_: Database access object
-    :param audio_source_: Source or path to the audio file
+    :param audio_source_: Source or path to the audio file (wav)
     :return: Dictionary, where the key is the content id and the value is a list of tuples
         (start time of the match in the database in seconds, end time of the match in the database in seconds,
         time offset of the current audio record relative to the found audio record in seconds)
@@ -58,16 +58,37 @@ def audio_match_search(db_service_: DBService, audio_source_) -> dict[int, list[
     audio_dict = defaultdict(list)
 
     try:
-
         audio_samples_, sample_rate_ = read_audio(audio_source_)
+        audio_dict = audio_samples_match_search(db_service_, audio_samples_, sample_rate_)
+
+    except Exception as ex_:
+        logger.error(ex_)
+        traceback.print_exc()
+
+    finally:
+        return audio_dict
+
+
+def audio_samples_match_search(db_service_: DBService, audio_samples_, sample_rate_: int)\
+        -> dict[int, list[tuple[int, int, int]]]:
+    """
+    Searches for matches of already decoded audio data.
+
+    :param db_service_: Database access object
+    :param audio_samples_: Audio data
+    :param sample_rate_: Sample rate of the audio data
+    :return: Dictionary in the same format as 'audio_match_search'
+    """
+    audio_dict = defaultdict(list)
+
+    try:
         duration = get_audio_duration(audio_samples_, sample_rate_)
         logger.info(f'audio file read (duration {duration} seconds)')
 
         result_hashes = create_audio_hashes(audio_samples_, sample_rate_)
         logger.info(f'created {len(result_hashes)} hashes')
 
-        audio_dict = detect_audio(result_hashes, duration, db_service_, max_diff_s=2)
-        logger.info(f'count find: {len(audio_dict)}\naudio id finds: {list(audio_dict.keys())}')
+        audio_dict = audio_hashes_match_search(db_service_, result_hashes, duration)
 
     except Exception as ex_:
         logger.error(ex_)
@@ -77,6 +98,60 @@ def audio_match_search(db_service_: DBService, audio_source_) -> dict[int, list[
         return audio_dict
 
 
+def audio_hashes_match_search(db_service_: DBService, result_hashes: list[tuple[int, int]], duration: float,
+                              match_info: dict = None, min_duration_s=10) -> dict[int, list[tuple[int, int, int]]]:
+    """
+    Searches for matches of already computed audio hashes.
+
+    :param db_service_: Database access object
+    :param result_hashes: A list of tuples (hash and time)
+    :param duration: Duration of the audio record in seconds
+    :param match_info: Dictionary that receives the search limits and their effect (see 'detect_audio')
+    :param min_duration_s: Minimum duration of a match in seconds
+    :return: Dictionary in the same format as 'audio_match_search'
+    :raises Exception: if the search failed (database, hash index or shard error), so a failure is not reported
+        as the absence of matches
+    """
+    try:
+        audio_dict = detect_audio(result_hashes, duration, db_service_, max_diff_s=2, min_duration_s=min_duration_s,
+                                  match_info=match_info)
+        logger.info(f'count find: {len(audio_dict)}\naudio id finds: {list(audio_dict.keys())}')
+
+    except Exception as ex_:
+        logger.error(ex_)
+        traceback.print_exc()
+        raise
+
+    return audio_dict
+
+
+async def audio_hashes_match_search_async(db_service_: AsyncDBService, result_hashes: list[tuple[int, int]],
+                                          duration: float, match_info: dict = None, min_duration_s=10)\
+        -> dict[int, list[tuple[int, int, int]]]:
+    """
+    Searches for matches of already computed audio hashes with the asynchronous database service.
+
+    :param db_service_: Asynchronous database access object
+    :param result_hashes: A list of tuples (hash and time)
+    :param duration: Duration of the audio record in seconds
+    :param match_info: Dictionary that receives the search limits and their effect (see 'detect_audio')
+    :param min_duration_s: Minimum duration of a match in seconds
+    :return: Dictionary in the same format as 'audio_match_search'
+    :raises Exception: if the search failed (see 'audio_hashes_match_search')
+    """
+    try:
+        audio_dict = await detect_audio_async(result_hashes, duration, db_service_, max_diff_s=2,
+                                              min_duration_s=min_duration_s, match_info=match_info)
+        logger.info(f'count find: {len(audio_dict)}\naudio id finds: {list(audio_dict.keys())}')
+
+    except Exception as ex_:
+        logger.error(ex_)
+        traceback.print_exc()
+        raise
+
+    return audio_dict
+
+
 def example_audio_match_search(path: str):
     """
     Example of an audio record match search
@@ -87,13 +162,13 @@ def example_audio_match_search(path: str):
         
         db_service = DBService(1, 1, config)
         
-        start_time = time()
-        audio_source = extract_audio_from_video_source(path)
-        print(f'extract audio from video: {time() - start_time} seconds')
+        with metrics.stage('decode') as timer:
+            audio_samples, sample_rate = decode_audio_from_video_source(path)
+        logger.info(f'extract audio from video: {timer.elapsed} seconds')
         
-        start_time = time()
-        dict_audio_matches = audio_match_search(db_service, audio_source)
-        print(f'search matches time: {time() - start_time} seconds')
+        with metrics.stage('match_search') as timer:
+            dict_audio_matches = audio_samples_match_search(db_service, audio_samples, sample_rate)
+        logger.info(f'search matches time: {timer.elapsed} seconds')
         
         for id_content, values in dict_audio_matches.items():
             logger.info(f'audio {id_content}:')
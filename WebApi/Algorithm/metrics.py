@@ -0,0 +1,217 @@
+import os
+import sys
+import threading
+from time import perf_counter
+from Algorithm.default_logger import logger
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+COUNT_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+RSS_BUCKETS = tuple(float(1 << power) for power in range(26, 36))  # 64 MiB .. 32 GiB
+
+
+class Histogram:
+    """
+    Prometheus histogram with one label (for example, the pipeline stage name).
+    """
+
+    def __init__(self, name: str, description: str, buckets: tuple, label: str = None):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.label = label
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, label_value: str = None):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+
+            bucket_counts = series[0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[idx] += 1
+                    break
+
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+
+        with self.lock:
+            for label_value, (bucket_counts, total, count) in sorted(self.series.items(), key=lambda x: str(x[0])):
+                labels = f'{self.label}="{label_value}",' if self.label else ''
+
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {count}')
+
+                labels = f'{{{labels[:-1]}}}' if labels else ''
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {count}')
+
+        return lines
+
+
+class Counter:
+    """
+    Prometheus counter without labels.
+    """
+    metric_type = 'counter'
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, value=1):
+        with self.lock:
+            self.value += value
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.metric_type}',
+                f'{self.name} {self.value}']
+
+
+class Gauge(Counter):
+    """
+    Prometheus gauge without labels.
+    """
+    metric_type = 'gauge'
+
+    def dec(self, value=1):
+        self.inc(-value)
+
+
+class StageTimer:
+    """
+    Context manager that records the duration of a pipeline stage.
+    """
+
+    def __init__(self, registry, name: str):
+        self.registry = registry
+        self.name = name
+        self.start = 0.0
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.elapsed = perf_counter() - self.start
+        self.registry.stage_duration.observe(self.elapsed, self.name)
+        logger.debug(f'{self.name}: {self.elapsed} seconds')
+        return False
+
+
+class NullTimer:
+    """
+    Context manager used instead of 'StageTimer' when metrics are disabled.
+    """
+    elapsed = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class MetricsRegistry:
+    """
+    Collects fingerprint pipeline metrics: stage durations, item counts and peak RSS.
+    When disabled, recording is a single attribute check.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+        self.stage_duration = Histogram('fingerprint_stage_duration_seconds',
+                                        'Duration of fingerprint pipeline stages.', DURATION_BUCKETS, 'stage')
+        self.items = Histogram('fingerprint_items', 'Number of items produced by fingerprint pipeline stages.',
+                               COUNT_BUCKETS, 'item')
+        self.peak_rss = Histogram('process_peak_rss_bytes', 'Peak resident set size of the process after a request.',
+                                  RSS_BUCKETS)
+
+        self.pool_wait = Histogram('db_pool_wait_seconds', 'Time spent waiting for a database connection.',
+                                   DURATION_BUCKETS)
+        self.pool_checkouts = Counter('db_pool_checkouts_total', 'Number of database connection checkouts.')
+        self.pool_timeouts = Counter('db_pool_timeouts_total', 'Number of checkouts that timed out.')
+        self.pool_in_use = Gauge('db_pool_connections_in_use', 'Number of database connections in use.')
+
+        self.collectors = [self.stage_duration, self.items, self.peak_rss,
+                           self.pool_wait, self.pool_checkouts, self.pool_timeouts, self.pool_in_use]
+
+    def stage(self, name: str):
+        """
+        Times a pipeline stage: 'with metrics.stage("stft"): ...'.
+
+        :param name: stage name (decode, stft, peak_picking, pairing, hashing, db_query, duration_finding, ...).
+        """
+        if not self.enabled:
+            return NULL_TIMER
+
+        return StageTimer(self, name)
+
+    def count(self, item: str, value: int):
+        """
+        Records the number of items (peaks, pairs, hashes, db_rows, ...).
+        """
+        if self.enabled:
+            self.items.observe(value, item)
+
+    def observe_peak_rss(self):
+        """
+        Records the peak resident set size of the process.
+        """
+        if not self.enabled or resource is None:
+            return
+
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # Linux reports kilobytes, macOS - bytes
+        self.peak_rss.observe(max_rss if sys.platform == 'darwin' else max_rss * 1024)
+
+    def observe_pool_checkout(self, wait_s: float):
+        """
+        Records a database connection checkout and the time spent waiting for it.
+        """
+        if self.enabled:
+            self.pool_wait.observe(wait_s)
+            self.pool_checkouts.inc()
+            self.pool_in_use.inc()
+
+    def observe_pool_checkin(self):
+        if self.enabled:
+            self.pool_in_use.dec()
+
+    def observe_pool_timeout(self):
+        if self.enabled:
+            self.pool_timeouts.inc()
+
+    def render(self) -> str:
+        """
+        Renders all metrics in the Prometheus text format.
+        """
+        lines = []
+        for collector in self.collectors:
+            lines.extend(collector.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry(enabled=os.environ.get('FINGERPRINT_METRICS', '1') != '0')
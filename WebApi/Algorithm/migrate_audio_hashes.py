@@ -0,0 +1,82 @@
+import re
+import sys
+from time import time
+
+import numpy as np
+
+from Algorithm.db_service import DBService
+from Algorithm.db_utilities import load_config
+from Algorithm.default_logger import logger
+from Algorithm.upload_all_audio_to_db import create_fingerprint_audio
+
+PACKED_TABLE = 'snapshot_audio_packed'
+LEGACY_TABLE = 'snapshot_audio_sha256'
+
+
+def parse_catalog_file(file_path: str) -> list[tuple[str, int]]:
+    """
+    Reads the list of catalog files written by 'upload_all_audio_to_db' ('data.txt').
+
+    :param file_path: path to the list file.
+    :return: list of tuples (path to the media file, id content).
+    """
+
+    with open(file_path) as f:
+        data = f.read()
+
+    matches = re.findall(r'([^ ]+) (\d+)', data)
+
+    return [(filename, int(id_content)) for filename, id_content in matches]
+
+
+def migrate_content(db_service_: DBService, path: str, id_content: int, table=PACKED_TABLE) -> int:
+    """
+    Re-fingerprints one content into the packed hash format.
+    Content that already has rows in the packed table is skipped, so the migration can be resumed.
+
+    :param db_service_: Database access object
+    :param path: path to the media file of the content
+    :param id_content: id content
+    :param table: table with packed hashes
+    :return: number of inserted hashes
+    """
+
+    if db_service_.count_audio_snapshots(id_content, table) > 0:
+        logger.info(f'[{id_content}] already migrated')
+        return 0
+
+    start = time()
+    result_hashes = create_fingerprint_audio(path)
+
+    hashes = np.fromiter((hash_value for hash_value, _ in result_hashes), dtype=np.int64, count=len(result_hashes))
+    timestamps = np.fromiter((time_ms for _, time_ms in result_hashes), dtype=np.int64, count=len(result_hashes))
+
+    count = db_service_.add_packed_audio_snapshots(id_content, hashes, timestamps, table)
+    logger.info(f'[{id_content}] migrated {count} hashes; time: {time() - start} seconds')
+
+    return count
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and sys.argv[2] != '--swap'):
+        logger.error(f'usage: python -m Algorithm.migrate_audio_hashes <data.txt> [--swap]')
+        sys.exit(1)
+
+    config = load_config()
+    # The schema check refuses a catalog with SHA-256 hashes: the migrations are applied after the swap
+    db_service = DBService(1, 1, config, migrate=False)
+
+    if not db_service.create_packed_audio_snapshot_table(PACKED_TABLE):
+        sys.exit(1)
+
+    data = parse_catalog_file(sys.argv[1])
+    logger.info(f'count data: {len(data)}')
+
+    for file, id_content in data:
+        migrate_content(db_service, file, id_content)
+
+    if len(sys.argv) == 3:
+        if db_service.swap_audio_snapshot_tables(PACKED_TABLE, LEGACY_TABLE):
+            logger.info(f'{PACKED_TABLE} is now snapshot_audio; previous table renamed to {LEGACY_TABLE}')
+            db_service.migrate_schema()
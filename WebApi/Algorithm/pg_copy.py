@@ -0,0 +1,109 @@
+import struct
+import numpy as np
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+COPY_HEADER = COPY_SIGNATURE + struct.pack('>ii', 0, 0)  # flags, header extension length
+COPY_TRAILER = struct.pack('>h', -1)
+
+COPY_ROWS_PER_CHUNK = 1 << 16
+COPY_READ_SIZE = 1 << 20
+
+
+def binary_field_dtype(column: np.ndarray) -> np.dtype:
+    """
+    Returns the big-endian dtype of a column in the PostgreSQL binary format.
+
+    :param column: integer (smallint, integer, bigint), float (real, double precision),
+        fixed-length bytes (text) or fixed-length void (bytea) array.
+    :return: numpy dtype.
+    """
+    if column.dtype.kind in 'iu' and column.dtype.itemsize in (2, 4, 8):
+        return np.dtype(f'>i{column.dtype.itemsize}')
+
+    if column.dtype.kind == 'f' and column.dtype.itemsize in (4, 8):
+        return np.dtype(f'>f{column.dtype.itemsize}')
+
+    if column.dtype.kind == 'S':
+        if len(column) and np.any(np.char.str_len(column) != column.dtype.itemsize):
+            raise ValueError('text values of a binary COPY column must have the same length')
+        return column.dtype
+
+    if column.dtype.kind == 'V' and column.dtype.names is None:
+        return column.dtype
+
+    raise ValueError(f'unsupported column type for binary COPY: {column.dtype}')
+
+
+def encode_binary_rows(columns: list[np.ndarray]) -> bytes:
+    """
+    Encodes rows to the PostgreSQL binary COPY format (without the header and trailer).
+    Every row is 'int16 field count' + ('int32 length' + value) per field, so the rows are built
+    as one structured array.
+
+    :param columns: arrays of the same length, one per table column.
+    :return: encoded rows.
+    """
+    fields = [('count', '>i2')]
+    for idx, column in enumerate(columns):
+        fields += [(f'length{idx}', '>i4'), (f'value{idx}', binary_field_dtype(column))]
+
+    rows = np.empty(len(columns[0]), dtype=fields)
+    rows['count'] = len(columns)
+
+    for idx, column in enumerate(columns):
+        rows[f'length{idx}'] = rows.dtype[f'value{idx}'].itemsize
+        rows[f'value{idx}'] = column
+
+    return rows.tobytes()
+
+
+class BinaryCopyStream:
+    """
+    File-like object for 'cursor.copy_expert' that streams numpy columns in the PostgreSQL binary COPY format.
+    Rows are encoded chunk by chunk, so the memory does not depend on the number of rows.
+    """
+
+    def __init__(self, columns: list[np.ndarray], rows_per_chunk=COPY_ROWS_PER_CHUNK):
+        """
+        :param columns: arrays of the same length, one per table column (NULL values are not supported).
+        :param rows_per_chunk: number of rows encoded at a time.
+        """
+        if len({len(column) for column in columns}) != 1:
+            raise ValueError('columns of a binary COPY must have the same length')
+
+        self.columns = columns
+        self.rows = len(columns[0])
+        self.rows_per_chunk = rows_per_chunk
+
+        self.next_row = 0
+        self.buffer = memoryview(COPY_HEADER)
+        self.position = 0
+        self.finished = False
+
+        # Validates column types before COPY starts
+        for column in columns:
+            binary_field_dtype(column)
+
+    def next_chunk(self) -> bytes:
+        if self.next_row >= self.rows:
+            self.finished = True
+            return COPY_TRAILER
+
+        start, self.next_row = self.next_row, min(self.next_row + self.rows_per_chunk, self.rows)
+
+        return encode_binary_rows([column[start:self.next_row] for column in self.columns])
+
+    def read(self, size=-1) -> bytes:
+        if size is None or size < 0:
+            size = COPY_READ_SIZE
+
+        while self.position >= len(self.buffer):
+            if self.finished:
+                return b''
+            self.buffer = memoryview(self.next_chunk())
+            self.position = 0
+
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+
+        return bytes(data)
@@ -1,16 +1,38 @@
+import asyncio
 import cv2
 import os
 import sys
+from functools import partial
+from inspect import signature, Parameter
 
 from Algorithm.video_create_hash import create_video_fingerprints
+from Algorithm.video_fingerprint_pack import pack_fingerprints
 from Algorithm.db_service import DBService
+from Algorithm.audio_hash_index import open_hash_index
 from Algorithm.db_utilities import load_config
 from os import listdir
-from Algorithm.audio_create_hashes import create_audio_hashes
-from Algorithm.audio_utility import extract_audio_from_video_source, read_audio
+from Algorithm.audio_create_hashes import create_audio_hashes, create_audio_hashes_streaming
+from Algorithm.audio_utility import decode_audio_from_video_source, get_audio_duration, iter_pcm_from_video_source,\
+    probe_media_duration, FINGERPRINT_SAMPLE_RATE
+from Algorithm.audio_screening import SCREEN_MIN_LENGTH_S, use_screening, screen_and_match, screen_and_match_async
+from Algorithm.fingerprint_cache import FingerprintCache
 from Algorithm.default_logger import logger
+from Algorithm.metrics import metrics
 
-from Algorithm.main_audio import audio_match_search
+from Algorithm.main_audio import audio_hashes_match_search, audio_hashes_match_search_async
+
+# Parameters that define the fingerprint; they are part of the cache key
+AUDIO_FINGERPRINT_PARAMS = {
+    'sample_rate': FINGERPRINT_SAMPLE_RATE,
+    **{name: parameter.default for name, parameter in signature(create_audio_hashes).parameters.items()
+       if parameter.default is not Parameter.empty},
+}
+
+# Files longer than this (seconds) are fingerprinted in the streaming mode: the signal and the spectrogram
+# are not held in memory, at the cost of decoding the file twice (0 - streaming is disabled)
+STREAM_MIN_LENGTH_S = float(os.environ.get('AUDIO_STREAM_MIN_LENGTH_S', 1800))
+
+fingerprint_cache = FingerprintCache()
 
 
 def get_duration_video(filename: str):
@@ -28,22 +50,124 @@ def get_duration_video(filename: str):
     return frame_count / fps
 
 
-def create_fingerprint_audio(path: str):
-    print("start algorithm")
-    audio_stream_ = extract_audio_from_video_source(path)
-    print("audio_stream_ is success")
-    audio_samples_, sample_rate_ = read_audio(audio_stream_)
-    print("sample_rate_ is success")
+def use_streaming(path: str, min_length_s=STREAM_MIN_LENGTH_S) -> bool:
+    """
+    :return: True if the file is long enough to be fingerprinted in the streaming mode.
+    """
+    if min_length_s <= 0:
+        return False
+
+    duration_ = probe_media_duration(path)
+
+    return duration_ is not None and duration_ > min_length_s
+
+
+def audio_cache_key(path: str) -> str:
+    """
+    :return: fingerprint cache key of the file (reads and hashes the whole file, so it is computed once per request).
+    """
+    return fingerprint_cache.make_key(path, AUDIO_FINGERPRINT_PARAMS)
+
+
+def fingerprint_audio_file(path: str, key: str = None) -> tuple[list[tuple[int, int]], float]:
+    """
+    :param key: cache key of the file if it is already computed (see 'audio_cache_key').
+    :return: list of (hash, time) and audio duration in seconds.
+    """
+    if key is None:
+        key = audio_cache_key(path)
 
-    result_hashes_ = create_audio_hashes(audio_samples_, sample_rate_)
-    print("result_hashes_ is success")
+    cached = fingerprint_cache.get(key)
+    if cached is not None:
+        logger.info(f'fingerprint cache hit: {path}')
+        return cached
+
+    if use_streaming(path):
+        # The same hashes as 'create_audio_hashes', so the cache entry and the catalog are shared
+        result_hashes_, duration_ = create_audio_hashes_streaming(partial(iter_pcm_from_video_source, path),
+                                                                  FINGERPRINT_SAMPLE_RATE)
+    else:
+        with metrics.stage('decode'):
+            audio_samples_, sample_rate_ = decode_audio_from_video_source(path)
+        logger.debug(f'decoded {path}: {len(audio_samples_)} samples, {sample_rate_} Hz')
+
+        duration_ = get_audio_duration(audio_samples_, sample_rate_)
+
+        result_hashes_ = create_audio_hashes(audio_samples_, sample_rate_)
+    logger.debug(f'fingerprinted {path}: {len(result_hashes_)} hashes')
+
+    fingerprint_cache.put(key, result_hashes_, duration_)
+
+    return result_hashes_, duration_
+
+
+def create_fingerprint_audio(path: str):
+    logger.debug(f'fingerprinting {path}')
+    result_hashes_, _ = fingerprint_audio_file(path)
 
     return result_hashes_
 
-def match_audio_fingerprint(path: str, db_service_):
-    audio_source = extract_audio_from_video_source(path)
+def screening_duration(path: str, key: str) -> float | None:
+    """
+    :param key: cache key of the file (see 'audio_cache_key').
+    :return: duration of the file if it should be screened before full fingerprinting (see 'audio_screening'),
+        None if the whole file is fingerprinted (short or already cached).
+    """
+    if SCREEN_MIN_LENGTH_S <= 0:
+        return None
 
-    dict_audio_matches = audio_match_search(db_service_, audio_source)
+    duration_ = probe_media_duration(path)
+    if not use_screening(duration_):
+        return None
+
+    # A cached fingerprint is cheaper than screening
+    if os.path.exists(fingerprint_cache.entry_path(key)):
+        return None
+
+    return duration_
+
+
+def match_audio_fingerprint(path: str, db_service_, match_info: dict = None):
+    key = audio_cache_key(path)
+    duration_ = screening_duration(path, key)
+
+    if duration_ is not None:
+        dict_audio_matches = screen_and_match(path, duration_, partial(audio_hashes_match_search, db_service_),
+                                              match_info)
+    else:
+        result_hashes_, duration_ = fingerprint_audio_file(path, key)
+        dict_audio_matches = audio_hashes_match_search(db_service_, result_hashes_, duration_, match_info)
+    metrics.observe_peak_rss()
+
+    return dict_audio_matches
+
+async def search_audio_hashes_async(db_service_, result_hashes_, duration_, match_info: dict = None,
+                                    min_duration_s=10):
+    """
+    Searches for matches with the asynchronous database service or its in-memory hash index.
+    """
+    if db_service_.hash_index is not None:
+        # The in-memory index replaces the database lookup
+        return await asyncio.to_thread(audio_hashes_match_search, db_service_.hash_index, result_hashes_, duration_,
+                                       match_info, min_duration_s)
+
+    return await audio_hashes_match_search_async(db_service_, result_hashes_, duration_, match_info, min_duration_s)
+
+async def match_audio_fingerprint_async(path: str, db_service_, match_info: dict = None):
+    """
+    Same as 'match_audio_fingerprint' for the asynchronous database service: decoding and hashing run in a thread,
+    so the event loop keeps serving other requests.
+    """
+    key = await asyncio.to_thread(audio_cache_key, path)
+    duration_ = await asyncio.to_thread(screening_duration, path, key)
+
+    if duration_ is not None:
+        dict_audio_matches = await screen_and_match_async(path, duration_,
+                                                          partial(search_audio_hashes_async, db_service_), match_info)
+    else:
+        result_hashes_, duration_ = await asyncio.to_thread(fingerprint_audio_file, path, key)
+        dict_audio_matches = await search_audio_hashes_async(db_service_, result_hashes_, duration_, match_info)
+    metrics.observe_peak_rss()
 
     return dict_audio_matches
 
@@ -53,14 +177,33 @@ def create_and_load_fingerprint_audio(title: str, path: str, db_service_):
     result_hashes_audio = create_fingerprint_audio(path)
 
     audio_data_ = [(id_, time_s, hash_value) for hash_value, time_s in result_hashes_audio]
-    db_service_.add_audio_snapshots(audio_data_)
+    with metrics.stage('db_insert'):
+        db_service_.add_audio_snapshots(audio_data_)
+    metrics.observe_peak_rss()
+
+    return id_
+
+
+async def create_and_load_fingerprint_audio_async(title: str, path: str, db_service_):
+    """
+    Same as 'create_and_load_fingerprint_audio' for the asynchronous database service.
+    """
+    duration_video = await asyncio.to_thread(get_duration_video, path)
+    id_ = await db_service_.add_content(title, duration_video)
+
+    result_hashes_audio = await asyncio.to_thread(create_fingerprint_audio, path)
+
+    audio_data_ = [(id_, time_s, hash_value) for hash_value, time_s in result_hashes_audio]
+    with metrics.stage('db_insert'):
+        await db_service_.add_audio_snapshots(audio_data_)
+    metrics.observe_peak_rss()
 
     return id_
 
 
 def create_and_load_video_fingerprint(id_, path: str):
     result_fingerprint = create_video_fingerprints(path)
-    db_service.add_video_fingerprints(result_fingerprint, id_)
+    db_service.add_packed_video_fingerprints(id_, *pack_fingerprints(result_fingerprint))
 
     return id_
 
@@ -77,7 +220,7 @@ if __name__ == '__main__':
 
     try:
         config = load_config()
-        db_service = DBService(1, 1, config)
+        db_service = DBService(1, 1, config, hash_index=open_hash_index())
 
         logger.info(f'count files: {len(listdir(dir))}')
 
@@ -113,17 +256,13 @@ if __name__ == '__main__':
 
         for file, id_content in data:
 
-            audio_stream = extract_audio_from_video_source(file)
-            logger.info(f'[{id_content}] extracted audio')
-            audio_samples, sample_rate = read_audio(audio_stream)
-
-            result_hashes = create_audio_hashes(audio_samples, sample_rate)
+            result_hashes, _ = fingerprint_audio_file(file)
             logger.info(f'[{id_content}] created {len(result_hashes)} hashes')
 
             audio_data = [(id_content, time_s, hash_value) for hash_value, time_s in result_hashes]
 
-            db_service.add_audio_snapshots(audio_data)
-            logger.info(f'[{id_content}] added to DB')
+            count = db_service.add_audio_snapshots(audio_data)
+            logger.info(f'[{id_content}] added {count} rows to DB')
 
     except Exception as ex:
         logger.error(f'exception: {ex}')
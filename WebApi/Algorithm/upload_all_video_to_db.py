@@ -4,6 +4,7 @@ from db_service import DBService
 from db_utilities import load_config
 from default_logger import logger
 from video_create_hash import create_video_fingerprints
+from video_fingerprint_pack import pack_fingerprints
 
 
 def parse_file(file_path):
@@ -37,5 +38,5 @@ if __name__ == '__main__':
         logger.info(f'[{id_content}] created fingerprint; time: {time() - start} seconds')
 
         start = time()
-        db_service.add_video_fingerprints(fingerprints, id_content)
-        logger.info(f'[{id_content}] added to DB; times: {time() - start} seconds')
+        count = db_service.add_packed_video_fingerprints(id_content, *pack_fingerprints(fingerprints))
+        logger.info(f'[{id_content}] added {count} rows to DB; times: {time() - start} seconds')
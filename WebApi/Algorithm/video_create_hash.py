@@ -3,8 +3,8 @@ import numpy as np
 from skimage.metrics import structural_similarity as ssim
 from moviepy.editor import VideoFileClip
 import statistics
-from time import time
 from Algorithm.default_logger import logger
+from Algorithm.metrics import metrics
 
 
 def resize_and_change_fps(input_path, new_width=144, new_height=176, fps=4):
@@ -209,31 +209,28 @@ def create_video_fingerprints(filename: str) -> list[tuple[list[int], int]]:
     :return: list with tuple (fingerprint data and fingerprint timestamp)
     """
 
-    start_time = time()
-    resized_file = resize_and_change_fps(filename, new_width=104, new_height=136, fps=5)
-    logger.debug(f'resized: {time() - start_time} seconds')
+    with metrics.stage('video_resize'):
+        resized_file = resize_and_change_fps(filename, new_width=104, new_height=136, fps=5)
 
-    start_time = time()
-    tiris, tiri_times = process_video(resized_file, threshold=0.6, J=5)
-    logger.debug(f'created tiris (count: {len(tiris)}): {time() - start_time} seconds')
+    with metrics.stage('video_keyframes'):
+        tiris, tiri_times = process_video(resized_file, threshold=0.6, J=5)
+    metrics.count('video_tiris', len(tiris))
 
-    start_time = time()
-    B = []
-    for tiri in tiris:
-        B.append(segment_Tiri(tiri))
-    logger.debug(f'created B (count: {len(B)}): {time() - start_time} seconds')
+    with metrics.stage('video_segments'):
+        B = []
+        for tiri in tiris:
+            B.append(segment_Tiri(tiri))
 
-    start_time_cycle = time()
-    hashes = []
+    with metrics.stage('video_hashing'):
+        hashes = []
 
-    for i in range(len(B)):
-        alpha, beta = compute_dct_coefficients(B[i])
+        for i in range(len(B)):
+            alpha, beta = compute_dct_coefficients(B[i])
 
-        f = get_f(alpha, beta)
+            f = get_f(alpha, beta)
 
-        hashes.append(hash_frame(f))
+            hashes.append(hash_frame(f))
 
-    logger.debug(f'created hashes (count: {len(hashes)}): {time() - start_time_cycle} seconds')
     hashes_decimal = map(binary_to_decimal, hashes)
 
     return list(zip(hashes_decimal, tiri_times))
@@ -1,3 +1,37 @@
+import numpy as np
+
+from Algorithm.video_fingerprint_pack import pack_fingerprints
+
+# Elements of the XOR block computed at once by 'hamming_distance_matrix' (bounds the temporary memory)
+DISTANCE_BLOCK_ELEMENTS = 1 << 22
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(words: np.ndarray) -> np.ndarray:
+        """
+        :return: number of set bits of every 64-bit word.
+        """
+        return np.bitwise_count(words)
+else:
+    # numpy < 2.0 has no popcount ufunc: bits are counted by a table of 16-bit halves of words
+    POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(1 << 16)], dtype=np.uint8)
+
+    def popcount(words: np.ndarray) -> np.ndarray:
+        """
+        :return: number of set bits of every 64-bit word.
+        """
+        words = np.ascontiguousarray(words)
+        return POPCOUNT_TABLE[words.view(np.uint16)].reshape(*words.shape, 4).sum(axis=-1, dtype=np.uint8)
+
+
+def native_words(packed: np.ndarray) -> np.ndarray:
+    """
+    Reinterprets packed fingerprints (big-endian words, see 'pack_fingerprints') as native uint64 without a copy:
+    XOR and popcount do not depend on the byte order.
+    """
+    packed = np.ascontiguousarray(packed)
+    return packed.view(np.uint64) if packed.dtype.itemsize == 8 else packed.astype(np.uint64)
+
+
 def hamming_distance(seq1, seq2):
     if len(seq1) != len(seq2):
         raise ValueError("Sequences must be of the same length")
@@ -9,25 +43,114 @@ def hamming_distance(seq1, seq2):
     return distance
 
 
-def find_video_duration(hashes_db: list[tuple[list[int]], int], hashes_local: list[tuple[list[int], int]], thresh,
-                        max_diff_time, min_duration_time):
-    durations = []
+def hamming_distances(packed1: np.ndarray, packed2: np.ndarray) -> np.ndarray:
+    """
+    Hamming distances between the fingerprints of the same rows.
 
-    len_min = min(len(hashes_db), len(hashes_local))
+    :param packed1: packed fingerprints (uint64 words, one row per fingerprint).
+    :param packed2: packed fingerprints with the same number of rows and words.
+    :return: distances (int32), one per row.
+    """
+    xor = np.bitwise_xor(native_words(packed1), native_words(packed2))
+
+    return popcount(xor).sum(axis=-1, dtype=np.int32)
+
+
+def hamming_distance_matrix(query: np.ndarray, candidates: np.ndarray, block_elements=DISTANCE_BLOCK_ELEMENTS)\
+        -> np.ndarray:
+    """
+    Hamming distances between every query fingerprint and every candidate fingerprint.
+    Query rows are processed in blocks, so the XOR temporary holds at most 'block_elements' words.
+
+    :param query: packed fingerprints (uint64 words, one row per fingerprint).
+    :param candidates: packed fingerprints with the same number of words.
+    :return: distance matrix (int32) of shape (len(query), len(candidates)).
+    """
+    query, candidates = native_words(query), native_words(candidates)
+    if query.shape[1:] != candidates.shape[1:]:
+        raise ValueError("Fingerprints must have the same number of words")
+
+    distances = np.empty((len(query), len(candidates)), dtype=np.int32)
+    block = max(block_elements // max(candidates.size, 1), 1)
+
+    for start in range(0, len(query), block):
+        xor = np.bitwise_xor(query[start:start + block, None, :], candidates[None, :, :])
+        popcount(xor).sum(axis=-1, dtype=np.int32, out=distances[start:start + block])
+
+    return distances
 
-    for i in range(len_min - 1):
 
-        if abs((hashes_db[i + 1][1] - hashes_db[i][1]) - (hashes_local[i + 1][1] - hashes_local[i][1])) > max_diff_time:
-            continue
+def find_video_runs(distances: np.ndarray, timestamps_db: np.ndarray, timestamps_local: np.ndarray, thresh,
+                    max_diff_time, min_duration_time) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds runs of aligned fingerprints closer than 'thresh'. A run starts at every fingerprint whose next time step
+    is the same in both videos (within 'max_diff_time') and ends at the first fingerprint that is not close.
 
-        start_time_db, start_time_local = hashes_db[i][1], hashes_local[i][1]
+    :param distances: distances between the fingerprints of the same positions (see 'hamming_distances').
+    :param timestamps_db: timestamps of the database fingerprints.
+    :param timestamps_local: timestamps of the local fingerprints (the same number as 'distances').
+    :return: indexes of the first and the last fingerprints of the runs.
+    """
+    count = len(distances)
+    if count < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    steps_db = np.diff(timestamps_db[:count])
+    steps_local = np.diff(timestamps_local[:count])
+    aligned = np.abs(steps_db - steps_local) <= max_diff_time
+
+    # The last position only closes runs
+    close = np.r_[distances[:count - 1] < thresh, False]
+    next_far = np.minimum.accumulate(np.where(close, count - 1, np.arange(count))[::-1])[::-1]
+
+    starts = np.flatnonzero(aligned & close[:count - 1])
+    ends = next_far[starts]
+
+    durations_db = timestamps_db[ends] - timestamps_db[starts]
+    durations_local = timestamps_local[ends] - timestamps_local[starts]
+    # A run counts if the database part is long enough or the local part is not empty
+    long_runs = (durations_db >= min_duration_time) | (durations_local != 0)
+
+    return starts[long_runs], ends[long_runs]
+
+
+def find_packed_video_duration(timestamps_db: np.ndarray, packed_db: np.ndarray, timestamps_local: np.ndarray,
+                               packed_local: np.ndarray, thresh, max_diff_time, min_duration_time)\
+        -> list[tuple[tuple[int, int], tuple[int, int]]]:
+    """
+    Same as 'find_video_duration' for packed fingerprints ('get_packed_video_fingerprints', 'pack_fingerprints').
+
+    :return: list of ((database start, database end), (local start, local end)).
+    """
+    count = min(len(packed_db), len(packed_local))
+    timestamps_db, timestamps_local = np.asarray(timestamps_db), np.asarray(timestamps_local)
+
+    distances = hamming_distances(packed_db[:count], packed_local[:count])
+    starts, ends = find_video_runs(distances, timestamps_db.astype(np.int64), timestamps_local.astype(np.int64),
+                                   thresh, max_diff_time, min_duration_time)
+
+    return list(zip(zip(timestamps_db[starts].tolist(), timestamps_db[ends].tolist()),
+                    zip(timestamps_local[starts].tolist(), timestamps_local[ends].tolist())))
+
+
+def find_video_duration(hashes_db: list[tuple[list[int]], int], hashes_local: list[tuple[list[int], int]], thresh,
+                        max_diff_time, min_duration_time):
+    len_min = min(len(hashes_db), len(hashes_local))
+    hashes_db, hashes_local = hashes_db[:len_min], hashes_local[:len_min]
+
+    # Packed together, so both have the same number of words
+    _, packed, sizes = pack_fingerprints(hashes_db + hashes_local)
+    packed_db, packed_local = packed[:len_min], packed[len_min:]
+    if np.any(sizes[:len_min - 1] != sizes[len_min:2 * len_min - 1]):
+        raise ValueError("Sequences must be of the same length")
 
-        old_i = i
-        while i < len_min - 1 and hamming_distance(hashes_db[i][0], hashes_local[i][0]) < thresh:
-            i += 1
+    # Packing rounds timestamps; the runs are found with the original ones
+    timestamps_db = np.array([timestamp for _, timestamp in hashes_db], dtype=np.float64)
+    timestamps_local = np.array([timestamp for _, timestamp in hashes_local], dtype=np.float64)
 
-        if i > old_i and (
-                hashes_db[i][1] - start_time_db >= min_duration_time or hashes_local[i][1] - start_time_local):
-            durations.append(((start_time_db, hashes_db[i][1]), (start_time_local, hashes_local[i][1])))
+    distances = hamming_distances(packed_db, packed_local)
+    starts, ends = find_video_runs(distances, timestamps_db, timestamps_local, thresh, max_diff_time,
+                                   min_duration_time)
 
-    return durations
+    return [((hashes_db[start][1], hashes_db[end][1]), (hashes_local[start][1], hashes_local[end][1]))
+            for start, end in zip(starts.tolist(), ends.tolist())]
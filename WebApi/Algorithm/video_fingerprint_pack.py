@@ -0,0 +1,56 @@
+import numpy as np
+
+# Bits of one number of a fingerprint (see 'video_create_hash.binary_to_decimal')
+FINGERPRINT_VALUE_BITS = 10
+# Packed fingerprints are stored as big-endian 64-bit words, so the bytes are the bit string in order
+FINGERPRINT_WORD_DTYPE = np.dtype('>u8')
+
+
+def pack_fingerprints(fingerprints: list[tuple[list[int], int]]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Packs fingerprints into bit strings: every number of a fingerprint takes FINGERPRINT_VALUE_BITS bits,
+    the bit string is padded to whole 64-bit words.
+
+    :param fingerprints: list with tuple (fingerprint data and fingerprint timestamp).
+    :return: timestamps (int32, milliseconds), packed fingerprints (uint64 words, one row per fingerprint)
+        and numbers of values in fingerprints (int32).
+    """
+    sizes = np.fromiter((len(values) for values, _ in fingerprints), dtype=np.int32, count=len(fingerprints))
+    timestamps = np.fromiter((timestamp for _, timestamp in fingerprints), dtype=np.float64,
+                             count=len(fingerprints))
+
+    max_size = int(sizes.max()) if len(sizes) else 0
+    values = np.zeros((len(fingerprints), max_size), dtype=np.uint16)
+    for idx, (fingerprint, _) in enumerate(fingerprints):
+        values[idx, :len(fingerprint)] = fingerprint
+
+    shifts = np.arange(FINGERPRINT_VALUE_BITS - 1, -1, -1, dtype=np.uint16)
+    bits = ((values[:, :, None] >> shifts) & 1).astype(np.uint8)
+    bits = bits.reshape(len(fingerprints), max_size * FINGERPRINT_VALUE_BITS)
+
+    words = -(-bits.shape[1] // 64)
+    bits = np.pad(bits, ((0, 0), (0, words * 64 - bits.shape[1])))
+
+    packed = np.packbits(bits, axis=1).view(FINGERPRINT_WORD_DTYPE).reshape(len(fingerprints), words)
+
+    return np.rint(timestamps).astype(np.int32), packed, sizes
+
+
+def unpack_fingerprints(packed: np.ndarray, sizes: np.ndarray) -> list[list[int]]:
+    """
+    Restores the numbers of fingerprints packed by 'pack_fingerprints'.
+
+    :param packed: packed fingerprints (uint64 words, one row per fingerprint).
+    :param sizes: numbers of values in fingerprints.
+    :return: list of fingerprints (lists of numbers).
+    """
+    packed = np.ascontiguousarray(packed, dtype=FINGERPRINT_WORD_DTYPE)
+    bits = np.unpackbits(packed.view(np.uint8).reshape(len(packed), packed.shape[1] * 8), axis=1)
+
+    values_count = bits.shape[1] // FINGERPRINT_VALUE_BITS
+    bits = bits[:, :values_count * FINGERPRINT_VALUE_BITS].reshape(len(packed), values_count, FINGERPRINT_VALUE_BITS)
+
+    weights = 1 << np.arange(FINGERPRINT_VALUE_BITS - 1, -1, -1)
+    values = bits.astype(np.int64) @ weights
+
+    return [row[:size].tolist() for row, size in zip(values, sizes)]
@@ -1,4 +1,4 @@
-from typing import List
+from typing import Any, Dict, List
 from pydantic import BaseModel, ConfigDict
 from varname import nameof
 
@@ -30,6 +30,8 @@ class IResponseServerUploadFiles(BaseModel):
     message: str
     status: int
     borrowing: List[IVideoBorrowing]
+    # search limits and their effect: stop hashes, kept candidates (see 'detect_audio')
+    metadata: Dict[str, Any] = {}
 
     def __str__(self):
         return (f"{nameof(self.message)}: {self.message},\n"
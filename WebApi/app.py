@@ -1,31 +1,50 @@
 import os
+import asyncio
+from contextlib import asynccontextmanager
 from typing import List
 import json
 
 from pydantic import ValidationError
 from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
+from Algorithm.async_db_service import AsyncDBService
+from Algorithm.audio_hash_index import open_hash_index
 from Algorithm.db_service import DBService
 from Algorithm.db_utilities import load_config
+from Algorithm.metrics import metrics
 from Common.FaultException import Fault
 from Common.FileValidation import video_validation
 from Common.HttpStatusCodes import HttpStatusSuccessfulCode
 from Model.OperationInfo import *
 from Model.UploadVideo import UploadVideo
-from Algorithm.upload_all_audio_to_db import create_fingerprint_audio, create_and_load_fingerprint_audio, \
-    match_audio_fingerprint
-from Algorithm.db_service import DBService
+from Algorithm.upload_all_audio_to_db import create_and_load_fingerprint_audio_async, match_audio_fingerprint_async
 from Model.ResultTable import IResponseServerUploadFiles, IVideoBorrowing
 
 # TODO: solve import with Algorithm import
 
-app = FastAPI()
-
 config = load_config()
-db_service = DBService(1, 5, config)
+db_service: AsyncDBService = None
+
+
+@asynccontextmanager
+async def lifespan(app_: FastAPI):
+    global db_service
+
+    # The schema is created or updated by the synchronous service once, before requests are served
+    await asyncio.to_thread(lambda: DBService(1, 1, config).close())
+
+    # Without the in-memory hash index matches query 'snapshot_audio'
+    hash_index = await asyncio.to_thread(open_hash_index)
+
+    db_service = await AsyncDBService.create(1, 5, config, hash_index)
+    yield
+    await db_service.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:3000",
@@ -53,19 +72,22 @@ async def upload_video_to_create_fingerprint(file: List[UploadFile] = File(...))
         operation_info = OperationInfo(OperationType.LoadVideoToSubFile, OperationStatus.InProcess)
 
         # create list of dictionary
-        result_audio_matching = match_audio_fingerprint(result_value.path, db_service)
+        match_info = {}
+        result_audio_matching = await match_audio_fingerprint_async(result_value.path, db_service, match_info)
+
+        contents = await db_service.get_contents_by_ids([int(id_content) for id_content in result_audio_matching])
 
         video_borrowing_dictionary: List[IVideoBorrowing] = []
         for result_audio_matching_item in result_audio_matching:
             id_piracy = int(result_audio_matching_item)
-            title_piracy = DBService.get_content_by_id(db_service, id_piracy)[0]
+            title_piracy = contents[id_piracy][0]
             for result_audio_matching_tuple in result_audio_matching[result_audio_matching_item]:
                 time_license_start = result_audio_matching_tuple[0]
                 time_license_finish = result_audio_matching_tuple[1]
                 diff = result_audio_matching_tuple[2]
                 video_borrowing_dictionary.append(IVideoBorrowing(title_license=title_piracy, title_piracy=result_value.title + result_value.extension, time_license_start=time_license_start, time_license_finish=time_license_finish, time_piracy_start=time_license_start + diff, time_piracy_finish=time_license_finish + diff))
 
-        json_ = IResponseServerUploadFiles(message="matching is successful", status=HttpStatusSuccessfulCode.Ok, borrowing=video_borrowing_dictionary).model_json_schema()
+        json_ = IResponseServerUploadFiles(message="matching is successful", status=HttpStatusSuccessfulCode.Ok, borrowing=video_borrowing_dictionary, metadata=match_info).model_dump()
         operation_info.change_status(OperationStatus.Done)
 
         if os.path.exists(video_validation_result.upload_video.path):
@@ -104,7 +126,8 @@ async def upload_video_to_database(file: List[UploadFile] = File(...)):
             await result_value.load_video_to_server(_file)
         operation_info = OperationInfo(OperationType.LoadVideoToDatabase, OperationStatus.InProcess)
         # create fingerprint into video and add to db
-        create_and_load_fingerprint_audio(result_value.title + result_value.extension, result_value.path, db_service)
+        await create_and_load_fingerprint_audio_async(result_value.title + result_value.extension, result_value.path,
+                                                      db_service)
         operation_info.change_status(OperationStatus.Done)
     except ValidationError as e:
         operation_info.set_fault(Fault(400, e.json(result_value)))
@@ -117,5 +140,10 @@ async def upload_video_to_database(file: List[UploadFile] = File(...)):
         return JSONResponse(operation_info.to_json(result_value))
 
 
+@app.get('/metrics')
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     uvicorn.run('app:app', host='127.0.0.1', port=8001)
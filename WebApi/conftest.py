@@ -0,0 +1 @@
+# Tests import modules as the service does ('from Algorithm.x import y'), so WebApi is the import root
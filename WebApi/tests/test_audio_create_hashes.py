@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from Algorithm.audio_create_hashes import HASH_FORMAT_PACKED, HASH_FORMAT_SHA256, anchor_times_ms, \
+    create_audio_hashes, create_audio_hashes_streaming
+
+SAMPLE_RATE = 11025
+
+
+def music(duration_s: float, seed: int) -> np.ndarray:
+    """
+    :return: int16 notes with harmonics and noise.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration_s * SAMPLE_RATE)) / SAMPLE_RATE
+
+    notes = 110 * 2 ** (rng.integers(0, 36, int(duration_s / 0.25) + 1) / 12)
+    phase = 2 * np.pi * np.cumsum(notes[(t / 0.25).astype(np.int64)]) / SAMPLE_RATE
+    signal = sum(0.4 / harmonic * np.sin(harmonic * phase) for harmonic in range(1, 4))
+    signal += 0.02 * rng.standard_normal(len(t))
+
+    return (np.clip(signal, -1, 1) * 32767).astype(np.int16)
+
+
+@pytest.mark.parametrize('seed, chunk_samples, hash_format, fan_out', [
+    (0, 1 << 16, HASH_FORMAT_PACKED, None),
+    (1, 3001, HASH_FORMAT_PACKED, 5),
+    (2, 40000, HASH_FORMAT_SHA256, None),
+])
+def test_streaming_matches_batch(seed, chunk_samples, hash_format, fan_out):
+    samples = music(40, seed)
+
+    def open_chunks():
+        return (samples[start:start + chunk_samples] for start in range(0, len(samples), chunk_samples))
+
+    result_hashes, duration = create_audio_hashes_streaming(open_chunks, SAMPLE_RATE, hash_format=hash_format,
+                                                            fan_out=fan_out)
+
+    assert result_hashes == create_audio_hashes(samples, SAMPLE_RATE, hash_format=hash_format, fan_out=fan_out)
+    assert duration == len(samples) / SAMPLE_RATE
+
+
+def test_streaming_short_signal():
+    assert create_audio_hashes_streaming(lambda: iter([np.zeros(100, dtype=np.int16)]), SAMPLE_RATE) == \
+        ([], 100 / SAMPLE_RATE)
+
+
+def test_anchor_times_single_frame():
+    assert anchor_times_ms(np.array([7, 7, 7]), 1000).tolist() == [0, 0, 0]
+    assert anchor_times_ms(np.array([2, 4, 6]), 1000).tolist() == [0, 500, 1000]
@@ -0,0 +1,141 @@
+from bisect import bisect_left
+
+import numpy as np
+import pytest
+
+from Algorithm.interval_set import IntervalSet, is_sorted_runs, merge_sorted_runs
+
+SEEDS = range(40)
+
+
+# Reference: the list helpers that 'IntervalSet' replaced in 'audio_detection' (unchanged)
+def merge_sequence(duration_list, value, idx_start, idx_end):
+    left_value = min(duration_list[idx_start][0], value[0])
+    right_value = max(duration_list[idx_end - 1][1], value[1])
+
+    duration = duration_list[idx_end - 1][2]
+    if duration_list[idx_end - 1][1] - duration_list[idx_start][0] < value[1] - value[0]:
+        duration = value[2]
+
+    duration_list[idx_start] = (left_value, right_value, duration)
+
+    if idx_end > idx_start + 1:
+        del duration_list[idx_start + 1:idx_end]
+
+
+def add_duration(duration_list, value, max_distance=1):
+    if not duration_list:
+        duration_list.append(value)
+        return
+
+    idx_start = bisect_left(duration_list, value[0], key=lambda item: item[0])
+    idx_end = bisect_left(duration_list, value[1], lo=idx_start, key=lambda item: item[1])
+
+    if idx_start > 0 and value[0] - duration_list[idx_start - 1][1] <= max_distance:
+        idx_start -= 1
+    if idx_end < len(duration_list) and duration_list[idx_end][0] - value[1] <= max_distance:
+        idx_end += 1
+
+    if idx_start == idx_end:
+        duration_list.insert(idx_start, value)
+    else:
+        merge_sequence(duration_list, value, idx_start, idx_end)
+
+    if idx_start > 0 and duration_list[idx_start][0] - duration_list[idx_start - 1][1] <= max_distance:
+        merge_sequence(duration_list, duration_list[idx_start], idx_start - 1, idx_start + 1)
+    if idx_start < len(duration_list) - 1 and duration_list[idx_start + 1][0] - duration_list[idx_start][1]\
+            <= max_distance:
+        merge_sequence(duration_list, duration_list[idx_start], idx_start, idx_start + 2)
+
+
+def reference(intervals, max_gap):
+    duration_list = []
+    for interval in intervals:
+        add_duration(duration_list, interval, max_gap)
+
+    return duration_list
+
+
+def random_intervals(rng, count, sorted_runs=False, allow_reversed=False):
+    """
+    :return: list of (start, end, payload); with 'sorted_runs' - ordered by start, start <= end.
+    """
+    starts = rng.integers(-100, 400, count)
+    if sorted_runs:
+        starts = np.sort(starts)
+
+    ends = starts + rng.integers(-5 if allow_reversed else 0, 40, count)
+    payloads = rng.integers(-50, 50, count)
+
+    return list(zip(starts.tolist(), ends.tolist(), payloads.tolist()))
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_add_matches_add_duration(seed):
+    rng = np.random.default_rng(seed)
+
+    for _ in range(50):
+        max_gap = int(rng.integers(0, 6))
+        intervals = random_intervals(rng, int(rng.integers(0, 80)), allow_reversed=bool(rng.integers(0, 2)))
+
+        interval_set = IntervalSet(max_gap)
+        interval_set.update(intervals)
+
+        assert interval_set.to_list() == reference(intervals, max_gap)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_add_keeps_gaps(seed):
+    rng = np.random.default_rng(seed)
+    max_gap = int(rng.integers(0, 6))
+
+    interval_set = IntervalSet(max_gap)
+    interval_set.update(random_intervals(rng, 200))
+
+    starts, ends = np.array(interval_set.starts), np.array(interval_set.ends)
+    assert np.all(starts <= ends)
+    assert np.all(starts[1:] - ends[:-1] > max_gap)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_merge_sorted_runs_matches_add_duration(seed):
+    rng = np.random.default_rng(seed)
+
+    for _ in range(20):
+        max_gap = int(rng.integers(0, 6))
+        groups = [random_intervals(rng, int(rng.integers(0, 40)), sorted_runs=True)
+                  for _ in range(int(rng.integers(1, 6)))]
+
+        runs = [interval for group in groups for interval in group]
+        group_ids = np.repeat(np.arange(len(groups)) * 3, [len(group) for group in groups])
+        starts, ends, payloads = (np.array(column, dtype=np.int64) for column in zip(*runs)) if runs\
+            else (np.empty(0, dtype=np.int64),) * 3
+
+        assert is_sorted_runs(starts, ends, group_ids)
+        merged_groups, merged_starts, merged_ends, merged_payloads = merge_sorted_runs(starts, ends, payloads, max_gap,
+                                                                                       group_ids)
+
+        for number, group in enumerate(groups):
+            mask = merged_groups == number * 3
+            merged = list(zip(merged_starts[mask].tolist(), merged_ends[mask].tolist(),
+                              merged_payloads[mask].tolist()))
+
+            assert merged == reference(group, max_gap)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_from_sorted_runs_matches_add(seed):
+    rng = np.random.default_rng(seed)
+    max_gap = int(rng.integers(0, 6))
+    intervals = random_intervals(rng, int(rng.integers(1, 100)), sorted_runs=True)
+
+    interval_set = IntervalSet.from_sorted_runs(*zip(*intervals), max_gap=max_gap)
+
+    assert interval_set.to_list() == reference(intervals, max_gap)
+
+
+def test_is_sorted_runs():
+    assert is_sorted_runs([1, 5, 5], [2, 6, 9])
+    assert not is_sorted_runs([1, 5, 3], [2, 6, 9])
+    assert not is_sorted_runs([1, 5], [2, 4])
+    assert is_sorted_runs([1, 5, 3], [2, 6, 9], [0, 0, 1])